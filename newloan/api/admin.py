@@ -1,19 +1,90 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from .models import Investor, Investment, Pairing
 
+# Counts stop here instead of scanning a whole million-row table
+COUNT_CAP = 10000
+# Unfiltered PostgreSQL tables at least this large use the planner's row estimate
+ESTIMATE_THRESHOLD = 100000
+
+
+def estimated_rows(model, using):
+    """The planner's row estimate for a model's table (-1 if never analyzed)"""
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else -1
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that never runs an exact COUNT(*) over a large table. An
+    unfiltered PostgreSQL table is counted from pg_class, anything else is
+    counted up to COUNT_CAP rows; older rows are reached with keyset links.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where and connections[queryset.db].vendor == 'postgresql':
+            estimate = estimated_rows(queryset.model, queryset.db)
+            if estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return queryset[:COUNT_CAP].count()
+
+
+class KeysetChangeList(ChangeList):
+    """Change list with an "Older" link that continues below the last id shown"""
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = list(self.result_list)
+        self.older_url = None
+        if (len(self.result_list) == self.list_per_page and not self.show_all
+                and ORDER_VAR not in self.params):
+            self.older_url = self.get_query_string({'id__lt': self.result_list[-1].pk}, [PAGE_VAR])
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    """
+    Change lists for tables with millions of rows: related objects come in
+    the page query, counts are estimated or capped, foreign keys use raw id
+    widgets instead of loading every choice, and pages are ordered by id
+    only so deep pages can be reached by keyset. Search fields should use
+    index-friendly lookups such as ``__startswith``.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+    sortable_by = ()
+    change_list_template = 'admin/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
 @admin.register(Investor)
-class InvestorAdmin(admin.ModelAdmin):
+class InvestorAdmin(ScalableAdmin):
     list_display = ('user', 'created_at', 'is_waiting', 'waiting_since', 'phone_number')
+    list_select_related = ('user',)
     list_filter = ('is_waiting',)
-    search_fields = ('user__username', 'user__email', 'phone_number')
+    search_fields = ('user__username__startswith', 'phone_number__startswith')
+    raw_id_fields = ('user', 'referred_by')
 
 @admin.register(Investment)
-class InvestmentAdmin(admin.ModelAdmin):
+class InvestmentAdmin(ScalableAdmin):
     list_display = ('investor', 'amount', 'created_at', 'maturation_date', 'is_matured', 'paired')
+    list_select_related = ('investor__user',)
     list_filter = ('is_matured', 'paired')
-    search_fields = ('investor__user__username',)
+    search_fields = ('investor__user__username__startswith',)
+    raw_id_fields = ('investor', 'pairing')
 
 @admin.register(Pairing)
-class PairingAdmin(admin.ModelAdmin):
+class PairingAdmin(ScalableAdmin):
     list_display = ('investor', 'paired_investment', 'created_at')
-    search_fields = ('investor__user__username', 'paired_investment__investor__user__username')
+    list_select_related = ('investor__user', 'paired_investment__investor__user')
+    search_fields = ('investor__user__username__startswith', 'paired_investment__investor__user__username__startswith')
+    raw_id_fields = ('investor', 'paired_investment')
@@ -0,0 +1,165 @@
+"""
+Async versions of the hot read pages, served in the ASGI serving mode
+(``config.urls_asgi``); ``api.views`` keeps the sync versions for WSGI.
+
+Each view starts its independent queries together with ``asyncio.gather``
+through the async ORM and renders once all of them are in. Django still
+runs one request's ORM calls one after another on that request's worker
+thread, so what ASGI buys is that the event loop serves other requests
+while this one waits on the database, not a shorter single request.
+"""
+import asyncio
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.db.models import Exists, OuterRef, Prefetch
+from django.shortcuts import aget_object_or_404, redirect, render
+from .caching import cache_investor_page
+from .models import Investment, Pairing, Referral
+from .querybudget import query_budget
+from .referrals import downline_stats
+from .summaries import get_summary
+
+arender = sync_to_async(render)
+
+
+async def current_investor(request):
+    """The logged-in user's investor, reusing the user the middleware loaded"""
+    return await sync_to_async(lambda: request.user.investor)()
+
+
+async def fetch(queryset):
+    return [obj async for obj in queryset]
+
+
+async def first_or_none(queryset):
+    return await queryset.afirst()
+
+
+async def none():
+    return None
+
+
+@query_budget(10)
+@login_required
+@cache_investor_page
+async def dashboard(request):
+    investor = await current_investor(request)
+    # Only show investments that have been paired and confirmed
+    investments = Investment.objects.filter(
+        investor=investor,
+        pairing__confirmed=True
+    ).distinct().order_by('-created_at').prefetch_related(
+        Prefetch('pairings', queryset=Pairing.objects.select_related('paired_investment__investor__user'))
+    )
+    active_pairings = Pairing.objects.filter(
+        investor=investor,
+        confirmed=True
+    ).select_related('paired_investment__investor__user').order_by('-created_at')
+    matured_investments_available = Investment.objects.filter(
+        is_matured=True,
+        remaining_amount__gt=0
+    ).exclude(investor=investor)
+    # Build only the awaitable that is gathered, so no coroutine is left unawaited
+    waiting_investment = (
+        first_or_none(Investment.objects.filter(id=investor.waiting_investment_id))
+        if investor.is_waiting and investor.waiting_investment_id else none()
+    )
+
+    summary, matured_investments_available, investments, active_pairings, waiting_investment = await asyncio.gather(
+        sync_to_async(get_summary)(investor),
+        matured_investments_available.aexists(),
+        fetch(investments),
+        fetch(active_pairings),
+        waiting_investment,
+    )
+
+    context = {
+        'investments': investments,
+        'total_invested': summary.total_invested,
+        'total_paired': summary.total_paired,
+        'total_waiting': summary.waiting_returns,
+        'active_investments': summary.active_investments,
+        'total_returns': summary.total_returns,
+        'total_interest': summary.total_interest,
+        'projected_returns': summary.projected_returns,
+        'matured_investments_available': matured_investments_available,
+        'active_pairings': active_pairings,
+        'waiting_investment': waiting_investment
+    }
+    return await arender(request, 'dashboard.html', context)
+
+
+@query_budget(6)
+@login_required
+@cache_investor_page
+async def investment_status(request, investment_id=None):
+    investor = await current_investor(request)
+    # The pairings depend on the investment, so these two queries cannot overlap
+    if investment_id:
+        investment = await aget_object_or_404(Investment, id=investment_id, investor=investor)
+    else:
+        investment = await Investment.objects.filter(investor=investor).order_by('-created_at').afirst()
+
+    pairings = None
+    if investment:
+        pairings = await fetch(Pairing.objects.filter(
+            investor=investor,
+            paired_investment__created_at__lte=investment.created_at
+        ).select_related('paired_investment__investor__user').order_by('-created_at'))
+
+    return await arender(request, 'investment_status.html', {
+        'investment': investment,
+        'pairings': pairings,
+    })
+
+
+@query_budget(6)
+@login_required
+@cache_investor_page
+async def waiting_to_be_paired(request):
+    investor = await current_investor(request)
+    unpaired_investments, pending_pairings = await asyncio.gather(
+        fetch(Investment.objects.filter(
+            investor=investor,
+            paired=False,
+            is_matured=False
+        ).order_by('-created_at')),
+        fetch(Pairing.objects.filter(
+            paired_investment__investor=investor,
+            confirmed=False
+        ).select_related('investor__user', 'paired_investment__investor__user')),
+    )
+    return await arender(request, 'waiting_to_be_paired.html', {
+        'unpaired_investments': unpaired_investments,
+        'pending_pairings': pending_pairings,
+    })
+
+
+@query_budget(7)
+@login_required
+async def referrals(request):
+    try:
+        investor = await current_investor(request)
+        referrals, downline_levels = await asyncio.gather(
+            fetch(Referral.objects.filter(
+                referrer_id=investor.user_id,
+                is_active=True
+            ).select_related('referred_user').annotate(
+                referred_has_invested=Exists(Investment.objects.filter(investor__user=OuterRef('referred_user')))
+            )),
+            sync_to_async(downline_stats)(investor),
+        )
+
+        context = {
+            'referrals': referrals,
+            'total_earnings': sum(referral.total_earnings for referral in referrals),
+            'total_referrals': len(referrals),
+            'downline_levels': downline_levels,
+            'downline_size': sum(level['investors'] for level in downline_levels),
+            'downline_investment': sum(level['investment'] for level in downline_levels),
+        }
+        return await arender(request, 'referrals.html', context)
+    except Exception as e:
+        messages.error(request, f"Error loading referrals: {str(e)}")
+        return redirect('api:dashboard')
@@ -0,0 +1,335 @@
+"""
+Matching throughput benchmarks run against synthetic markets.
+
+Each scenario generates a fresh market inside a transaction that is rolled
+back afterwards, so scenarios never see each other's rows.
+"""
+import asyncio
+import queue
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from asgiref.sync import ThreadSensitiveContext
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import OperationalError, connection, transaction
+from django.test import AsyncClient, Client, RequestFactory, override_settings
+from django.urls import reverse
+from django.db.models import Sum
+from django.utils import timezone
+from . import ledger, market
+from .models import BalanceEntry, Investor, Investment, Notification, Pairing, WaitingQueueEntry
+from .summaries import refresh_summaries
+from .notifications import BATCH_SIZE as NOTIFICATION_BATCH_SIZE, send_pending
+from .tasks import match_waiting_investors
+from .views import match_investor
+
+DEFAULT_AMOUNTS = (100, 500, 1000, 5000)
+DEFAULT_MATURITIES = (7, 14, 30)
+
+
+class QueryCounter:
+    """Counts queries through a connection execute wrapper"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def generate_market(size, matured_ratio=0.3, amounts=DEFAULT_AMOUNTS, maturities=DEFAULT_MATURITIES,
+                    seed=0, batch_size=5000):
+    """
+    Create ``size`` investors with one investment each. A ``matured_ratio``
+    share of them are matured supply; the rest are immature demand and are
+    put in the waiting queue. Returns the ids of the waiting investors.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    prefix = f'bench{seed}_{size}_'
+
+    User.objects.bulk_create(
+        [User(username=f'{prefix}{i}', password='!') for i in range(size)],
+        batch_size=batch_size
+    )
+    users = User.objects.filter(username__startswith=prefix).order_by('id')
+    Investor.objects.bulk_create(
+        [Investor(user=user, referral_code=f'{prefix}{user.id}') for user in users.iterator()],
+        batch_size=batch_size
+    )
+
+    investments = []
+    waiting = []
+    for investor in Investor.objects.filter(user__username__startswith=prefix).order_by('id').iterator():
+        amount = Decimal(rng.choice(amounts))
+        matured = rng.random() < matured_ratio
+        days = rng.choice(maturities)
+        investment = Investment(
+            investor=investor,
+            amount=amount,
+            remaining_amount=amount,
+            maturation_date=now - timedelta(days=days) if matured else now + timedelta(days=days),
+            is_matured=matured
+        )
+        investment.refresh_returns()  # bulk_create bypasses save()
+        investments.append(investment)
+        if not matured:
+            waiting.append(investor.id)
+    Investment.objects.bulk_create(investments, batch_size=batch_size)
+
+    WaitingQueueEntry.objects.bulk_create(
+        [
+            WaitingQueueEntry(investment=investment, investor_id=investment.investor_id, enqueued_at=now)
+            for investment in investments if not investment.is_matured
+        ],
+        batch_size=batch_size
+    )
+    Investor.objects.filter(id__in=waiting).update(is_waiting=True, waiting_since=now)
+    return waiting
+
+
+def measure(func, track_memory=True):
+    """Run ``func`` and return its result with wall time, query count and peak memory"""
+    counter = QueryCounter()
+    if track_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        result = func()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if track_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {'seconds': elapsed, 'queries': counter.count, 'peak_memory_bytes': peak}
+
+
+def run_task_scenario(size, track_memory=True, **market):
+    """Benchmark a full match_waiting_investors run over a synthetic market"""
+    with transaction.atomic():
+        generate_market(size, **market)
+        pairings, stats = measure(match_waiting_investors, track_memory)
+        transaction.set_rollback(True)
+    return dict(stats, scenario='task', size=size, pairings=pairings)
+
+
+def run_view_scenario(size, requests=100, track_memory=True, **market):
+    """Benchmark the view-level match_investor path for ``requests`` waiting investors"""
+    factory = RequestFactory()
+    with transaction.atomic():
+        waiting = generate_market(size, **market)
+        investors = list(Investor.objects.filter(id__in=waiting[:requests]).select_related('user'))
+        before = Pairing.objects.count()
+
+        def run():
+            for investor in investors:
+                request = factory.get('/api/match-investor/')
+                request.user = investor.user
+                request._messages = CookieStorage(request)
+                match_investor(request)
+
+        _, stats = measure(run, track_memory)
+        pairings = Pairing.objects.count() - before
+        transaction.set_rollback(True)
+    return dict(stats, scenario='view', size=size, requests=len(investors), pairings=pairings)
+
+
+def run_suite(sizes, view_requests=100, track_memory=True, **market):
+    """Run every scenario for every market size and return the result rows"""
+    results = []
+    for size in sizes:
+        for row in (
+            run_task_scenario(size, track_memory=track_memory, **market),
+            run_view_scenario(size, requests=view_requests, track_memory=track_memory, **market),
+        ):
+            row['pairings_per_sec'] = row['pairings'] / row['seconds'] if row['seconds'] else None
+            results.append(row)
+    return results
+
+
+def run_purchase_stress(buyers=50, threads=8, purchases_per_buyer=4, amount=Decimal('10.00'),
+                        listing_amount=None, prefix='stress'):
+    """
+    Have ``buyers`` investors buy ``amount`` of one listing
+    ``purchases_per_buyer`` times each from ``threads`` threads at once.
+    The listing defaults to half the total demand, so buyers race for it
+    and some purchases must be rejected. Rows are committed, so run this
+    against a throwaway database. Returns throughput and oversell checks.
+    """
+    demand = amount * buyers * purchases_per_buyer
+    listing_amount = demand / 2 if listing_amount is None else listing_amount
+
+    seller = Investor.objects.create(user=User.objects.create(username=f'{prefix}_seller', password='!'))
+    share = Investment.objects.create(
+        investor=seller, amount=listing_amount, maturation_date=timezone.now() + timedelta(days=30),
+        status='available', is_for_sale=True
+    )
+    User.objects.bulk_create([User(username=f'{prefix}_{i}', password='!') for i in range(buyers)])
+    Investor.objects.bulk_create([
+        Investor(user=user, referral_code=f'{prefix}_{user.id}')
+        for user in User.objects.filter(username__startswith=f'{prefix}_').exclude(pk=seller.user_id)
+    ])
+    buyer_list = list(Investor.objects.filter(user__username__startswith=f'{prefix}_').exclude(pk=seller.pk))
+    BalanceEntry.objects.bulk_create([
+        BalanceEntry(investor=buyer, amount=amount * purchases_per_buyer, kind='deposit') for buyer in buyer_list
+    ])
+
+    orders = queue.Queue()
+    for _ in range(purchases_per_buyer):
+        for buyer in buyer_list:
+            orders.put(buyer)
+    counts = {'purchases': 0, 'rejected': 0, 'retries': 0}
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                try:
+                    buyer = orders.get_nowait()
+                except queue.Empty:
+                    return
+                while True:
+                    try:
+                        market.buy_share(buyer, share.pk, amount)
+                        outcome = 'purchases'
+                    except market.PurchaseError:
+                        outcome = 'rejected'
+                    except OperationalError:
+                        # The database refused the lock (SQLite); try the order again
+                        with lock:
+                            counts['retries'] += 1
+                        time.sleep(0.001)
+                        continue
+                    with lock:
+                        counts[outcome] += 1
+                    break
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    share.refresh_from_db()
+    sold = Investment.objects.filter(investor__in=buyer_list).aggregate(total=Sum('amount'))['total'] or Decimal('0')
+    seller_credit = ledger.balance(seller)
+    return dict(
+        counts,
+        threads=threads,
+        seconds=elapsed,
+        purchases_per_sec=counts['purchases'] / elapsed if elapsed else None,
+        listing_amount=listing_amount,
+        sold=sold,
+        remaining=share.amount,
+        oversold=sold > listing_amount or share.amount != listing_amount - sold or seller_credit != sold,
+    )
+
+
+def run_outbox_benchmark(messages=1000, batch_size=NOTIFICATION_BATCH_SIZE):
+    """
+    Queue ``messages`` outbox notifications and time draining them through
+    the configured email backend. The rows are rolled back afterwards.
+    """
+    with transaction.atomic():
+        user = User.objects.create(username='outbox_benchmark', email='benchmark@example.com', password='!')
+        Notification.objects.bulk_create([
+            Notification(user=user, subject='Benchmark', body=f'Message {i}') for i in range(messages)
+        ])
+        result, stats = measure(lambda: send_pending(batch_size), track_memory=False)
+        transaction.set_rollback(True)
+    return dict(result, messages=messages, batch_size=batch_size, queries=stats['queries'])
+
+
+# Pages compared by run_serving_comparison; each has a sync and an async view
+SERVED_PAGES = ('api:dashboard', 'api:investment_status', 'api:waiting_to_be_paired', 'api:referrals')
+NO_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+TEST_HOSTS = ['testserver']
+
+
+def latency_summary(mode, latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'mode': mode,
+        'requests': len(latencies),
+        'requests_per_sec': len(latencies) / elapsed if elapsed else None,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+    }
+
+
+def run_serving_comparison(size=200, requests=200, concurrency=8, seed=0):
+    """
+    Serve the same hot read pages through the WSGI path (sync views, one
+    thread per in-flight request) and the ASGI path (async views on one
+    event loop) with ``concurrency`` requests in flight, and return the
+    latency of each. The page cache is off so every request renders. Rows
+    are committed, so run this against a throwaway database.
+    """
+    generate_market(size, seed=seed)
+    match_waiting_investors()
+    Pairing.objects.update(confirmed=True, confirmed_at=timezone.now())
+    # Build the portfolio summaries up front so pages are measured in steady state
+    refresh_summaries(Investor.objects.values_list('id', flat=True))
+    users = list(User.objects.filter(investor__isnull=False).order_by('id')[:concurrency * 4])
+    rng = random.Random(seed)
+    plan = [(rng.randrange(len(users)), SERVED_PAGES[i % len(SERVED_PAGES)]) for i in range(requests)]
+
+    results = []
+    with override_settings(CACHES=NO_CACHE, ALLOWED_HOSTS=TEST_HOSTS, ROOT_URLCONF='config.urls'):
+        clients = []
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        urls = {page: reverse(page) for page in SERVED_PAGES}
+
+        def get(step):
+            index, page = step
+            start = time.perf_counter()
+            response = clients[index].get(urls[page])
+            assert response.status_code == 200, (page, response.status_code)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(get, plan))
+        results.append(latency_summary('wsgi', latencies, time.perf_counter() - start))
+
+    with override_settings(CACHES=NO_CACHE, ALLOWED_HOSTS=TEST_HOSTS, ROOT_URLCONF='config.urls_asgi'):
+        clients = []
+        for user in users:
+            client = AsyncClient()
+            client.force_login(user)
+            clients.append(client)
+        urls = {page: reverse(page) for page in SERVED_PAGES}
+
+        async def serve():
+            slots = asyncio.Semaphore(concurrency)
+
+            async def aget(step):
+                index, page = step
+                # Like ASGIHandler, give each request its own sync worker thread
+                async with slots, ThreadSensitiveContext():
+                    start = time.perf_counter()
+                    response = await clients[index].get(urls[page])
+                    assert response.status_code == 200, (page, response.status_code)
+                    return time.perf_counter() - start
+
+            return await asyncio.gather(*(aget(step) for step in plan))
+
+        start = time.perf_counter()
+        latencies = asyncio.run(serve())
+        results.append(latency_summary('asgi', latencies, time.perf_counter() - start))
+    return results
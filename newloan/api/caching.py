@@ -0,0 +1,105 @@
+"""
+Per-investor caching of rendered pages.
+
+Every cached page of an investor is keyed on that investor's current page
+version. Write paths call ``invalidate_investor_pages`` for the investors
+whose data changed, which drops the version so their next request renders
+fresh pages; other investors keep their cache.
+"""
+import hashlib
+import uuid
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from .metrics import note_cache_lookup
+
+
+def version_key(investor_id):
+    return f'investor-pages:{investor_id}'
+
+
+def page_version(investor_id):
+    """Return the investor's current page version, creating one if needed"""
+    key = version_key(investor_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_investor_pages(investor_ids):
+    """
+    Drop the cached pages of the given investors once the current
+    transaction commits, so no page is rendered from uncommitted data.
+    """
+    keys = [version_key(investor_id) for investor_id in set(investor_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def page_cache_key(request, view):
+    """The cache key of a request's page, or None if the page must not be cached"""
+    csrf_secret = request.META.get('CSRF_COOKIE')
+    if request.method != 'GET' or not csrf_secret or len(messages.get_messages(request)):
+        return None
+    investor_id = request.user.investor.pk
+    fingerprint = hashlib.sha256(
+        f'{request.get_host()}|{request.get_full_path()}|{csrf_secret}'.encode()
+    ).hexdigest()
+    return f'investor-page:{view.__name__}:{investor_id}:{page_version(investor_id)}:{fingerprint}'
+
+
+def cached_page(request, key):
+    cached = cache.get(key)
+    note_cache_lookup(request, cached is not None)
+    if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+    return None
+
+
+def store_page(request, key, response):
+    if (response.status_code == 200 and not response.streaming
+            and not messages.get_messages(request).used):
+        cache.set(key, (response.content, response['Content-Type']), settings.INVESTOR_PAGE_CACHE_TIMEOUT)
+
+
+def cache_investor_page(view):
+    """
+    Cache a GET page per investor until one of their investments, pairings
+    or sales changes. Pages showing flash messages are never cached, and
+    the CSRF secret is part of the key so cached forms stay valid. Works
+    on sync and async views.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            # Session, user and cache lookups are sync, so they run in a thread
+            key = await sync_to_async(page_cache_key)(request, view)
+            if key is None:
+                return await view(request, *args, **kwargs)
+            response = await sync_to_async(cached_page)(request, key)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+                await sync_to_async(store_page)(request, key, response)
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = page_cache_key(request, view)
+        if key is None:
+            return view(request, *args, **kwargs)
+        response = cached_page(request, key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            store_page(request, key, response)
+        return response
+
+    return wrapper
@@ -0,0 +1,116 @@
+"""
+Streaming statement exports.
+
+Rows are read with ``values_list(...).iterator()`` so no model instances
+are built and only one chunk of rows is held at a time, and are written
+out in buffered blocks as they are read. Memory stays flat however long
+the export is, and the first block is sent after the first chunk instead
+of after the last row.
+"""
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from .models import Investment, InvestmentSale, Pairing
+
+# Rows fetched per database round trip
+CHUNK_SIZE = 2000
+# Characters collected before a block is handed to the server
+BLOCK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def investment_rows(investor=None):
+    investments = Investment.objects.all()
+    if investor is not None:
+        investments = investments.filter(investor=investor)
+    return investments.order_by('id').values_list(
+        'id', 'investor__user__username', 'created_at', 'amount', 'remaining_amount', 'maturation_date',
+        'is_matured', 'status', 'is_for_sale', 'paired', 'matched_at', 'projected_interest', 'end_return'
+    )
+
+
+def pairing_rows(investor=None):
+    pairings = Pairing.objects.all()
+    if investor is not None:
+        # Pairings the investor pays into and pairings paying out their matured investments
+        pairings = pairings.filter(Q(investor=investor) | Q(paired_investment__investor=investor))
+    return pairings.order_by('id').values_list(
+        'id', 'created_at', 'investor__user__username', 'paired_investment_id',
+        'paired_investment__investor__user__username', 'paired_amount', 'confirmed', 'confirmed_at'
+    )
+
+
+def sale_rows(investor=None):
+    sales = InvestmentSale.objects.all()
+    if investor is not None:
+        sales = sales.filter(seller_id=investor.user_id)
+    return sales.order_by('id').values_list(
+        'id', 'created_at', 'investment_id', 'seller__username', 'price', 'remaining_amount', 'unit_price',
+        'maturity_bucket', 'status'
+    )
+
+
+# Export name -> (column names, function returning the rows for an investor or everyone)
+EXPORTS = {
+    'investments': (
+        ('id', 'investor', 'created_at', 'amount', 'remaining_amount', 'maturation_date', 'is_matured',
+         'status', 'is_for_sale', 'paired', 'matched_at', 'projected_interest', 'end_return'),
+        investment_rows,
+    ),
+    'pairings': (
+        ('id', 'created_at', 'payer', 'paired_investment_id', 'receiver', 'paired_amount', 'confirmed',
+         'confirmed_at'),
+        pairing_rows,
+    ),
+    'sales': (
+        ('id', 'created_at', 'investment_id', 'seller', 'price', 'remaining_amount', 'unit_price',
+         'maturity_bucket', 'status'),
+        sale_rows,
+    ),
+}
+
+
+class Echo:
+    """File-like object whose write() returns the value, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def blocks(lines, size=BLOCK_SIZE):
+    """Join lines into blocks of about ``size`` characters"""
+    block = []
+    length = 0
+    for line in lines:
+        block.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(block)
+            block = []
+            length = 0
+    if block:
+        yield ''.join(block)
+
+
+def stream_export(name, file_format, investor=None):
+    """Yield the blocks of export ``name`` in ``file_format``, for one investor or everyone"""
+    columns, rows = EXPORTS[name]
+    lines = csv_lines if file_format == 'csv' else jsonl_lines
+    return blocks(lines(columns, rows(investor).iterator(chunk_size=CHUNK_SIZE)))
@@ -0,0 +1,269 @@
+"""
+Bulk import of users, investors and investments from CSV or JSON Lines.
+
+Every record is one flat row with these fields; only ``username`` is
+required:
+
+    username, email, first_name, last_name, phone_number,
+    amount, maturation_date, remaining_amount
+
+A record creates the user and their investor unless they already exist,
+and an investment when it has an ``amount``. An existing user is reused as
+is, so one user's investments can be spread over many records.
+``maturation_date`` is an ISO 8601 date or datetime.
+
+The file is streamed and written ``chunk_size`` records at a time, each
+chunk in its own transaction together with the job's JobWatermark
+position. An import that fails part way resumes after its last committed
+chunk without duplicating or skipping records. Imported investments start
+unmatured and join the waiting queue while they have a remaining amount,
+and each chunk schedules a matching run for its queued investments once
+it commits; the maturation sweeper matures and matches the ones already
+due.
+"""
+import csv
+import json
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connection, transaction
+from django.db.models import Case, Max, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .caching import invalidate_investor_pages
+from .models import Investment, Investor, JobWatermark, WaitingQueueEntry
+from .tasks import schedule_matching
+
+# Records per transaction; also bounds the size of the IN lists per chunk
+CHUNK_SIZE = 1000
+# Rows per INSERT statement
+INSERT_BATCH_SIZE = 500
+MAX_AMOUNT = Decimal('100000000')  # Investment.amount has 8 integer digits
+CENT = Decimal('0.01')
+
+
+class RecordError(ValueError):
+    """A record that cannot be imported"""
+
+
+def read_records(path, file_format=None):
+    """Yield the records of a CSV or JSON Lines file one at a time"""
+    if file_format is None:
+        file_format = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    # Decoded in clean_record so a bad line is rejected, not fatal
+                    yield line
+
+
+def parse_amount(value, name):
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise RecordError(f'{name} is not a number')
+    if not amount.is_finite() or amount.quantize(CENT) != amount:
+        raise RecordError(f'{name} must have at most two decimal places')
+    if amount < 0 or amount >= MAX_AMOUNT:
+        raise RecordError(f'{name} is out of range')
+    return amount
+
+
+def parse_maturation_date(value):
+    value = str(value).strip()
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise RecordError('maturation_date is not an ISO 8601 date')
+        moment = datetime.combine(day, datetime.min.time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def clean_record(record):
+    """Validate one raw record and return its fields, raising RecordError if invalid"""
+    if isinstance(record, str):
+        try:
+            record = json.loads(record)
+        except ValueError:
+            raise RecordError('Line is not valid JSON')
+        if not isinstance(record, dict):
+            raise RecordError('Line is not a JSON object')
+    fields = {key: value for key, value in record.items() if value not in (None, '')}
+
+    username = str(fields.get('username', '')).strip()
+    if not username:
+        raise RecordError('username is required')
+    try:
+        User.username_validator(username)
+    except ValidationError:
+        raise RecordError('username is not valid')
+    if len(username) > 150:
+        raise RecordError('username is longer than 150 characters')
+
+    email = str(fields.get('email', '')).strip()
+    if email:
+        try:
+            validate_email(email)
+        except ValidationError:
+            raise RecordError('email is not valid')
+    phone_number = str(fields.get('phone_number', '')).strip() or None
+    if phone_number and len(phone_number) > 15:
+        raise RecordError('phone_number is longer than 15 characters')
+
+    cleaned = {
+        'username': username,
+        'email': email,
+        'first_name': str(fields.get('first_name', '')).strip()[:150],
+        'last_name': str(fields.get('last_name', '')).strip()[:150],
+        'phone_number': phone_number,
+        'investment': None,
+    }
+    if 'amount' in fields:
+        amount = parse_amount(fields['amount'], 'amount')
+        if amount == 0:
+            raise RecordError('amount must be positive')
+        if 'maturation_date' not in fields:
+            raise RecordError('maturation_date is required with an amount')
+        remaining = amount
+        if 'remaining_amount' in fields:
+            remaining = parse_amount(fields['remaining_amount'], 'remaining_amount')
+            if remaining > amount:
+                raise RecordError('remaining_amount is larger than amount')
+        cleaned['investment'] = {
+            'amount': amount,
+            'remaining_amount': remaining,
+            'maturation_date': parse_maturation_date(fields['maturation_date']),
+        }
+    return cleaned
+
+
+def write_chunk(rows):
+    """
+    Insert the users, investors and investments of one chunk of cleaned
+    records. Returns the number of users and investments created.
+    """
+    usernames = {row['username'] for row in rows}
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+    new_users = {}
+    for row in rows:
+        if row['username'] not in user_ids and row['username'] not in new_users:
+            new_users[row['username']] = User(
+                username=row['username'], email=row['email'], first_name=row['first_name'],
+                last_name=row['last_name'], password=make_password(None)
+            )
+    User.objects.bulk_create(new_users.values(), batch_size=INSERT_BATCH_SIZE)
+    # Read the ids back, since not every database returns them from a bulk insert
+    user_ids.update(User.objects.filter(username__in=new_users).values_list('username', 'id'))
+
+    investor_ids = dict(Investor.objects.filter(user_id__in=user_ids.values()).values_list('user_id', 'id'))
+    new_investors = {}
+    for row in rows:
+        user_id = user_ids[row['username']]
+        if user_id not in investor_ids and user_id not in new_investors:
+            # bulk_create skips Investor.save(), which fills in the referral code
+            new_investors[user_id] = Investor(
+                user_id=user_id, phone_number=row['phone_number'], referral_code=str(uuid.uuid4())
+            )
+    Investor.objects.bulk_create(new_investors.values(), batch_size=INSERT_BATCH_SIZE)
+    investor_ids.update(Investor.objects.filter(user_id__in=new_investors).values_list('user_id', 'id'))
+
+    investments = []
+    for row in rows:
+        if row['investment'] is not None:
+            investment = Investment(investor_id=investor_ids[user_ids[row['username']]], **row['investment'])
+            investment.refresh_returns()
+            investments.append(investment)
+    # Portfolio summaries only count confirmed pairings, so new unpaired
+    # investments leave them unchanged
+    returns_ids = connection.features.can_return_rows_from_bulk_insert
+    last_id = None if returns_ids else Investment.objects.aggregate(last=Max('id'))['last'] or 0
+    Investment.objects.bulk_create(investments, batch_size=INSERT_BATCH_SIZE)
+
+    # bulk_create skips the signal that queues new demand
+    waiting = [investment for investment in investments if investment.remaining_amount > 0]
+    if waiting:
+        investor_ids = {investment.investor_id for investment in waiting}
+        if not returns_ids:
+            ids = list(Investment.objects.filter(
+                id__gt=last_id, investor_id__in=investor_ids, remaining_amount__gt=0
+            ).values_list('id', 'investor_id'))
+        else:
+            ids = [(investment.pk, investment.investor_id) for investment in waiting]
+        now = timezone.now()
+        WaitingQueueEntry.objects.bulk_create(
+            [WaitingQueueEntry(investment_id=pk, investor_id=investor_id, enqueued_at=now) for pk, investor_id in ids],
+            batch_size=INSERT_BATCH_SIZE
+        )
+        # Like enqueue(), point each investor at their latest queued investment
+        latest = {}
+        for pk, investor_id in ids:
+            latest[investor_id] = max(pk, latest.get(investor_id, pk))
+        Investor.objects.filter(pk__in=latest).update(
+            is_waiting=True,
+            waiting_since=now,
+            waiting_investment_id=Case(*(When(pk=investor_id, then=Value(pk)) for investor_id, pk in latest.items()))
+        )
+        invalidate_investor_pages(latest)
+        # The new demand can pair with supply that is already open
+        schedule_matching(*(pk for pk, _ in ids))
+    return len(new_users), len(investments)
+
+
+def import_records(path, job, file_format=None, chunk_size=CHUNK_SIZE, restart=False,
+                   on_reject=None, on_chunk=None):
+    """
+    Import a CSV or JSON Lines file, resuming job ``job`` where it stopped
+    unless ``restart`` is set. Invalid records are skipped and passed to
+    ``on_reject(record_number, message)``; ``on_chunk(stats)`` is called
+    after every committed chunk. Returns the counts and the rows per second.
+    """
+    watermark, _ = JobWatermark.objects.get_or_create(name=job)
+    if restart:
+        watermark.position = 0
+        watermark.save(update_fields=['position', 'updated_at'])
+    resumed_at = position = watermark.position
+
+    stats = {'resumed_at': resumed_at, 'records': 0, 'rejected': 0, 'users': 0, 'investments': 0}
+    start = time.perf_counter()
+    records = islice(read_records(path, file_format), resumed_at, None)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        rows = []
+        for number, record in enumerate(chunk, position + 1):
+            try:
+                rows.append(clean_record(record))
+            except RecordError as e:
+                stats['rejected'] += 1
+                if on_reject:
+                    on_reject(number, str(e))
+
+        with transaction.atomic():
+            users, investments = write_chunk(rows)
+            position += len(chunk)
+            watermark.position = position
+            watermark.save(update_fields=['position', 'updated_at'])
+
+        stats['records'] += len(chunk)
+        stats['users'] += users
+        stats['investments'] += investments
+        stats['seconds'] = time.perf_counter() - start
+        if on_chunk:
+            on_chunk(stats)
+
+    stats['seconds'] = elapsed = time.perf_counter() - start
+    stats['rows_per_sec'] = stats['records'] / elapsed if stats['records'] and elapsed else None
+    return stats
@@ -0,0 +1,144 @@
+"""
+Append-only balance ledger.
+
+Balances are never updated in place. Every movement is a ``BalanceEntry``
+insert, and a periodic job folds the entries into one ``BalanceSnapshot``
+per investor. Reading a balance is the snapshot plus the entries written
+after it, so writers never contend on a shared balance row.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+from .models import BalanceEntry, BalanceSnapshot
+from .task_metrics import note
+
+# Only entries older than this are folded into snapshots. This assumes a
+# transaction commits its entries within the lag: one that commits later,
+# below an id a run has already folded past, is left out of that investor's
+# snapshot until repair_snapshots() recomputes it from its entries
+SNAPSHOT_LAG = timedelta(minutes=1)
+
+
+def post_entry(investor, amount, kind, reference=''):
+    """Append a single balance movement for ``investor``"""
+    return BalanceEntry.objects.create(investor=investor, amount=amount, kind=kind, reference=reference)
+
+
+def transfer(payer, payee, amount, payer_kind, payee_kind, reference=''):
+    """Move ``amount`` from ``payer`` to ``payee`` with two inserts in one statement"""
+    return BalanceEntry.objects.bulk_create([
+        BalanceEntry(investor=payer, amount=-amount, kind=payer_kind, reference=reference),
+        BalanceEntry(investor=payee, amount=amount, kind=payee_kind, reference=reference),
+    ])
+
+
+def balances(investor_ids):
+    """
+    Return a dict of investor id to current balance, read as each
+    snapshot plus the sum of the entries written after it.
+    """
+    investor_ids = set(investor_ids)
+    snapshots = {
+        snapshot.investor_id: snapshot
+        for snapshot in BalanceSnapshot.objects.filter(investor_id__in=investor_ids)
+    }
+    result = {investor_id: Decimal('0.00') for investor_id in investor_ids}
+    for investor_id, snapshot in snapshots.items():
+        result[investor_id] = snapshot.balance
+
+    # Group investors by snapshot position so the tail is one query per position
+    by_position = {}
+    for investor_id in investor_ids:
+        snapshot = snapshots.get(investor_id)
+        by_position.setdefault(snapshot.last_entry_id if snapshot else 0, []).append(investor_id)
+    for last_entry_id, ids in by_position.items():
+        tail = (
+            BalanceEntry.objects.filter(investor_id__in=ids, id__gt=last_entry_id)
+            .values_list('investor_id').order_by().annotate(total=Sum('amount'))
+        )
+        for investor_id, total in tail:
+            result[investor_id] += total
+    return result
+
+
+def balance(investor):
+    """Return ``investor``'s current balance"""
+    return balances([investor.pk])[investor.pk]
+
+
+def take_snapshots(now=None):
+    """
+    Fold every entry older than ``SNAPSHOT_LAG`` into the investors'
+    snapshots with one grouped aggregate and one upsert. Returns the number
+    of snapshots written.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        cutoff = BalanceEntry.objects.filter(created_at__lte=now - SNAPSHOT_LAG).aggregate(cutoff=Max('id'))['cutoff']
+        if cutoff is None:
+            return 0
+        # Each run writes its cutoff to every snapshot it touches, so the
+        # highest stored position is where the previous run stopped
+        previous = BalanceSnapshot.objects.aggregate(position=Max('last_entry_id'))['position'] or 0
+        if cutoff <= previous:
+            return 0
+
+        deltas = dict(
+            BalanceEntry.objects.filter(id__gt=previous, id__lte=cutoff)
+            .values_list('investor_id').order_by().annotate(total=Sum('amount'))
+        )
+        note(examined=len(deltas))
+        current = dict(
+            BalanceSnapshot.objects.filter(investor_id__in=deltas).values_list('investor_id', 'balance')
+        )
+        snapshots = [
+            BalanceSnapshot(investor_id=investor_id, balance=current.get(investor_id, Decimal('0.00')) + total,
+                            last_entry_id=cutoff)
+            for investor_id, total in deltas.items()
+        ]
+        BalanceSnapshot.objects.bulk_create(
+            snapshots,
+            update_conflicts=True,
+            unique_fields=['investor'],
+            update_fields=['balance', 'last_entry_id', 'updated_at']
+        )
+        return len(snapshots)
+
+
+def stale_snapshots(investor_ids):
+    """
+    Return the given investors' snapshots whose balance differs from the
+    sum of their entries up to the snapshot's position, with the balance
+    corrected but not saved.
+    """
+    by_position = {}
+    for snapshot in BalanceSnapshot.objects.filter(investor_id__in=investor_ids):
+        by_position.setdefault(snapshot.last_entry_id, []).append(snapshot)
+    stale = []
+    for last_entry_id, snapshots in by_position.items():
+        totals = dict(
+            BalanceEntry.objects.filter(investor_id__in=[s.investor_id for s in snapshots], id__lte=last_entry_id)
+            .values_list('investor_id').order_by().annotate(total=Sum('amount'))
+        )
+        for snapshot in snapshots:
+            expected = totals.get(snapshot.investor_id, Decimal('0.00'))
+            if snapshot.balance != expected:
+                snapshot.balance = expected
+                stale.append(snapshot)
+    return stale
+
+
+def repair_snapshots(investor_ids):
+    """
+    Recompute the given investors' snapshots from their entries, picking up
+    any entry that committed after a run had folded past its id. Returns
+    the number of snapshots corrected.
+    """
+    with transaction.atomic():
+        # Hold the rows so a concurrent run cannot fold on top of a stale balance
+        list(BalanceSnapshot.objects.select_for_update().filter(investor_id__in=investor_ids).values_list('pk'))
+        stale = stale_snapshots(investor_ids)
+        BalanceSnapshot.objects.bulk_update(stale, ['balance'])
+    return len(stale)
@@ -0,0 +1,121 @@
+"""
+Cache-backed singleton locks.
+
+The lock lives in the configured cache, so it is shared by every worker
+on Redis and is a local, per-process stand-in under the in-memory cache
+used in development and tests. Each lock expires after a timeout, so a
+crashed worker cannot hold it forever.
+"""
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+
+
+class CacheLock:
+    def __init__(self, name, timeout=None):
+        self.key = f'lock:{name}'
+        self.timeout = timeout or settings.SINGLETON_LOCK_TIMEOUT
+        self.token = None
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        if cache.add(self.key, token, self.timeout):
+            self.token = token
+            return True
+        return False
+
+    def release(self):
+        # Only drop the lock if it is still ours and has not expired into
+        # another holder's hands
+        if self.token is not None and cache.get(self.key) == self.token:
+            cache.delete(self.key)
+        self.token = None
+
+
+# Seconds a crashed worker can hold a pending set's guard
+PENDING_GUARD_TIMEOUT = 5
+
+
+class PendingSet:
+    """
+    Work items left for a lock's holder by calls that found it taken. The
+    cache has no atomic set union, so updates are serialised by a short
+    guard lock. An existing (possibly empty) set means a follow-up is due.
+    """
+
+    def __init__(self, name, timeout):
+        self.key = f'lock:{name}:pending'
+        self.guard = CacheLock(f'{name}:pending-guard', PENDING_GUARD_TIMEOUT)
+        self.timeout = timeout
+
+    def update(self, func):
+        while not self.guard.acquire():
+            time.sleep(0.001)
+        try:
+            return func(cache.get(self.key))
+        finally:
+            self.guard.release()
+
+    def add(self, items):
+        self.update(lambda current: cache.set(self.key, (current or set()) | set(items), self.timeout))
+
+    def take(self):
+        """Return and clear the pending items, or None if nothing is pending"""
+        def take(current):
+            cache.delete(self.key)
+            return current
+        return self.update(take)
+
+    def __bool__(self):
+        return cache.get(self.key) is not None
+
+
+def run_exclusive(name, func, follow_up=None, pending=()):
+    """
+    Run ``func`` while holding the singleton lock ``name``.
+
+    A call that finds the lock taken adds its ``pending`` work items to the
+    lock's pending set and returns None straight away. The holder then makes
+    one more run for all calls that arrived during its run: ``follow_up``
+    with the set of their items, or ``func`` again without a ``follow_up``.
+    Any number of overlapping calls coalesce into at most one follow-up and
+    no change waits longer than one extra run. Returns the list of results
+    of the runs made, or None if this call was coalesced.
+    """
+    lock = CacheLock(name)
+    waiting = PendingSet(name, lock.timeout)
+    results = []
+    run = func
+    handed_off = False
+
+    def next_run():
+        items = waiting.take()
+        if items is None:
+            return None
+        return func if follow_up is None else lambda: follow_up(items)
+
+    while True:
+        if not lock.acquire():
+            if handed_off:
+                # The holder took the lock after our items were added, so
+                # its check after release will see them
+                return results or None
+            # After a run of its own, this call's items were already handled.
+            # The holder may have released since the failed acquire, so try
+            # once more rather than leave the items with nobody to run them
+            waiting.add(() if results else pending)
+            run = None
+            handed_off = True
+            continue
+        handed_off = False
+        try:
+            run = run or next_run()
+            while run is not None:
+                results.append(run())
+                run = next_run()
+        finally:
+            lock.release()
+        # A call may have landed between the last check and the release
+        if not waiting:
+            return results
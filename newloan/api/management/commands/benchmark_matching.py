@@ -0,0 +1,72 @@
+import json
+import platform
+import django
+from celery import current_app
+from django.core.management.base import BaseCommand
+from django.db import connection
+from api.benchmarks import DEFAULT_AMOUNTS, DEFAULT_MATURITIES, run_suite
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks matching throughput against synthetic markets in a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int_list, default=[1000, 10000, 100000],
+                            help='Comma-separated market sizes (investors)')
+        parser.add_argument('--matured-ratio', type=float, default=0.3,
+                            help='Share of investors whose investment has matured')
+        parser.add_argument('--amounts', type=int_list, default=list(DEFAULT_AMOUNTS),
+                            help='Comma-separated investment amounts to draw from')
+        parser.add_argument('--maturities', type=int_list, default=list(DEFAULT_MATURITIES),
+                            help='Comma-separated maturity periods in days to draw from')
+        parser.add_argument('--view-requests', type=int, default=100,
+                            help='Number of match_investor requests per market')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--no-memory', action='store_true',
+                            help='Skip peak memory tracking, which slows the runs down')
+        parser.add_argument('--output', default='benchmark_results.json',
+                            help='File the JSON results are written to')
+
+    def handle(self, *args, **options):
+        # Run tasks inline against an in-memory broker instead of Redis
+        current_app.conf.update(task_always_eager=True, broker_url='memory://')
+
+        # Never touch the configured database; SQLite test databases live in memory
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run_suite(
+                options['sizes'],
+                view_requests=options['view_requests'],
+                track_memory=not options['no_memory'],
+                matured_ratio=options['matured_ratio'],
+                amounts=options['amounts'],
+                maturities=options['maturities'],
+                seed=options['seed'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for row in results:
+            self.stdout.write(
+                f"{row['scenario']:>5} size={row['size']:<7} pairings={row['pairings']:<7} "
+                f"pairings/sec={row['pairings_per_sec'] or 0:,.0f} queries={row['queries']} "
+                f"peak_memory={row['peak_memory_bytes']}"
+            )
+
+        with open(options['output'], 'w') as f:
+            json.dump({
+                'environment': {
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                },
+                'parameters': {key: options[key] for key in (
+                    'sizes', 'matured_ratio', 'amounts', 'maturities', 'view_requests', 'seed'
+                )},
+                'results': results,
+            }, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from api.benchmarks import run_outbox_benchmark
+from api.notifications import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Measures how fast the notification outbox drains in a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--backend', default='django.core.mail.backends.locmem.EmailBackend',
+                            help='Email backend to send through, e.g. the file or SMTP backend')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(EMAIL_BACKEND=options['backend']):
+                result = run_outbox_benchmark(options['messages'], options['batch_size'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            f"sent={result['sent']} failed={result['failed']} batch_size={result['batch_size']} "
+            f"queries={result['queries']} seconds={result['seconds']:.3f} "
+            f"messages/sec={result['messages_per_sec'] or 0:,.0f}"
+        )
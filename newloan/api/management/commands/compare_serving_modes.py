@@ -0,0 +1,35 @@
+from celery import current_app
+from django.core.management.base import BaseCommand
+from django.db import connection
+from api.benchmarks import run_serving_comparison
+
+
+class Command(BaseCommand):
+    help = 'Compares hot read page latency under the WSGI and ASGI serving modes in a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=200, help='Investors in the synthetic market')
+        parser.add_argument('--requests', type=int, default=200, help='Page requests per serving mode')
+        parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # Matching tasks queued while the market is built go to an in-memory broker
+        current_app.conf.update(task_always_eager=True, broker_url='memory://')
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run_serving_comparison(
+                size=options['size'],
+                requests=options['requests'],
+                concurrency=options['concurrency'],
+                seed=options['seed'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for row in results:
+            self.stdout.write(
+                f"{row['mode']:>4} requests={row['requests']} req/sec={row['requests_per_sec'] or 0:,.0f} "
+                f"mean={row['mean_ms']:.1f}ms p50={row['p50_ms']:.1f}ms p95={row['p95_ms']:.1f}ms"
+            )
@@ -0,0 +1,47 @@
+from pathlib import Path
+from django.core.management.base import BaseCommand, CommandError
+from api.imports import CHUNK_SIZE, import_records
+
+
+class Command(BaseCommand):
+    help = 'Imports users, investors and investments from a CSV or JSON Lines file, resuming a failed run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a header row, or JSON Lines file (.jsonl)')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format; guessed from the extension by default')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Records written per transaction')
+        parser.add_argument('--job', help='Name the progress is saved under; defaults to the file name')
+        parser.add_argument('--restart', action='store_true',
+                            help='Start from the first record instead of resuming')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not Path(path).is_file():
+            raise CommandError(f'{path} does not exist')
+        job = options['job'] or f'import:{Path(path).name}'[:50]
+
+        def on_reject(number, message):
+            self.stderr.write(f'Record {number} skipped: {message}')
+
+        def on_chunk(stats):
+            if options['verbosity'] >= 2:
+                self.stdout.write(
+                    f"{stats['resumed_at'] + stats['records']:,} records "
+                    f"({stats['records'] / stats['seconds']:,.0f}/sec)"
+                )
+
+        stats = import_records(
+            path, job, file_format=options['format'], chunk_size=options['chunk_size'],
+            restart=options['restart'], on_reject=on_reject, on_chunk=on_chunk
+        )
+
+        if stats['resumed_at']:
+            self.stdout.write(f"Resumed after record {stats['resumed_at']:,}")
+        self.stdout.write(
+            f"records={stats['records']} rejected={stats['rejected']} users={stats['users']} "
+            f"investments={stats['investments']} seconds={stats['seconds']:.2f} "
+            f"rows/sec={stats['rows_per_sec'] or 0:,.0f}"
+        )
+        self.stdout.write(self.style.SUCCESS(f'Import {job} complete'))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from api.models import Investor, PortfolioSummary
+from api.summaries import SUMMARY_FIELDS, empty_summary, live_summaries, refresh_summaries
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds every portfolio summary in bulk to backfill or repair them, '
+            'or checks them against the live data')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only compare stored summaries with the live data')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Investors rebuilt or checked per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        investor_ids = list(Investor.objects.order_by('pk').values_list('pk', flat=True))
+        mismatches = 0
+
+        for start in range(0, len(investor_ids), batch_size):
+            batch = investor_ids[start:start + batch_size]
+            if options['check']:
+                mismatches += self.check_batch(batch)
+            else:
+                with transaction.atomic():
+                    refresh_summaries(batch)
+
+        if options['check']:
+            if mismatches:
+                raise CommandError(f'{mismatches} of {len(investor_ids)} summaries do not match the live data')
+            self.stdout.write(self.style.SUCCESS(f'All {len(investor_ids)} summaries match the live data'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {len(investor_ids)} summaries'))
+
+    def check_batch(self, investor_ids):
+        live = live_summaries(investor_ids)
+        stored = {
+            summary.pk: summary
+            for summary in PortfolioSummary.objects.filter(pk__in=investor_ids)
+        }
+        mismatches = 0
+        for investor_id in investor_ids:
+            expected = live.get(investor_id, empty_summary())
+            summary = stored.get(investor_id)
+            if summary is None:
+                self.stdout.write(self.style.WARNING(f'Investor {investor_id}: summary missing'))
+                mismatches += 1
+                continue
+            wrong = [field for field in SUMMARY_FIELDS if getattr(summary, field) != expected[field]]
+            if wrong:
+                self.stdout.write(self.style.WARNING(f"Investor {investor_id}: {', '.join(wrong)} out of date"))
+                mismatches += 1
+        return mismatches
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.ledger import repair_snapshots, stale_snapshots
+from api.models import BalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = ('Recomputes balance snapshots from their ledger entries to repair any that missed a '
+            'late-committed entry, or checks them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only compare stored snapshots with their entries')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Snapshots repaired or checked per transaction')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        investor_ids = list(BalanceSnapshot.objects.order_by('pk').values_list('pk', flat=True))
+        stale = 0
+
+        for start in range(0, len(investor_ids), batch_size):
+            batch = investor_ids[start:start + batch_size]
+            if options['check']:
+                for snapshot in stale_snapshots(batch):
+                    self.stdout.write(self.style.WARNING(f'Investor {snapshot.investor_id}: balance out of date'))
+                    stale += 1
+            else:
+                stale += repair_snapshots(batch)
+
+        if options['check']:
+            if stale:
+                raise CommandError(f'{stale} of {len(investor_ids)} snapshots do not match their entries')
+            self.stdout.write(self.style.SUCCESS(f'All {len(investor_ids)} snapshots match their entries'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {stale} of {len(investor_ids)} snapshots'))
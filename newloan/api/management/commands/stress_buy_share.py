@@ -0,0 +1,41 @@
+from decimal import Decimal
+from celery import current_app
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from api.benchmarks import run_purchase_stress
+
+
+class Command(BaseCommand):
+    help = 'Races concurrent buyers against one share listing in a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=50)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--purchases', type=int, default=4,
+                            help='Purchases attempted per buyer')
+        parser.add_argument('--amount', type=Decimal, default=Decimal('10.00'),
+                            help='Amount bought per purchase')
+
+    def handle(self, *args, **options):
+        # Matching tasks queued by new investments go to an in-memory broker
+        current_app.conf.update(broker_url='memory://')
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            result = run_purchase_stress(
+                buyers=options['buyers'],
+                threads=options['threads'],
+                purchases_per_buyer=options['purchases'],
+                amount=options['amount'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            f"threads={result['threads']} purchases={result['purchases']} rejected={result['rejected']} "
+            f"retries={result['retries']} purchases/sec={result['purchases_per_sec'] or 0:,.0f} "
+            f"sold={result['sold']} of {result['listing_amount']} remaining={result['remaining']}"
+        )
+        if result['oversold']:
+            raise CommandError('The listing was oversold')
+        self.stdout.write(self.style.SUCCESS('No amount was oversold'))
@@ -0,0 +1,57 @@
+"""
+Secondary market purchases.
+
+A purchase is one transaction: the buyer's investor row is locked so the
+same buyer cannot overspend in parallel, and the listing is decremented
+with a single conditional UPDATE, so concurrent buyers of one listing
+never oversell it and never wait on each other in Python.
+"""
+from django.db import transaction
+from django.db.models import F
+from . import ledger
+from .models import Investor, Investment
+
+
+class PurchaseError(Exception):
+    """A purchase that cannot go through; the message is shown to the buyer"""
+
+
+def buy_share(buyer, share_id, amount):
+    """
+    Buy ``amount`` of the listed share ``share_id`` for ``buyer``, filling
+    partially if the listing is larger. Returns the buyer's new investment
+    or raises ``PurchaseError`` without changing anything.
+    """
+    if not amount.is_finite() or amount <= 0:
+        raise PurchaseError('Invalid amount to buy.')
+
+    with transaction.atomic():
+        # Serialise purchases per buyer only; sellers never take this lock
+        Investor.objects.select_for_update().get(pk=buyer.pk)
+        if ledger.balance(buyer) < amount:
+            raise PurchaseError('You do not have enough balance to buy this share.')
+
+        listing = Investment.objects.filter(pk=share_id, status='available', is_for_sale=True)
+        filled = listing.exclude(investor=buyer).filter(amount__gte=amount).update(amount=F('amount') - amount)
+        if not filled:
+            if not listing.exists():
+                raise PurchaseError('This share is no longer available.')
+            if listing.filter(investor=buyer).exists():
+                raise PurchaseError('You cannot buy your own share.')
+            raise PurchaseError('Only part of this share is left; choose a smaller amount.')
+
+        # The row stays locked by the UPDATE until commit, so this read is
+        # current; saving refreshes the stored returns for the new amount
+        share = Investment.objects.select_related('investor').get(pk=share_id)
+        if share.amount == 0:
+            share.status = 'sold'
+        share.save(update_fields=['status'])
+
+        buyer_investment = Investment.objects.create(
+            investor=buyer,
+            amount=amount,
+            maturation_date=share.maturation_date,
+            status='matched'
+        )
+        ledger.transfer(buyer, share.investor, amount, 'purchase', 'sale', reference=f'investment:{share.pk}')
+        return buyer_investment
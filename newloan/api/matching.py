@@ -0,0 +1,288 @@
+from collections import deque
+from django.db import transaction
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+from .models import Investor, Investment, Pairing, WaitingQueueEntry
+from .summaries import apply_deltas, investment_changes
+from .caching import invalidate_investor_pages
+from .notifications import notify_pairings
+from .task_metrics import note
+
+# Rows fetched per round trip while streaming either side of the market
+BATCH_SIZE = 500
+
+
+def match_investments(matured=None, immature=None, claim_batch=None):
+    """
+    Pair matured investments with immature investments from other investors.
+
+    Both sides are read once, oldest first, and paired in a single sweep.
+    Pairings, investments and investors are then written in bulk inside one
+    transaction. ``matured`` and ``immature`` optionally narrow the supply
+    and demand querysets; an explicitly ordered queryset keeps its own
+    order. Demand defaults to the waiting queue, head first, so queue
+    priority decides who is paired and cancelled investments never are.
+    Returns the list of created pairings.
+
+    Every row read is locked for the rest of the transaction. With
+    ``claim_batch`` set, each side claims at most that many rows and skips
+    rows already locked by another worker instead of waiting for them.
+    """
+    return match_batch(matured, immature, claim_batch)[0]
+
+
+def match_batch(matured=None, immature=None, claim_batch=None):
+    """
+    Run one matching pass as ``match_investments`` does and return
+    ``(pairings, resume_after, demand_exhausted)``. ``resume_after`` is the
+    id of the last supply row the pass finished with, or None if it claimed
+    no supply; ``demand_exhausted`` is True when no more unlocked demand was
+    left to claim.
+    """
+    if matured is None:
+        matured = Investment.objects.all()
+    if immature is None:
+        immature = waiting_investments()
+
+    with transaction.atomic():
+        # Both sides are streamed, so a run scoped to a few investments only
+        # reads as far into the other side as it needs to
+        supply = matured.filter(is_matured=True, remaining_amount__gt=0).select_related('investor__user')
+        if not supply.ordered:
+            supply = supply.order_by('created_at', 'id')
+        supply = lock_rows(supply, claim_batch).iterator(chunk_size=BATCH_SIZE)
+
+        demand_rows = immature.filter(is_matured=False, remaining_amount__gt=0).select_related('investor__user')
+        if not demand_rows.ordered:
+            demand_rows = demand_rows.order_by('created_at', 'id')
+        demand_rows = lock_rows(demand_rows, claim_batch).iterator(chunk_size=BATCH_SIZE)
+        demand = deque()
+        demand_exhausted = False
+        demand_claimed = 0
+        last_supply = None
+        stopped = False
+
+        pairings = []
+        changed_investments = {}
+        paired_demand = []
+        examined = 0
+
+        for matured_inv in supply:
+            examined += 1
+            last_supply = matured_inv
+            # Investments from the same investor are skipped for this matured
+            # investment only and keep their place in the queue
+            skipped = []
+            while matured_inv.remaining_amount > 0:
+                if demand:
+                    immature_inv = demand.popleft()
+                else:
+                    immature_inv = next(demand_rows, None)
+                    if immature_inv is None:
+                        demand_exhausted = True
+                        break
+                    examined += 1
+                    demand_claimed += 1
+                if immature_inv.investor_id == matured_inv.investor_id:
+                    skipped.append(immature_inv)
+                    continue
+
+                pairing_amount = min(matured_inv.remaining_amount, immature_inv.remaining_amount)
+                pairings.append(Pairing(
+                    investor=immature_inv.investor,
+                    paired_investment=matured_inv,
+                    paired_amount=pairing_amount
+                ))
+
+                matured_inv.remaining_amount -= pairing_amount
+                immature_inv.remaining_amount -= pairing_amount
+                changed_investments[matured_inv.pk] = matured_inv
+                changed_investments[immature_inv.pk] = immature_inv
+
+                if immature_inv.remaining_amount == 0:
+                    immature_inv.paired = True
+                    paired_demand.append(immature_inv)
+                else:
+                    # Still has demand left, so the matured investment is used up
+                    demand.appendleft(immature_inv)
+
+            if matured_inv.remaining_amount == 0:
+                matured_inv.paired = True
+            demand.extendleft(reversed(skipped))
+
+            if demand_exhausted and not demand:
+                stopped = True
+                break
+
+        if pairings:
+            Pairing.objects.bulk_create(pairings)
+            notify_pairings(pairings)
+            Investment.objects.bulk_update(
+                changed_investments.values(), ['remaining_amount', 'paired']
+            )
+            investment_changes(changed_investments.values())
+            invalidate_investor_pages({inv.investor_id for inv in changed_investments.values()})
+        if paired_demand:
+            # Fully paired investments leave the queue
+            leave_queue([inv.pk for inv in paired_demand], {inv.investor_id for inv in paired_demand})
+
+    note(examined=examined, pairings=len(pairings))
+    resume_after = None
+    if last_supply is not None:
+        resume_after = last_supply.pk
+        if stopped and last_supply.remaining_amount > 0:
+            # Demand ran out part way through this row; a claimed batch
+            # that ran dry paired all of its demand, so retrying it progresses
+            resume_after -= 1
+    # A claim that filled its batch may have left more demand behind
+    demand_exhausted = demand_exhausted and (claim_batch is None or demand_claimed < claim_batch)
+    return pairings, resume_after, demand_exhausted
+
+
+def leave_queue(investment_ids, investor_ids):
+    """
+    Remove investments from the waiting queue; their investors stop waiting
+    unless another of their investments is still queued.
+    """
+    WaitingQueueEntry.objects.filter(investment_id__in=investment_ids).delete()
+    Investor.objects.filter(pk__in=investor_ids).exclude(queue_entries__isnull=False).update(
+        is_waiting=False, waiting_since=None, waiting_investment_id=None
+    )
+
+
+def lock_rows(queryset, claim_batch=None):
+    """Lock the investments a matching run reads, claiming a batch if given"""
+    if claim_batch is None:
+        return queryset.select_for_update(of=('self',))
+    return queryset.select_for_update(skip_locked=True, of=('self',))[:claim_batch]
+
+
+def partition_ranges(partitions):
+    """
+    Split the ids of open matured investments into ``partitions`` contiguous
+    [start, end) ranges, one per matching worker.
+    """
+    bounds = Investment.objects.filter(is_matured=True, remaining_amount__gt=0).aggregate(
+        low=Min('id'), high=Max('id')
+    )
+    if bounds['low'] is None:
+        return []
+    span = (bounds['high'] - bounds['low']) // partitions + 1
+    return [
+        (bounds['low'] + i * span, bounds['low'] + (i + 1) * span)
+        for i in range(partitions)
+    ]
+
+
+def match_id_range(start_id, end_id, claim_batch=BATCH_SIZE):
+    """
+    Match matured investments with ids in [start_id, end_id) in claimed batches.
+
+    Demand is shared between workers: each batch skips immature investments
+    locked by another worker, so no investment is ever paired twice. Batches
+    walk the range by id, so a batch that pairs nothing (its demand all
+    belongs to its supply's investors, or is locked) does not end the run;
+    it stops once no supply is left to claim or no demand is left.
+    """
+    supply = Investment.objects.filter(id__lt=end_id).order_by('id')
+    resume_after = start_id - 1
+    pairings = []
+    while True:
+        batch, resume_after, demand_exhausted = match_batch(
+            matured=supply.filter(id__gt=resume_after), claim_batch=claim_batch
+        )
+        pairings += batch
+        if resume_after is None or demand_exhausted:
+            return pairings
+
+
+def match_for_investments(investment_ids):
+    """
+    Match only the given investments against the other side of the market.
+
+    Matured investments among them are offered to the waiting queue as
+    supply and queued immature ones take any supply left over as demand,
+    so an event never triggers a full-table scan.
+    """
+    pairings = match_investments(matured=Investment.objects.filter(pk__in=investment_ids))
+    pairings += match_investments(immature=waiting_investments().filter(pk__in=investment_ids))
+    return pairings
+
+
+def mature_due_investments(now=None):
+    """
+    Mark every investment whose maturation date has passed as matured. A
+    matured investment is supply, so it leaves the waiting queue. Returns
+    the ids of the newly matured investments.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        due_ids = list(
+            Investment.objects.filter(is_matured=False, maturation_date__lte=now)
+            .select_for_update(skip_locked=True)
+            .values_list('id', flat=True)
+        )
+        note(examined=len(due_ids))
+        for start in range(0, len(due_ids), BATCH_SIZE):
+            batch_ids = due_ids[start:start + BATCH_SIZE]
+            batch = Investment.objects.filter(id__in=batch_ids)
+            # Matured investments no longer count towards projected returns
+            projected = batch.filter(pairing__confirmed=True).values('investor_id').order_by().annotate(
+                total=Sum('end_return')
+            )
+            deltas = {row['investor_id']: {'projected_returns': -row['total']} for row in projected}
+            batch.update(is_matured=True)
+            apply_deltas(deltas)
+            investor_ids = set(batch.values_list('investor_id', flat=True))
+            leave_queue(batch_ids, investor_ids)
+            invalidate_investor_pages(investor_ids)
+    return due_ids
+
+
+def waiting_investments():
+    """Investments in the waiting queue, head first"""
+    return Investment.objects.filter(queue_entry__isnull=False).order_by(
+        'queue_entry__priority', 'queue_entry__enqueued_at', 'id'
+    )
+
+
+def enqueue(investment, priority=0):
+    """Add an investment to the waiting queue and flag its investor as waiting"""
+    with transaction.atomic():
+        entry, created = WaitingQueueEntry.objects.get_or_create(
+            investment=investment,
+            defaults={'investor_id': investment.investor_id, 'priority': priority}
+        )
+        Investor.objects.filter(pk=investment.investor_id).update(
+            is_waiting=True,
+            waiting_since=entry.enqueued_at,
+            waiting_investment_id=investment.id
+        )
+        invalidate_investor_pages([investment.investor_id])
+    return entry
+
+
+def cancel(investment):
+    """
+    Remove an investment from the waiting queue, which takes it out of
+    matching until it is enqueued again. The investor stays flagged as
+    waiting while any other of their investments is still queued.
+    Returns True if the investment was queued.
+    """
+    with transaction.atomic():
+        deleted, _ = WaitingQueueEntry.objects.filter(investment=investment).delete()
+        if deleted:
+            next_entry = WaitingQueueEntry.objects.filter(
+                investor_id=investment.investor_id
+            ).order_by('priority', 'enqueued_at').first()
+            if next_entry:
+                Investor.objects.filter(pk=investment.investor_id).update(
+                    waiting_since=next_entry.enqueued_at,
+                    waiting_investment_id=next_entry.investment_id
+                )
+            else:
+                Investor.objects.filter(pk=investment.investor_id).update(
+                    is_waiting=False, waiting_since=None, waiting_investment_id=None
+                )
+            invalidate_investor_pages([investment.investor_id])
+    return bool(deleted)
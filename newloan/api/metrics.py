@@ -0,0 +1,127 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Counters and histograms live in this process's memory and are served by
+the ``api:metrics`` view, so each web or worker process is scraped as its
+own target and Prometheus aggregates across them.
+"""
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1000, 10000, 50000, 100000, 500000, 1000000)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [per-bucket counts, +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * len(self.buckets), 0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, [list(counts), count, total]) for key, (counts, count, total) in self.values.items())
+        for label_values, (counts, count, total) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f'{self.name}_bucket', format_labels(self.labels + ('le',), label_values + (bound,)),
+                       cumulative)
+            yield f'{self.name}_bucket', format_labels(self.labels + ('le',), label_values + ('+Inf',)), count
+            yield f'{self.name}_sum', format_labels(self.labels, label_values), total
+            yield f'{self.name}_count', format_labels(self.labels, label_values), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'newloan_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+REQUEST_LATENCY = REGISTRY.histogram(
+    'newloan_request_duration_seconds', 'Request latency by route', ('route',))
+REQUEST_QUERIES = REGISTRY.histogram(
+    'newloan_request_db_queries', 'SQL queries per request by route', ('route',), buckets=QUERY_BUCKETS)
+REQUEST_DB_TIME = REGISTRY.histogram(
+    'newloan_request_db_duration_seconds', 'SQL time per request by route', ('route',))
+RESPONSE_SIZE = REGISTRY.histogram(
+    'newloan_response_size_bytes', 'Response body size by route', ('route',), buckets=SIZE_BUCKETS)
+CACHE_LOOKUPS = REGISTRY.counter(
+    'newloan_page_cache_lookups_total', 'Investor page cache lookups by route and result', ('route', 'result'))
+
+
+def note_cache_lookup(request, hit):
+    """Record a page cache hit or miss for the request's timing and metrics"""
+    timings = getattr(request, 'timings', None)
+    if timings is not None:
+        timings.cache_results.append('hit' if hit else 'miss')
@@ -0,0 +1,83 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+from . import metrics
+from .querybudget import async_execute_wrapper
+
+
+class RequestTimings:
+    """Per-request SQL count and time, recorded through a connection execute wrapper"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.cache_results = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+
+def route_name(request):
+    """Label a request by its URL name, e.g. ``api:dashboard``"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.view_name:
+        return 'unmatched'
+    return match.view_name
+
+
+class RequestMetricsMiddleware:
+    """
+    Time every request and record its latency, SQL count and time, page
+    cache results and response size per route. Each response gets a
+    ``Server-Timing`` header with the same numbers. List it first in
+    MIDDLEWARE so the timing covers the whole stack. It runs natively under
+    both WSGI and ASGI, so async views are not forced through a sync adapter.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = request.timings = RequestTimings()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timings):
+            response = self.get_response(request)
+        return self.record(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        timings = request.timings = RequestTimings()
+        start = time.perf_counter()
+        async with async_execute_wrapper(timings):
+            response = await self.get_response(request)
+        return self.record(request, response, timings, time.perf_counter() - start)
+
+    def record(self, request, response, timings, elapsed):
+        route = route_name(request)
+        metrics.REQUESTS.inc(route, request.method, response.status_code)
+        metrics.REQUEST_LATENCY.observe(elapsed, route)
+        metrics.REQUEST_QUERIES.observe(timings.queries, route)
+        metrics.REQUEST_DB_TIME.observe(timings.db_seconds, route)
+        if not response.streaming:
+            metrics.RESPONSE_SIZE.observe(len(response.content), route)
+        for result in timings.cache_results:
+            metrics.CACHE_LOOKUPS.inc(route, result)
+
+        entries = [
+            f'app;dur={elapsed * 1000:.1f}',
+            f'db;dur={timings.db_seconds * 1000:.1f};desc="{timings.queries} queries"',
+        ]
+        if timings.cache_results:
+            entries.append(f'cache;desc="{timings.cache_results[-1]}"')
+        response['Server-Timing'] = ', '.join(entries)
+        return response
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def enqueue_waiting_investors(apps, schema_editor):
+    Investor = apps.get_model('api', 'Investor')
+    Investment = apps.get_model('api', 'Investment')
+    WaitingQueueEntry = apps.get_model('api', 'WaitingQueueEntry')
+
+    entries = []
+    for investor in Investor.objects.filter(is_waiting=True).order_by('created_at'):
+        investment = None
+        if investor.waiting_investment_id:
+            investment = Investment.objects.filter(
+                id=investor.waiting_investment_id, remaining_amount__gt=0
+            ).first()
+        if investment is None:
+            investment = Investment.objects.filter(
+                investor=investor, remaining_amount__gt=0
+            ).order_by('created_at').first()
+        if investment is not None:
+            entries.append(WaitingQueueEntry(
+                investment=investment,
+                investor=investor,
+                enqueued_at=investor.waiting_since or investor.created_at
+            ))
+    WaitingQueueEntry.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_rename_confirmation_date_pairing_confirmed_at_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitingQueueEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('priority', models.SmallIntegerField(default=0)),
+                ('enqueued_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('investment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='queue_entry', to='api.investment')),
+                ('investor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queue_entries', to='api.investor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['priority', 'enqueued_at'], name='api_queue_head_idx')],
+            },
+        ),
+        migrations.RunPython(enqueue_waiting_investors, migrations.RunPython.noop),
+    ]
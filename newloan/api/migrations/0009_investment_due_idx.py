@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_waitingqueueentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(condition=models.Q(('is_matured', False)), fields=['maturation_date'], name='api_investment_due_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_investment_due_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(condition=models.Q(('is_matured', True), ('remaining_amount__gt', 0)), fields=['created_at', 'id'], name='api_investment_supply_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(condition=models.Q(('is_matured', False), ('remaining_amount__gt', 0)), fields=['created_at', 'id'], name='api_investment_demand_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(condition=models.Q(('remaining_amount__gt', 0)), fields=['investor', 'created_at'], name='api_investment_inv_open_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(fields=['status', 'is_for_sale'], name='api_investment_sale_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pairing',
+            index=models.Index(fields=['investor', 'confirmed', '-created_at'], name='api_pairing_investor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pairing',
+            index=models.Index(fields=['paired_investment', 'confirmed'], name='api_pairing_paid_inv_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:22
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def fill_stored_returns(apps, schema_editor):
+    Investment = apps.get_model('api', 'Investment')
+    batch = []
+    for investment in Investment.objects.only('amount', 'created_at', 'maturation_date').iterator(chunk_size=1000):
+        days = (investment.maturation_date - investment.created_at).days
+        investment.projected_interest = investment.amount * Decimal('0.01') * days
+        investment.end_return = investment.amount + investment.projected_interest
+        batch.append(investment)
+        if len(batch) == 1000:
+            Investment.objects.bulk_update(batch, ['projected_interest', 'end_return'])
+            batch = []
+    Investment.objects.bulk_update(batch, ['projected_interest', 'end_return'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investment',
+            name='end_return',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='investment',
+            name='projected_interest',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_stored_returns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_investment_stored_returns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSummary',
+            fields=[
+                ('investor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='api.investor')),
+                ('total_invested', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_paired', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_returns', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_interest', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('projected_returns', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('waiting_returns', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('active_investments', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
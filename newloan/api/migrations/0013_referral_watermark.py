@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:28
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def start_referral_watermark(apps, schema_editor):
+    # Existing referral totals already include every investment matched so far
+    Investment = apps.get_model('api', 'Investment')
+    JobWatermark = apps.get_model('api', 'JobWatermark')
+    Investment.objects.filter(status='matched', matched_at__isnull=True).update(matched_at=F('created_at'))
+    JobWatermark.objects.create(name='referral_earnings', processed_until=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_portfoliosummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('processed_until', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='investment',
+            name='matched_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(start_referral_watermark, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_referral_paths(apps, schema_editor):
+    Investor = apps.get_model('api', 'Investor')
+    ReferralPath = apps.get_model('api', 'ReferralPath')
+    parents = dict(Investor.objects.filter(referred_by__isnull=False).values_list('id', 'referred_by_id'))
+
+    paths = []
+    for descendant_id in parents:
+        ancestor_id, depth, seen = parents[descendant_id], 1, {descendant_id}
+        while ancestor_id is not None and ancestor_id not in seen:
+            paths.append(ReferralPath(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth))
+            seen.add(ancestor_id)
+            ancestor_id, depth = parents.get(ancestor_id), depth + 1
+    ReferralPath.objects.bulk_create(paths, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_referral_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralPath',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='referral_descendants', to='api.investor')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='referral_ancestors', to='api.investor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='api_referral_path_depth_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestor', 'descendant'), name='api_referral_path_unique')],
+            },
+        ),
+        migrations.RunPython(build_referral_paths, migrations.RunPython.noop),
+    ]
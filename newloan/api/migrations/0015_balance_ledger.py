@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def open_balances(apps, schema_editor):
+    # Carry each non-zero stored balance over as an opening ledger entry
+    Investor = apps.get_model('api', 'Investor')
+    BalanceEntry = apps.get_model('api', 'BalanceEntry')
+    BalanceEntry.objects.bulk_create(
+        [
+            BalanceEntry(investor_id=investor_id, amount=balance, kind='opening')
+            for investor_id, balance in Investor.objects.exclude(available_balance=0)
+            .values_list('id', 'available_balance').iterator()
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_referralpath'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('investor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance_snapshot', serialize=False, to='api.investor')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('last_entry_id', models.BigIntegerField(db_index=True, default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('purchase', 'Share purchase'), ('sale', 'Share sale'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('reference', models.CharField(blank=True, max_length=100)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('investor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to='api.investor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['investor', 'id'], name='api_balance_entry_tail_idx')],
+            },
+        ),
+        migrations.RunPython(open_balances, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='investor',
+            name='available_balance',
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:38
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from datetime import date
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def book_pending_sales(apps, schema_editor):
+    # Pending listings offer their whole investment at the listed price
+    InvestmentSale = apps.get_model('api', 'InvestmentSale')
+    sales = list(InvestmentSale.objects.filter(status='pending').select_related('investment'))
+    for sale in sales:
+        investment = sale.investment
+        day = timezone.localdate(investment.maturation_date).toordinal()
+        sale.remaining_amount = investment.amount
+        sale.unit_price = (sale.price / investment.amount).quantize(Decimal('0.0001')) if investment.amount else 1
+        sale.maturity_bucket = date.fromordinal(day - day % settings.MATURITY_BUCKET_DAYS)
+    InvestmentSale.objects.bulk_update(sales, ['remaining_amount', 'unit_price', 'maturity_bucket'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_balance_ledger'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuyOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('remaining_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('limit_price', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('maturity_bucket', models.DateField()),
+                ('held_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('filled', 'Filled'), ('cancelled', 'Cancelled')], default='open', max_length=20)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Trade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('unit_price', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='investmentsale',
+            name='maturity_bucket',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='investmentsale',
+            name='remaining_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='investmentsale',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=4, default=1, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='balanceentry',
+            name='kind',
+            field=models.CharField(choices=[('opening', 'Opening balance'), ('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('purchase', 'Share purchase'), ('sale', 'Share sale'), ('order_hold', 'Buy order hold'), ('order_release', 'Buy order release'), ('adjustment', 'Adjustment')], max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='investmentsale',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['maturity_bucket', 'unit_price', 'created_at', 'id'], name='api_sale_book_idx'),
+        ),
+        migrations.AddField(
+            model_name='buyorder',
+            name='investor',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='buy_orders', to='api.investor'),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='buy_order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trades', to='api.buyorder'),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='investment',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='trade', to='api.investment'),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='sale',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trades', to='api.investmentsale'),
+        ),
+        migrations.AddIndex(
+            model_name='buyorder',
+            index=models.Index(condition=models.Q(('status', 'open')), fields=['maturity_bucket', '-limit_price', 'created_at', 'id'], name='api_buy_order_book_idx'),
+        ),
+        migrations.RunPython(book_pending_sales, migrations.RunPython.noop),
+    ]
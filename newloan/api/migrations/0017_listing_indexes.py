@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_order_book'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(condition=models.Q(('is_for_sale', True), ('status', 'available')), fields=['maturation_date', 'id'], name='api_share_listing_mat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(condition=models.Q(('is_for_sale', True), ('status', 'available')), fields=['amount', 'id'], name='api_share_listing_amt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investmentsale',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['unit_price', 'id'], name='api_sale_listing_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='investmentsale',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['remaining_amount', 'id'], name='api_sale_listing_amt_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='waitingqueueentry',
+            index=models.Index(fields=['enqueued_at'], name='api_queue_age_idx'),
+        ),
+    ]
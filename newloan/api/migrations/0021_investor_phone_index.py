@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_jobwatermark_position'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='investor',
+            name='phone_number',
+            field=models.CharField(blank=True, db_index=True, max_length=15, null=True),
+        ),
+    ]
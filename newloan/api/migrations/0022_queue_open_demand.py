@@ -0,0 +1,33 @@
+from django.db import migrations
+from django.utils import timezone
+
+
+def queue_open_demand(apps, schema_editor):
+    """Queue open demand created before matching read it from the waiting queue"""
+    Investment = apps.get_model('api', 'Investment')
+    Investor = apps.get_model('api', 'Investor')
+    WaitingQueueEntry = apps.get_model('api', 'WaitingQueueEntry')
+
+    open_demand = Investment.objects.filter(
+        is_matured=False, remaining_amount__gt=0, queue_entry__isnull=True
+    ).order_by('created_at', 'id')
+    entries = [
+        # Enqueued at creation time, so the backfill keeps the old oldest-first order
+        WaitingQueueEntry(investment_id=pk, investor_id=investor_id, enqueued_at=created_at or timezone.now())
+        for pk, investor_id, created_at in open_demand.values_list('id', 'investor_id', 'created_at').iterator()
+    ]
+    WaitingQueueEntry.objects.bulk_create(entries, batch_size=500)
+    Investor.objects.filter(pk__in=WaitingQueueEntry.objects.values('investor_id'), is_waiting=False).update(
+        is_waiting=True, waiting_since=timezone.now()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_investor_phone_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(queue_open_demand, migrations.RunPython.noop),
+    ]
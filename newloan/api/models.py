@@ -14,10 +14,9 @@ class Investor(models.Model):
     is_waiting = models.BooleanField(default=False)  # Track if the investor is waiting
     waiting_since = models.DateTimeField(null=True, blank=True)  # Track when they started waiting
     waiting_investment_id = models.IntegerField(null=True, blank=True)  # Track which investment is waiting
-    phone_number = models.CharField(max_length=15, blank=True, null=True)
+    phone_number = models.CharField(max_length=15, blank=True, null=True, db_index=True)
     referral_code = models.CharField(max_length=36, blank=True, null=True, db_index=True)
     referred_by = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='referrals')
-    available_balance = models.DecimalField(max_digits=10, decimal_places=2, default=0)  # Add available balance field
 
     def save(self, *args, **kwargs):
         if not self.referral_code:
@@ -45,7 +44,27 @@ class Investment(models.Model):
     ])
     is_for_sale = models.BooleanField(default=False)
     paired = models.BooleanField(default=False)
+    matched_at = models.DateTimeField(null=True, blank=True, db_index=True)  # Set when status first becomes matched
     pairing = models.ForeignKey('Pairing', on_delete=models.SET_NULL, null=True, blank=True, related_name='investments')
+    # Stored copies of calculate_projected_interest/calculate_end_return, kept in sync by save()
+    projected_interest = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    end_return = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            # Investments still waiting to mature, for the maturation sweeper
+            models.Index(fields=['maturation_date'], condition=models.Q(is_matured=False), name='api_investment_due_idx'),
+            # Open supply and demand for matching, oldest first
+            models.Index(fields=['created_at', 'id'], condition=models.Q(is_matured=True, remaining_amount__gt=0), name='api_investment_supply_idx'),
+            models.Index(fields=['created_at', 'id'], condition=models.Q(is_matured=False, remaining_amount__gt=0), name='api_investment_demand_idx'),
+            # An investor's investments that still need pairing
+            models.Index(fields=['investor', 'created_at'], condition=models.Q(remaining_amount__gt=0), name='api_investment_inv_open_idx'),
+            # Secondary market listings
+            models.Index(fields=['status', 'is_for_sale'], name='api_investment_sale_idx'),
+            # Keyset orderings of the share listing API
+            models.Index(fields=['maturation_date', 'id'], condition=models.Q(status='available', is_for_sale=True), name='api_share_listing_mat_idx'),
+            models.Index(fields=['amount', 'id'], condition=models.Q(status='available', is_for_sale=True), name='api_share_listing_amt_idx'),
+        ]
     
     def calculate_daily_interest(self):
         """Calculate the daily interest (1% of the investment amount)"""
@@ -59,10 +78,48 @@ class Investment(models.Model):
     def calculate_end_return(self):
         """Calculate the total return (principal + interest) at maturity"""
         return self.amount + self.calculate_projected_interest()
+
+    def refresh_returns(self):
+        """Recompute the stored projected interest and end return"""
+        self.amount = self._meta.get_field('amount').to_python(self.amount)
+        maturation_date = self._meta.get_field('maturation_date').to_python(self.maturation_date)
+        if timezone.is_naive(maturation_date):
+            maturation_date = timezone.make_aware(maturation_date)
+        self.maturation_date = maturation_date
+        created_at = self.created_at or timezone.now()
+        days = (self.maturation_date - created_at).days
+        self.projected_interest = self.calculate_daily_interest() * days
+        self.end_return = self.amount + self.projected_interest
+
+    def save(self, *args, **kwargs):
+        self.refresh_returns()
+        if self.status == 'matched' and self.matched_at is None:
+            self.matched_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'projected_interest', 'end_return', 'matched_at'}
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f"Investment of ${self.amount} by {self.investor.user.username}"
 
+class WaitingQueueEntry(models.Model):
+    """One row per investment waiting to be paired"""
+    investment = models.OneToOneField(Investment, on_delete=models.CASCADE, related_name='queue_entry')
+    investor = models.ForeignKey(Investor, on_delete=models.CASCADE, related_name='queue_entries')
+    priority = models.SmallIntegerField(default=0)  # Lower values are served first
+    enqueued_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['priority', 'enqueued_at'], name='api_queue_head_idx'),
+            # Age of the oldest entry, reported as the matching queue lag
+            models.Index(fields=['enqueued_at'], name='api_queue_age_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.investor.user.username} waiting with investment {self.investment_id}"
+
 class Pairing(models.Model):
     investor = models.ForeignKey(Investor, on_delete=models.CASCADE, related_name='pairings')
     paired_investment = models.ForeignKey(Investment, on_delete=models.CASCADE, related_name='pairings')
@@ -70,10 +127,38 @@ class Pairing(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     confirmed = models.BooleanField(default=False)
     confirmed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Pairings a new investor has (un)confirmed, newest first
+            models.Index(fields=['investor', 'confirmed', '-created_at'], name='api_pairing_investor_idx'),
+            # Pairings paying out a given matured investment
+            models.Index(fields=['paired_investment', 'confirmed'], name='api_pairing_paid_inv_idx'),
+        ]
+
+    @property
+    def paired_to(self):
+        """The investor whose matured investment this pairing pays out"""
+        return self.paired_investment.investor
     
     def __str__(self):
         return f"Pairing of ${self.paired_amount} for {self.investor.user.username}"
 
+class PortfolioSummary(models.Model):
+    """Dashboard totals for an investor's paired and confirmed investments"""
+    investor = models.OneToOneField(Investor, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    total_invested = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_paired = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_returns = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_interest = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    projected_returns = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    waiting_returns = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    active_investments = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Portfolio summary for {self.investor_id}"
+
 class Referral(models.Model):
     referrer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referrals_made')
     referred_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referral_received')
@@ -95,6 +180,74 @@ class Referral(models.Model):
     def __str__(self):
         return f"{self.referrer.username} referred {self.referred_user.username}"
 
+class JobWatermark(models.Model):
+    """How far an incremental periodic job has processed its input"""
+    name = models.CharField(max_length=50, unique=True)
+    processed_until = models.DateTimeField(null=True, blank=True)
+    position = models.PositiveBigIntegerField(default=0)  # Records consumed, for jobs reading a file
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} processed until {self.processed_until}"
+
+class ReferralPath(models.Model):
+    """Closure table of the referral tree: one row per ancestor/descendant pair"""
+    ancestor = models.ForeignKey(Investor, on_delete=models.CASCADE, related_name='referral_descendants')
+    descendant = models.ForeignKey(Investor, on_delete=models.CASCADE, related_name='referral_ancestors')
+    depth = models.PositiveIntegerField()  # 1 for a direct referral
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='api_referral_path_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['ancestor', 'depth'], name='api_referral_path_depth_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
+
+class BalanceEntry(models.Model):
+    """
+    Append-only ledger of balance movements. Entries are never updated or
+    deleted; an investor's balance is their latest snapshot plus the
+    entries written after it.
+    """
+    KIND_CHOICES = [
+        ('opening', 'Opening balance'),
+        ('deposit', 'Deposit'),
+        ('withdrawal', 'Withdrawal'),
+        ('purchase', 'Share purchase'),
+        ('sale', 'Share sale'),
+        ('order_hold', 'Buy order hold'),
+        ('order_release', 'Buy order release'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    investor = models.ForeignKey(Investor, on_delete=models.CASCADE, related_name='balance_entries')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)  # Negative for debits
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    reference = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['investor', 'id'], name='api_balance_entry_tail_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.investor} {self.kind} {self.amount}"
+
+class BalanceSnapshot(models.Model):
+    """An investor's balance folded up to and including ``last_entry_id``"""
+    investor = models.OneToOneField(Investor, on_delete=models.CASCADE, primary_key=True, related_name='balance_snapshot')
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    last_entry_id = models.BigIntegerField(default=0, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.investor} balance {self.balance} at entry {self.last_entry_id}"
+
 class InvestmentSale(models.Model):
     investment = models.ForeignKey(Investment, on_delete=models.CASCADE, related_name='sales')
     seller = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sales')
@@ -105,6 +258,97 @@ class InvestmentSale(models.Model):
         ('completed', 'Completed'),
         ('cancelled', 'Cancelled'),
     ])
+    # Order book fields: the face amount still offered, the asking price per
+    # unit of face amount and the maturity bucket the ask trades in
+    remaining_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=4, default=1)
+    maturity_bucket = models.DateField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['maturity_bucket', 'unit_price', 'created_at', 'id'],
+                condition=models.Q(status='pending'),
+                name='api_sale_book_idx'
+            ),
+            # Keyset orderings of the sale listing API
+            models.Index(fields=['unit_price', 'id'], condition=models.Q(status='pending'), name='api_sale_listing_price_idx'),
+            models.Index(fields=['remaining_amount', 'id'], condition=models.Q(status='pending'), name='api_sale_listing_amt_idx'),
+        ]
     
     def __str__(self):
         return f"Sale of {self.investment} by {self.seller.username} for ${self.price}"
+
+class BuyOrder(models.Model):
+    """
+    Standing interest to buy face amount in one maturity bucket at up to
+    ``limit_price`` per unit. The full cost at the limit is held on the
+    buyer's ledger while the order is open.
+    """
+    investor = models.ForeignKey(Investor, on_delete=models.CASCADE, related_name='buy_orders')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    remaining_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    limit_price = models.DecimalField(max_digits=10, decimal_places=4)
+    maturity_bucket = models.DateField()
+    held_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=20, default='open', choices=[
+        ('open', 'Open'),
+        ('filled', 'Filled'),
+        ('cancelled', 'Cancelled'),
+    ])
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['maturity_bucket', '-limit_price', 'created_at', 'id'],
+                condition=models.Q(status='open'),
+                name='api_buy_order_book_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Buy {self.remaining_amount} of {self.amount} at {self.limit_price} by {self.investor}"
+
+class Trade(models.Model):
+    """One fill between a buy order and a sale listing"""
+    buy_order = models.ForeignKey(BuyOrder, on_delete=models.CASCADE, related_name='trades')
+    sale = models.ForeignKey(InvestmentSale, on_delete=models.CASCADE, related_name='trades')
+    investment = models.OneToOneField(Investment, on_delete=models.CASCADE, related_name='trade')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=4)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Trade of {self.amount} at {self.unit_price}"
+
+class Notification(models.Model):
+    """
+    Transactional outbox of emails. Rows are written in the same transaction
+    as the event they announce and sent later in batches by
+    api.tasks.send_notifications.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Due messages, oldest first
+            models.Index(fields=['next_attempt_at', 'id'], condition=models.Q(status='pending'), name='api_outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.user} ({self.status})"
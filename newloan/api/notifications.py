@@ -0,0 +1,126 @@
+"""
+Email notifications through a transactional outbox.
+
+Events write Notification rows in their own transaction, so a message is
+queued if and only if the event commits and no event ever waits on a mail
+server. api.tasks.send_notifications drains the outbox in batches over a
+single mail connection. Failed messages are retried with exponential
+backoff and given up on after MAX_ATTEMPTS. Delivery is at least once: a
+worker that dies between sending a batch and marking it sent resends it.
+"""
+import logging
+import time
+from datetime import timedelta
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F
+from django.utils import timezone
+from .models import Notification
+
+logger = logging.getLogger(__name__)
+
+# Messages sent per round trip to the database
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = timedelta(minutes=1)
+
+
+def notify_pairings(pairings):
+    """
+    Queue a "paired" email to the investor of each new pairing. Call it in
+    the transaction that creates the pairings; investors and the paired
+    investment's investor should come with their users loaded.
+    """
+    Notification.objects.bulk_create([
+        Notification(
+            user_id=pairing.investor.user_id,
+            subject='Investment Paired',
+            body=(
+                f'Dear {pairing.investor.user.username},\n\n'
+                f'Your investment has been paired with {pairing.paired_investment.investor.user.username} '
+                f'for an amount of ${pairing.paired_amount}.\n\n'
+                'Best regards,\nLoan Management System'
+            ),
+        )
+        for pairing in pairings
+    ])
+
+
+def retry_delay(attempts):
+    """Backoff before the next try of a message that has failed ``attempts`` times"""
+    return RETRY_BASE_DELAY * 2 ** (attempts - 1)
+
+
+def record_failures(failures, now):
+    """Schedule a retry for each (notification, error) pair, or give up on it"""
+    for notification, error in failures:
+        notification.attempts += 1
+        notification.last_error = str(error)
+        if notification.attempts >= MAX_ATTEMPTS:
+            notification.status = 'failed'
+        else:
+            notification.next_attempt_at = now + retry_delay(notification.attempts)
+    Notification.objects.bulk_update(
+        [notification for notification, _ in failures],
+        ['attempts', 'last_error', 'status', 'next_attempt_at']
+    )
+
+
+def send_pending(batch_size=BATCH_SIZE, now=None):
+    """
+    Send every due outbox message, ``batch_size`` at a time, over one
+    reused mail connection. Run it from one worker at a time. Returns the
+    number of messages sent and failed and the send rate.
+    """
+    now = now or timezone.now()
+    due = Notification.objects.filter(status='pending', next_attempt_at__lte=now).select_related('user')
+    due = due.order_by('next_attempt_at', 'id')
+    sent = failed = 0
+    start = time.perf_counter()
+
+    batch = list(due[:batch_size])
+    if batch:
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # The mail server is unreachable; back the batch off and stop
+            logger.warning('Failed to open mail connection', exc_info=True)
+            record_failures([(notification, e) for notification in batch], now)
+            batch, failed = [], len(batch)
+
+        try:
+            while batch:
+                sent_ids = []
+                failures = []
+                for notification in batch:
+                    try:
+                        if not notification.user.email:
+                            raise ValueError('User has no email address')
+                        message = EmailMessage(
+                            notification.subject, notification.body, to=[notification.user.email],
+                            connection=connection
+                        )
+                        message.send()
+                        sent_ids.append(notification.pk)
+                    except Exception as e:
+                        failures.append((notification, e))
+
+                Notification.objects.filter(pk__in=sent_ids).update(
+                    status='sent', sent_at=timezone.now(), attempts=F('attempts') + 1
+                )
+                if failures:
+                    record_failures(failures, now)
+                sent += len(sent_ids)
+                failed += len(failures)
+                # Sent and failed messages are no longer due, so this is the next batch
+                batch = list(due[:batch_size])
+        finally:
+            connection.close()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'sent': sent,
+        'failed': failed,
+        'seconds': elapsed,
+        'messages_per_sec': sent / elapsed if sent and elapsed else None,
+    }
@@ -0,0 +1,288 @@
+"""
+Price-time priority order book for the secondary market.
+
+Sale listings (asks) and buy orders (bids) trade within maturity buckets.
+Each bucket keeps both sides in memory as heaps ordered by price, then
+time, so finding the best ask and bid is O(1) and every fill is O(log n).
+The database stays the source of truth: a book is rebuilt from the open
+rows the first time a process touches its bucket, picks up rows written
+by other processes on each pass, and every fill re-reads and locks the
+two rows before trading, so a stale heap entry is simply dropped. Within
+a process, each book has a lock that serialises its passes.
+"""
+import heapq
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from . import ledger
+from .models import BuyOrder, Investor, Investment, InvestmentSale, Trade
+
+CENT = Decimal('0.01')
+UNIT_PRICE = Decimal('0.0001')
+
+# Rows created this long before the last pass are looked for again, so rows
+# committed out of creation order by other processes are not missed
+SYNC_LAG = timedelta(minutes=1)
+
+
+class OrderError(Exception):
+    """An order that cannot be placed; the message is shown to the user"""
+
+
+def bucket_for(maturation_date):
+    """Return the first day of the maturity bucket ``maturation_date`` falls in"""
+    day = timezone.localdate(maturation_date).toordinal()
+    return date.fromordinal(day - day % settings.MATURITY_BUCKET_DAYS)
+
+
+class BookSide:
+    """
+    One side of a bucket's book: a heap of (price key, time, id). Orders
+    are removed by id and their heap entries dropped once they reach the top.
+    """
+
+    def __init__(self, descending):
+        self.descending = descending
+        self.heap = []
+        self.ids = set()
+
+    def push(self, order_id, price, created_at):
+        if order_id in self.ids:
+            return
+        self.ids.add(order_id)
+        heapq.heappush(self.heap, (-price if self.descending else price, created_at, order_id))
+
+    def best(self):
+        """Return (id, price) of the best order, or None when the side is empty"""
+        while self.heap and self.heap[0][2] not in self.ids:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        key, _, order_id = self.heap[0]
+        return order_id, -key if self.descending else key
+
+    def remove(self, order_id):
+        self.ids.discard(order_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class OrderBook:
+    """Asks and bids of one maturity bucket"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.asks = BookSide(descending=False)
+        self.bids = BookSide(descending=True)
+        self.synced_at = None
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """Load open rows of this bucket not in the heaps yet"""
+        now = timezone.now()
+        asks = InvestmentSale.objects.filter(status='pending', maturity_bucket=self.bucket, remaining_amount__gt=0)
+        bids = BuyOrder.objects.filter(status='open', maturity_bucket=self.bucket)
+        if self.synced_at is not None:
+            asks = asks.filter(created_at__gte=self.synced_at - SYNC_LAG)
+            bids = bids.filter(created_at__gte=self.synced_at - SYNC_LAG)
+        for sale_id, price, created_at in asks.values_list('id', 'unit_price', 'created_at').iterator():
+            self.asks.push(sale_id, price, created_at)
+        for order_id, price, created_at in bids.values_list('id', 'limit_price', 'created_at').iterator():
+            self.bids.push(order_id, price, created_at)
+        self.synced_at = now
+
+
+_books = {}
+_books_lock = threading.Lock()
+
+
+def get_book(bucket):
+    """Return the bucket's in-memory book; sync it while holding its lock"""
+    with _books_lock:
+        book = _books.get(bucket)
+        if book is None:
+            book = _books[bucket] = OrderBook(bucket)
+    return book
+
+
+def reset_books():
+    """Forget every in-memory book; the next pass rebuilds from the database"""
+    with _books_lock:
+        _books.clear()
+
+
+def list_investment(investment, seller, price):
+    """
+    List the whole of ``investment`` for ``price``, marking it for sale, and
+    match it against the bids. Fills update the investment's row, so reload
+    ``investment`` before saving it again.
+    """
+    if not investment.amount:
+        raise OrderError('This investment has nothing left to sell.')
+    with transaction.atomic():
+        # Marked before matching so an immediate fill is never overwritten
+        Investment.objects.filter(pk=investment.pk).update(is_for_sale=True, status='available')
+        sale = InvestmentSale.objects.create(
+            investment=investment,
+            seller=seller,
+            price=price,
+            remaining_amount=investment.amount,
+            unit_price=(price / investment.amount).quantize(UNIT_PRICE),
+            maturity_bucket=bucket_for(investment.maturation_date)
+        )
+    match_bucket(sale.maturity_bucket)
+    return sale
+
+
+def place_buy_order(investor, amount, limit_price, maturation_date):
+    """
+    Place a bid for ``amount`` of face value at up to ``limit_price`` per
+    unit, holding the full cost on the buyer's ledger, and match it.
+    """
+    if not amount.is_finite() or amount <= 0 or not limit_price.is_finite() or limit_price <= 0:
+        raise OrderError('Amount and price must be greater than 0.')
+    limit_price = limit_price.quantize(UNIT_PRICE)
+    hold = (amount * limit_price).quantize(CENT)
+
+    with transaction.atomic():
+        # Serialise holds per buyer so parallel orders cannot overspend
+        Investor.objects.select_for_update().get(pk=investor.pk)
+        if ledger.balance(investor) < hold:
+            raise OrderError('You do not have enough balance for this order.')
+        order = BuyOrder.objects.create(
+            investor=investor,
+            amount=amount,
+            remaining_amount=amount,
+            limit_price=limit_price,
+            maturity_bucket=bucket_for(maturation_date),
+            held_amount=hold
+        )
+        ledger.post_entry(investor, -hold, 'order_hold', reference=f'buy-order:{order.pk}')
+
+    match_bucket(order.maturity_bucket)
+    order.refresh_from_db()
+    return order
+
+
+def cancel_buy_order(order_id, investor):
+    """Cancel an open bid and release what is still held for it"""
+    with transaction.atomic():
+        order = BuyOrder.objects.select_for_update().filter(pk=order_id, investor=investor, status='open').first()
+        if order is None:
+            raise OrderError('This order is no longer open.')
+        if order.held_amount:
+            ledger.post_entry(investor, order.held_amount, 'order_release', reference=f'buy-order:{order.pk}')
+        order.status = 'cancelled'
+        order.held_amount = 0
+        order.save(update_fields=['status', 'held_amount'])
+    return order
+
+
+def match_bucket(bucket):
+    """
+    Cross the best bid with the best ask of ``bucket`` until they no longer
+    overlap. Each fill is its own transaction; returns the trades made.
+    """
+    book = get_book(bucket)
+    with book.lock:
+        book.sync()
+        return cross(book)
+
+
+def cross(book):
+    """Fill crossing orders of ``book``; the caller holds the book's lock"""
+    trades = []
+    while True:
+        best_bid, best_ask = book.bids.best(), book.asks.best()
+        if best_bid is None or best_ask is None or best_bid[1] < best_ask[1]:
+            return trades
+
+        with transaction.atomic():
+            # Always lock the bid before the ask so concurrent passes cannot deadlock
+            order = (
+                BuyOrder.objects.select_for_update(of=('self',)).select_related('investor')
+                .filter(pk=best_bid[0], status='open').first()
+            )
+            if order is None:
+                book.bids.remove(best_bid[0])
+                continue
+            sale = (
+                InvestmentSale.objects.select_for_update(of=('self',)).select_related('investment')
+                .filter(pk=best_ask[0], status='pending').first()
+            )
+            if sale is None:
+                book.asks.remove(best_ask[0])
+                continue
+            if sale.investment.investor_id == order.investor_id:
+                # Self-trade prevention: the newer of the two is cancelled
+                if order.created_at >= sale.created_at:
+                    cancel_buy_order(order.pk, order.investor)
+                    book.bids.remove(order.pk)
+                else:
+                    sale.status = 'cancelled'
+                    sale.save(update_fields=['status'])
+                    Investment.objects.filter(pk=sale.investment_id).update(is_for_sale=False, status='matched')
+                    book.asks.remove(sale.pk)
+                continue
+            trade = fill(order, sale)
+
+        if trade is not None:
+            trades.append(trade)
+        if order.status != 'open':
+            book.bids.remove(order.pk)
+        if sale.status != 'pending':
+            book.asks.remove(sale.pk)
+
+
+def fill(order, sale):
+    """
+    Trade as much as both locked rows allow at the resting order's price.
+    Returns the trade, or None when the listing turned out to be empty.
+    """
+    investment = Investment.objects.select_for_update(of=('self',)).select_related('investor').get(pk=sale.investment_id)
+    amount = min(order.remaining_amount, sale.remaining_amount, investment.amount)
+    if amount <= 0:
+        sale.status = 'completed'
+        sale.save(update_fields=['status'])
+        return None
+
+    unit_price = sale.unit_price if sale.created_at <= order.created_at else order.limit_price
+    cost = (amount * unit_price).quantize(CENT)
+
+    order.remaining_amount -= amount
+    if order.remaining_amount == 0:
+        release = order.held_amount - cost
+        order.held_amount = 0
+        order.status = 'filled'
+    else:
+        held_for_fill = (amount * order.limit_price).quantize(CENT)
+        release = held_for_fill - cost
+        order.held_amount -= held_for_fill
+    order.save(update_fields=['remaining_amount', 'held_amount', 'status'])
+
+    investment.amount -= amount
+    if investment.amount == 0:
+        investment.status = 'sold'
+        investment.is_for_sale = False
+    investment.save(update_fields=['amount', 'status', 'is_for_sale'])
+
+    sale.remaining_amount -= amount
+    if sale.remaining_amount == 0 or investment.amount == 0:
+        sale.status = 'completed'
+    sale.save(update_fields=['remaining_amount', 'status'])
+
+    bought = Investment.objects.create(
+        investor_id=order.investor_id,
+        amount=amount,
+        maturation_date=investment.maturation_date,
+        status='matched'
+    )
+    reference = f'sale:{sale.pk}'
+    ledger.post_entry(investment.investor, cost, 'sale', reference=reference)
+    if release:
+        ledger.post_entry(order.investor, release, 'order_release', reference=f'buy-order:{order.pk}')
+    return Trade.objects.create(buy_order=order, sale=sale, investment=bought, amount=amount, unit_price=unit_price)
@@ -0,0 +1,106 @@
+"""
+Per-view SQL query budgets.
+
+``query_budget(n)`` declares the most queries a view may run, however many
+rows it shows. A view over budget raises ``QueryBudgetExceeded`` when
+``QUERY_BUDGET_RAISE`` is set (it defaults to DEBUG; the budget tests
+turn it on) and logs a warning otherwise. Either way the report lists the
+SQL shapes that ran repeatedly, which is what an N+1 looks like.
+"""
+import logging
+import re
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# A shape repeated this many times in one request is reported as a likely N+1
+REPEAT_THRESHOLD = 3
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def sql_shape(sql):
+    """Reduce a statement to its shape: literals and IN lists collapsed"""
+    sql = re.sub(r'\((?:%s, )+%s\)', '(%s, ...)', sql)
+    sql = re.sub(r"'[^']*'", "'?'", sql)
+    return re.sub(r'\b\d+\b', 'N', sql)
+
+
+class QueryRecorder:
+    """Counts statements per shape through a connection execute wrapper"""
+
+    def __init__(self):
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.shapes[sql_shape(sql)] += 1
+        return execute(sql, params, many, context)
+
+    @property
+    def count(self):
+        return sum(self.shapes.values())
+
+    def repeated(self):
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= REPEAT_THRESHOLD]
+
+
+@asynccontextmanager
+async def async_execute_wrapper(wrapper):
+    """
+    ``connection.execute_wrapper`` for async code. Connections belong to a
+    thread and the async ORM runs a request's queries on that request's
+    sync worker thread, so the wrapper is installed on that thread's
+    connection rather than the event loop's.
+    """
+    await sync_to_async(lambda: connection.execute_wrappers.append(wrapper))()
+    try:
+        yield
+    finally:
+        await sync_to_async(lambda: connection.execute_wrappers.remove(wrapper))()
+
+
+def budget_report(name, budget, recorder):
+    lines = [f'{name} ran {recorder.count} queries, over its budget of {budget}']
+    for shape, count in recorder.repeated():
+        lines.append(f'  {count}x {shape}')
+    return '\n'.join(lines)
+
+
+def check_budget(view, max_queries, recorder):
+    if recorder.count > max_queries:
+        report = budget_report(view.__name__, max_queries, recorder)
+        if settings.QUERY_BUDGET_RAISE:
+            raise QueryBudgetExceeded(report)
+        logger.warning(report)
+
+
+def query_budget(max_queries):
+    """Enforce a maximum query count on a sync or async view; apply it outermost"""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                recorder = QueryRecorder()
+                async with async_execute_wrapper(recorder):
+                    response = await view(request, *args, **kwargs)
+                check_budget(view, max_queries, recorder)
+                return response
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                recorder = QueryRecorder()
+                with connection.execute_wrapper(recorder):
+                    response = view(request, *args, **kwargs)
+                check_budget(view, max_queries, recorder)
+                return response
+
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
@@ -0,0 +1,83 @@
+import random
+import string
+from django.db import transaction
+from django.db.models import Count, Sum
+from .models import Investor, Investment, Referral, ReferralPath
+
+
+def new_referral_code():
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+
+
+def link_referral(investor, referrer):
+    """
+    Attach ``investor`` and everyone they referred below ``referrer`` in the
+    referral tree. Returns False if the link would create a cycle or the
+    investor already has a referrer.
+    """
+    with transaction.atomic():
+        investor = Investor.objects.select_for_update().get(pk=investor.pk)
+        if investor.referred_by_id is not None or investor.pk == referrer.pk:
+            return False
+        if ReferralPath.objects.filter(ancestor=investor, descendant=referrer).exists():
+            return False
+
+        investor.referred_by = referrer
+        investor.save(update_fields=['referred_by'])
+
+        # Every ancestor of the referrer (and the referrer itself) becomes an
+        # ancestor of the investor's whole subtree (and the investor itself)
+        ancestors = [(referrer.pk, 0)] + list(
+            ReferralPath.objects.filter(descendant=referrer).values_list('ancestor_id', 'depth')
+        )
+        subtree = [(investor.pk, 0)] + list(
+            ReferralPath.objects.filter(ancestor=investor).values_list('descendant_id', 'depth')
+        )
+        ReferralPath.objects.bulk_create([
+            ReferralPath(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=up + down + 1)
+            for ancestor_id, up in ancestors
+            for descendant_id, down in subtree
+        ], batch_size=1000)
+    return True
+
+
+def apply_referral(investor, referrer):
+    """
+    Place ``investor`` under ``referrer`` in the referral tree and record
+    the referral with a code of its own, both or neither. Returns the new
+    Referral, or None if link_referral refused the link.
+    """
+    with transaction.atomic():
+        if not link_referral(investor, referrer):
+            return None
+        return Referral.objects.create(
+            referrer=referrer.user, referred_user=investor.user, code=new_referral_code()
+        )
+
+
+def downline(investor, max_depth=None):
+    """All investors referred by ``investor`` directly or indirectly, up to ``max_depth`` levels"""
+    if max_depth is None:
+        return Investor.objects.filter(referral_ancestors__ancestor=investor)
+    return Investor.objects.filter(
+        referral_ancestors__ancestor=investor, referral_ancestors__depth__lte=max_depth
+    )
+
+
+def downline_stats(investor, max_depth=None):
+    """Downline size and total investment per level, each in a single indexed query"""
+    paths = ReferralPath.objects.filter(ancestor=investor)
+    investments = Investment.objects.filter(investor__referral_ancestors__ancestor=investor)
+    if max_depth is not None:
+        paths = paths.filter(depth__lte=max_depth)
+        investments = Investment.objects.filter(
+            investor__referral_ancestors__ancestor=investor,
+            investor__referral_ancestors__depth__lte=max_depth
+        )
+    levels = {
+        row['depth']: {'depth': row['depth'], 'investors': row['investors'], 'investment': 0}
+        for row in paths.values('depth').annotate(investors=Count('id')).order_by('depth')
+    }
+    for row in investments.values('investor__referral_ancestors__depth').annotate(total=Sum('amount')).order_by():
+        levels[row['investor__referral_ancestors__depth']]['investment'] = row['total']
+    return list(levels.values())
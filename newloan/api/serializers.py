@@ -0,0 +1,32 @@
+from rest_framework import serializers
+from .models import Investment, InvestmentSale
+
+
+class ListingFilterSerializer(serializers.Serializer):
+    """Query parameters shared by the market listings"""
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=4, required=False)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=4, required=False)
+    min_amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    max_amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    matures_after = serializers.DateTimeField(required=False)
+    matures_before = serializers.DateTimeField(required=False)
+
+
+class ShareListingSerializer(serializers.ModelSerializer):
+    seller = serializers.CharField(source='investor.user.username', read_only=True)
+
+    class Meta:
+        model = Investment
+        fields = ['id', 'seller', 'amount', 'maturation_date', 'projected_interest', 'end_return', 'created_at']
+
+
+class SaleListingSerializer(serializers.ModelSerializer):
+    seller = serializers.CharField(source='seller.username', read_only=True)
+    maturation_date = serializers.DateTimeField(source='investment.maturation_date', read_only=True)
+
+    class Meta:
+        model = InvestmentSale
+        fields = [
+            'id', 'investment', 'seller', 'price', 'unit_price', 'remaining_amount', 'maturation_date',
+            'maturity_bucket', 'created_at'
+        ]
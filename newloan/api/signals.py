@@ -1,52 +1,77 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete
 from django.dispatch import receiver
-from django.utils import timezone
-from decimal import Decimal
-from .models import Investment, Investor, Pairing
+from .models import Investor, Investment, InvestmentSale, Pairing, PortfolioSummary
+from .caching import invalidate_investor_pages
+from .matching import enqueue
+from .summaries import investment_changes, pairing_change, refresh_summaries, source_state
+from .tasks import schedule_matching
 
 @receiver(post_save, sender=Investment)
-def check_maturation(sender, instance, created, **kwargs):
-    if not created and instance.maturation_date <= timezone.now() and not instance.is_matured:
-        # Mark the investment as matured
-        instance.is_matured = True
-        instance.save()
-
-        # Check for waiting investors with remaining amounts
-        waiting_investors = Investor.objects.filter(is_waiting=True).order_by('created_at')
-        
-        for waiting_investor in waiting_investors:
-            # Get the waiting investor's unpaired investment
-            new_investment = Investment.objects.filter(
-                investor=waiting_investor,
-                remaining_amount__gt=0
-            ).first()
-
-            if new_investment and instance.remaining_amount > 0:
-                # Determine the amount to pair
-                amount_to_pair = min(new_investment.remaining_amount, instance.remaining_amount)
-
-                # Create the pairing
-                Pairing.objects.create(
-                    investor=waiting_investor,
-                    paired_investment=instance,
-                    paired_amount=amount_to_pair
-                )
-
-                # Update remaining amounts
-                new_investment.remaining_amount -= amount_to_pair
-                instance.remaining_amount -= amount_to_pair
-
-                # Save the changes
-                new_investment.save()
-                instance.save()
-
-                # If the new investment is fully paired, remove waiting status
-                if new_investment.remaining_amount == 0:
-                    waiting_investor.is_waiting = False
-                    waiting_investor.save()
-
-                # If the matured investment is fully paired, mark it as paired
-                if instance.remaining_amount == 0:
-                    instance.paired = True
-                    instance.save()
-                    break  # Exit the loop as this matured investment is fully paired 
\ No newline at end of file
+def queue_new_investment(sender, instance, created, **kwargs):
+    # A new investment adds supply or demand, so match just that investment;
+    # demand waits in the queue until it is paired or cancelled
+    if created:
+        if not instance.is_matured and instance.remaining_amount > 0:
+            enqueue(instance)
+        schedule_matching(instance.pk)
+
+@receiver(post_init, sender=Investment)
+def remember_investment_state(sender, instance, **kwargs):
+    # Saves compare against this to work out their summary deltas
+    instance._summary_state = source_state(instance)
+
+@receiver(post_save, sender=Investment)
+def update_investment_summary(sender, instance, created, **kwargs):
+    investment_changes([instance], created=created)
+
+@receiver(post_delete, sender=Investment)
+def update_deleted_investment_summary(sender, instance, **kwargs):
+    investment_changes([instance], deleted=True)
+
+@receiver(post_init, sender=Pairing)
+def remember_pairing_confirmed(sender, instance, **kwargs):
+    instance._was_confirmed = instance.__dict__.get('confirmed')
+
+@receiver(post_save, sender=Pairing)
+def update_pairing_summaries(sender, instance, created, **kwargs):
+    # Confirming a pairing adds the investments linked to it to the totals
+    if not created and instance.confirmed != instance._was_confirmed:
+        if instance._was_confirmed is None:
+            refresh_summaries(Investment.objects.filter(pairing=instance).values_list('investor_id', flat=True))
+        else:
+            pairing_change(instance, 1 if instance.confirmed else -1)
+    instance._was_confirmed = instance.confirmed
+
+@receiver(pre_delete, sender=Pairing)
+def update_deleted_pairing_summaries(sender, instance, **kwargs):
+    # Its investments are unlinked by SET_NULL, which sends no signals
+    if instance._was_confirmed:
+        pairing_change(instance, -1)
+
+@receiver(post_save, sender=Investor)
+def create_investor_summary(sender, instance, created, **kwargs):
+    # A new investor's totals are all zero, and deltas keep them current from here
+    if created:
+        PortfolioSummary.objects.get_or_create(investor=instance)
+
+@receiver(post_save, sender=Investor)
+def invalidate_investor(sender, instance, **kwargs):
+    invalidate_investor_pages([instance.pk])
+
+@receiver(post_save, sender=Investment)
+@receiver(post_delete, sender=Investment)
+def invalidate_investment(sender, instance, **kwargs):
+    # Investors paired against this investment display it on their pages too
+    counterparties = Pairing.objects.filter(paired_investment_id=instance.pk).values_list('investor_id', flat=True)
+    invalidate_investor_pages([instance.investor_id, *counterparties])
+
+@receiver(post_save, sender=Pairing)
+@receiver(post_delete, sender=Pairing)
+def invalidate_pairing(sender, instance, **kwargs):
+    owner = Investment.objects.filter(pk=instance.paired_investment_id).values_list('investor_id', flat=True)
+    invalidate_investor_pages([instance.investor_id, *owner])
+
+@receiver(post_save, sender=InvestmentSale)
+@receiver(post_delete, sender=InvestmentSale)
+def invalidate_sale(sender, instance, **kwargs):
+    invalidate_investor_pages(Investor.objects.filter(user_id=instance.seller_id).values_list('pk', flat=True))
@@ -0,0 +1,191 @@
+"""
+Per-investor portfolio summaries behind the dashboard totals.
+
+Only investments paired through a confirmed pairing count. Writes keep the
+stored rows current by applying F() deltas for the rows they change:
+``investment_changes`` compares investments with the state they were
+loaded in, ``pairing_change`` adds or removes a pairing's investments when
+it is confirmed or deleted, and the maturation sweep hands its own deltas
+to ``apply_deltas``. A summary is only computed in full when it is read
+for the first time; the rebuild_summaries command recomputes and checks
+them all as a repair or backfill.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+from .models import Investor, Investment, Pairing, PortfolioSummary
+
+SUMMARY_FIELDS = [
+    'total_invested', 'total_paired', 'total_returns', 'total_interest',
+    'projected_returns', 'waiting_returns', 'active_investments',
+]
+# Investment fields a summary is computed from
+SOURCE_FIELDS = ('pairing_id', 'amount', 'remaining_amount', 'end_return', 'projected_interest', 'is_matured')
+# Summaries updated per UPDATE statement
+BATCH_SIZE = 500
+
+
+def aggregate(investments):
+    """Summary totals of ``investments``, grouped by investor"""
+    rows = investments.values('investor_id').order_by().annotate(
+        total_invested=Sum('amount'),
+        total_paired=Sum(F('amount') - F('remaining_amount')),
+        total_returns=Sum('end_return'),
+        total_interest=Sum('projected_interest'),
+        projected_returns=Sum('end_return', filter=Q(is_matured=False)),
+        waiting_returns=Sum('end_return', filter=Q(remaining_amount__gt=0)),
+        active_investments=Count('id')
+    )
+    return {
+        row.pop('investor_id'): {
+            field: row[field] if row[field] is not None else Decimal('0.00')
+            for field in SUMMARY_FIELDS
+        }
+        for row in rows
+    }
+
+
+def live_summaries(investor_ids=None):
+    """
+    Compute dashboard totals from the investments table, grouped by investor.
+    Only investments paired through a confirmed pairing are counted.
+    Returns a dict of investor id to field values.
+    """
+    investments = Investment.objects.filter(pairing__confirmed=True)
+    if investor_ids is not None:
+        investments = investments.filter(investor_id__in=investor_ids)
+    return aggregate(investments)
+
+
+def empty_summary():
+    values = {field: Decimal('0.00') for field in SUMMARY_FIELDS}
+    values['active_investments'] = 0
+    return values
+
+
+def refresh_summaries(investor_ids):
+    """
+    Recompute the stored summaries of the given investors with one grouped
+    aggregate and one upsert. Writes apply deltas instead; this builds
+    missing summaries and repairs stale ones.
+    """
+    investor_ids = set(Investor.objects.filter(pk__in=set(investor_ids)).values_list('pk', flat=True))
+    if not investor_ids:
+        return []
+    live = live_summaries(investor_ids)
+    summaries = [
+        PortfolioSummary(investor_id=investor_id, **live.get(investor_id, empty_summary()))
+        for investor_id in investor_ids
+    ]
+    return PortfolioSummary.objects.bulk_create(
+        summaries,
+        update_conflicts=True,
+        unique_fields=['investor'],
+        update_fields=SUMMARY_FIELDS + ['updated_at']
+    )
+
+
+def get_summary(investor):
+    """Return the investor's stored summary, building it on first use"""
+    summary = PortfolioSummary.objects.filter(pk=investor.pk).first()
+    if summary is None:
+        summary = refresh_summaries([investor.pk])[0]
+    return summary
+
+
+def source_state(investment):
+    """The summary inputs of an investment as loaded, or None if some were deferred"""
+    values = investment.__dict__
+    if any(field not in values for field in SOURCE_FIELDS):
+        return None
+    return tuple(values[field] for field in SOURCE_FIELDS)
+
+
+def contribution(state):
+    """What one investment in ``state`` adds to its investor's summary"""
+    _, amount, remaining_amount, end_return, projected_interest, is_matured = state
+    amount, remaining_amount, end_return, projected_interest = (
+        Decimal(str(value)) for value in (amount, remaining_amount, end_return, projected_interest)
+    )
+    return {
+        'total_invested': amount,
+        'total_paired': amount - remaining_amount,
+        'total_returns': end_return,
+        'total_interest': projected_interest,
+        'projected_returns': Decimal('0.00') if is_matured else end_return,
+        'waiting_returns': end_return if remaining_amount > 0 else Decimal('0.00'),
+        'active_investments': 1,
+    }
+
+
+def add_delta(deltas, investor_id, values, sign=1):
+    delta = deltas[investor_id]
+    for field in SUMMARY_FIELDS:
+        delta[field] = delta.get(field, 0) + sign * values[field]
+
+
+def apply_deltas(deltas):
+    """
+    Add ``{investor id: {field: change}}`` to the stored summaries with F()
+    updates, BATCH_SIZE investors per statement. Summaries not built yet
+    are skipped; they are computed in full when first read.
+    """
+    deltas = {investor_id: delta for investor_id, delta in deltas.items() if any(delta.values())}
+    investor_ids = list(deltas)
+    for start in range(0, len(investor_ids), BATCH_SIZE):
+        batch = investor_ids[start:start + BATCH_SIZE]
+        changes = {}
+        for field in SUMMARY_FIELDS:
+            output_field = IntegerField() if field == 'active_investments' else DecimalField(max_digits=14, decimal_places=2)
+            whens = [
+                When(pk=investor_id, then=Value(deltas[investor_id][field]))
+                for investor_id in batch if deltas[investor_id].get(field)
+            ]
+            if whens:
+                changes[field] = F(field) + Case(*whens, default=Value(0), output_field=output_field)
+        PortfolioSummary.objects.filter(pk__in=batch).update(updated_at=timezone.now(), **changes)
+
+
+def investment_changes(investments, created=False, deleted=False):
+    """
+    Apply the summary deltas of saved, created or deleted investments,
+    comparing each with the state it was loaded in. Investors of
+    investments loaded or saved with deferred fields are recomputed instead.
+    """
+    changes = []
+    recompute = set()
+    for investment in investments:
+        before = None if created else investment._summary_state
+        after = None if deleted else source_state(investment)
+        if (before is None and not created) or (after is None and not deleted):
+            recompute.add(investment.investor_id)
+        elif before != after:
+            changes.append((investment.investor_id, before, after))
+        investment._summary_state = after
+
+    pairing_ids = {state[0] for _, *states in changes for state in states if state is not None} - {None}
+    confirmed = set()
+    if pairing_ids:
+        confirmed = set(Pairing.objects.filter(pk__in=pairing_ids, confirmed=True).values_list('pk', flat=True))
+    deltas = defaultdict(dict)
+    for investor_id, before, after in changes:
+        for state, sign in ((before, -1), (after, 1)):
+            if state is not None and state[0] in confirmed:
+                add_delta(deltas, investor_id, contribution(state), sign)
+    apply_deltas(deltas)
+    if recompute:
+        if deleted:
+            # The investor may be deleted in the same cascade, so wait for the commit
+            transaction.on_commit(lambda: refresh_summaries(recompute))
+        else:
+            refresh_summaries(recompute)
+
+
+def pairing_change(pairing, sign):
+    """Add (sign 1) or remove (sign -1) the investments paired through ``pairing``"""
+    deltas = defaultdict(dict)
+    for investor_id, values in aggregate(Investment.objects.filter(pairing=pairing)).items():
+        add_delta(deltas, investor_id, values, sign)
+    apply_deltas(deltas)
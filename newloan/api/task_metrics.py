@@ -0,0 +1,195 @@
+"""
+Celery task metrics.
+
+Tasks run in worker child processes, so their metrics live in the shared
+cache instead of process memory: every worker adds to the same counters
+and the ``api:metrics`` endpoint of any web process serves the totals.
+Per run a task records its duration, the rows it examined and wrote and
+the pairings it created. The queue lag gauge is read from the database at
+scrape time, so it stays current even when no task is running.
+"""
+import threading
+import time
+from bisect import bisect_left
+from celery import current_app
+from celery.signals import task_postrun, task_prerun
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+from .metrics import LATENCY_BUCKETS, REGISTRY, format_labels
+from .models import WaitingQueueEntry
+
+TASK_BUCKETS = LATENCY_BUCKETS + (30.0, 60.0, 120.0, 300.0)
+TASK_STATES = ('SUCCESS', 'FAILURE', 'RETRY')
+MICROS = 1000000
+
+# Stats of the tasks running in each thread
+_current = threading.local()
+
+
+def task_names():
+    return sorted(name for name in current_app.tasks if name.startswith('api.'))
+
+
+def task_series():
+    return [(name,) for name in task_names()]
+
+
+def task_state_series():
+    return [(name, state) for name in task_names() for state in TASK_STATES]
+
+
+class CacheMetric:
+    def __init__(self, name, documentation, labels, series):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.series = series
+
+    def key(self, label_values, suffix=''):
+        return f"metrics:{self.name}{suffix}:{'|'.join(str(value) for value in label_values)}"
+
+    def add(self, key, amount):
+        cache.add(key, 0, None)
+        cache.incr(key, amount)
+
+
+class CacheCounter(CacheMetric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        if amount:
+            self.add(self.key(label_values), amount)
+
+    def samples(self):
+        series = self.series()
+        values = cache.get_many([self.key(label_values) for label_values in series])
+        for label_values in series:
+            value = values.get(self.key(label_values))
+            if value is not None:
+                yield self.name, format_labels(self.labels, label_values), value
+
+
+class CacheGauge(CacheCounter):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        cache.set(self.key(label_values), value, None)
+
+
+class CacheHistogram(CacheMetric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=TASK_BUCKETS):
+        super().__init__(*args)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.add(self.key(label_values, f'_bucket{index}'), 1)
+        self.add(self.key(label_values, '_count'), 1)
+        self.add(self.key(label_values, '_sum'), round(value * MICROS))
+
+    def samples(self):
+        series = self.series()
+        suffixes = [f'_bucket{index}' for index in range(len(self.buckets))] + ['_count', '_sum']
+        values = cache.get_many([self.key(labels, suffix) for labels in series for suffix in suffixes])
+        for label_values in series:
+            count = values.get(self.key(label_values, '_count'))
+            if count is None:
+                continue
+            cumulative = 0
+            for index, bound in enumerate(self.buckets):
+                cumulative += values.get(self.key(label_values, f'_bucket{index}'), 0)
+                yield (f'{self.name}_bucket', format_labels(self.labels + ('le',), label_values + (bound,)),
+                       cumulative)
+            yield f'{self.name}_bucket', format_labels(self.labels + ('le',), label_values + ('+Inf',)), count
+            yield (f'{self.name}_sum', format_labels(self.labels, label_values),
+                   values.get(self.key(label_values, '_sum'), 0) / MICROS)
+            yield f'{self.name}_count', format_labels(self.labels, label_values), count
+
+
+class QueueLag:
+    """Seconds since the oldest investment still in the waiting queue was enqueued"""
+    type = 'gauge'
+    name = 'newloan_matching_queue_lag_seconds'
+    documentation = 'Seconds the oldest unmatched investment has been waiting'
+
+    def samples(self):
+        oldest = WaitingQueueEntry.objects.aggregate(oldest=Min('enqueued_at'))['oldest']
+        lag = (timezone.now() - oldest).total_seconds() if oldest else 0
+        yield self.name, '', lag
+
+
+TASK_RUNS = REGISTRY.register(CacheCounter(
+    'newloan_task_runs_total', 'Celery task runs by final state', ('task', 'state'), task_state_series))
+TASK_DURATION = REGISTRY.register(CacheHistogram(
+    'newloan_task_duration_seconds', 'Celery task run time', ('task',), task_series))
+TASK_LAST_DURATION = REGISTRY.register(CacheGauge(
+    'newloan_task_last_duration_seconds', 'Run time of the latest run, to compare with the beat period',
+    ('task',), task_series))
+TASK_ROWS_EXAMINED = REGISTRY.register(CacheCounter(
+    'newloan_task_rows_examined_total', 'Rows read and considered by Celery tasks', ('task',), task_series))
+TASK_ROWS_WRITTEN = REGISTRY.register(CacheCounter(
+    'newloan_task_rows_written_total', 'Rows inserted, updated or deleted by Celery tasks', ('task',), task_series))
+TASK_PAIRINGS = REGISTRY.register(CacheCounter(
+    'newloan_task_pairings_created_total', 'Pairings created by Celery tasks', ('task',), task_series))
+REGISTRY.register(QueueLag())
+
+
+class TaskStats:
+    """Counters for the task running in this thread; also an execute wrapper counting rows written"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.examined = 0
+        self.written = 0
+        self.pairings = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        if not sql.lstrip().upper().startswith('SELECT'):
+            self.written += max(context['cursor'].rowcount, 0)
+        return result
+
+
+def running_tasks():
+    # A stack, since eager tasks can run inside another task
+    if not hasattr(_current, 'stack'):
+        _current.stack = []
+    return _current.stack
+
+
+def note(examined=0, pairings=0):
+    """Add to the running task's counters; a no-op outside a task"""
+    stack = running_tasks()
+    if stack:
+        stack[-1].examined += examined
+        stack[-1].pairings += pairings
+
+
+@task_prerun.connect
+def start_task_stats(task_id=None, task=None, **kwargs):
+    stats = TaskStats()
+    running_tasks().append(stats)
+    connection.execute_wrappers.append(stats)
+
+
+@task_postrun.connect
+def record_task_stats(task_id=None, task=None, state=None, **kwargs):
+    stack = running_tasks()
+    if not stack:
+        return
+    stats = stack.pop()
+    if stats in connection.execute_wrappers:
+        connection.execute_wrappers.remove(stats)
+
+    elapsed = time.perf_counter() - stats.start
+    TASK_RUNS.inc(task.name, state)
+    TASK_DURATION.observe(elapsed, task.name)
+    TASK_LAST_DURATION.set(elapsed, task.name)
+    TASK_ROWS_EXAMINED.inc(task.name, amount=stats.examined)
+    TASK_ROWS_WRITTEN.inc(task.name, amount=stats.written)
+    TASK_PAIRINGS.inc(task.name, amount=stats.pairings)
@@ -1,10 +1,61 @@
-from celery import shared_task
+import logging
+from celery import shared_task, group
 from django.utils import timezone
-from django.core.mail import send_mail
 from django.conf import settings
-from .models import Investor, Investment, Pairing, Referral, User
-from django.db.models import Q
+from .models import Investor, Investment, JobWatermark, Pairing, Referral, User
+from django.db.models import Case, DecimalField, F, Q, Sum, Value, When
+from decimal import Decimal
+from datetime import timedelta
 from django.db import transaction
+from .ledger import take_snapshots
+from .locks import run_exclusive
+from .notifications import send_pending
+from .task_metrics import note
+from .matching import (
+    BATCH_SIZE,
+    match_investments, match_for_investments, match_id_range, mature_due_investments, partition_ranges,
+    waiting_investments
+)
+
+logger = logging.getLogger(__name__)
+
+# Share of a referred user's matched investments credited to the referrer
+REFERRAL_EARNINGS_RATE = Decimal('0.05')
+REFERRAL_WATERMARK_LAG = timedelta(minutes=1)
+
+# Singleton lock shared by every matching task except the partitioned
+# fan-out, whose workers are built to run side by side
+MATCHING_LOCK = 'matching'
+
+# Pending item asking the follow-up pass to match the whole market
+FULL_PASS = '*'
+
+def full_match():
+    return len(match_investments())
+
+def match_batches(investment_ids):
+    """Match the given investments, BATCH_SIZE at a time"""
+    investment_ids = sorted(investment_ids)
+    return sum(
+        len(match_for_investments(investment_ids[start:start + BATCH_SIZE]))
+        for start in range(0, len(investment_ids), BATCH_SIZE)
+    )
+
+def match_pending(items):
+    return full_match() if FULL_PASS in items else match_batches(items)
+
+def run_matching(func, investment_ids=None):
+    """
+    Run a matching pass unless another one holds the matching lock.
+
+    A trigger that arrives while a pass is running is coalesced: it leaves
+    ``investment_ids`` (all of them if None) in the lock's pending set, and
+    the running pass makes one follow-up pass scoped to the union of those
+    ids. Returns the number of pairings created, 0 for a coalesced trigger.
+    """
+    pending = [FULL_PASS] if investment_ids is None else investment_ids
+    runs = run_exclusive(MATCHING_LOCK, func, follow_up=match_pending, pending=pending)
+    return sum(runs) if runs else 0
 
 @shared_task
 def match_waiting_investors():
@@ -12,110 +63,55 @@ def match_waiting_investors():
     Match matured investments with waiting investors.
     A matured investment can be paired with an immature investment from another user.
     """
-    # Get all matured investments that haven't been fully paired
-    matured_investments = Investment.objects.filter(
-        is_matured=True,
-        remaining_amount__gt=0
-    ).select_related('investor')
-
-    for matured_inv in matured_investments:
-        # Find immature investments from other users
-        immature_investments = Investment.objects.filter(
-            is_matured=False,
-            remaining_amount__gt=0
-        ).exclude(
-            investor=matured_inv.investor  # Exclude investments from the same user
-        ).select_related('investor')
-
-        for immature_inv in immature_investments:
-            # Calculate how much can be paired
-            pairing_amount = min(matured_inv.remaining_amount, immature_inv.remaining_amount)
-            
-            if pairing_amount > 0:
-                # Create the pairing
-                pairing = Pairing.objects.create(
-                    investor=immature_inv.investor,
-                    paired_investment=matured_inv,
-                    paired_amount=pairing_amount,
-                    paired_to=matured_inv.investor  # Set the paired_to field to the matured investment's investor
-                )
+    return run_matching(full_match)
 
-                # Update remaining amounts
-                matured_inv.remaining_amount -= pairing_amount
-                immature_inv.remaining_amount -= pairing_amount
-
-                # Update paired status if fully paired
-                if matured_inv.remaining_amount == 0:
-                    matured_inv.paired = True
-                if immature_inv.remaining_amount == 0:
-                    immature_inv.paired = True
-                    # Update investor's waiting status
-                    immature_inv.investor.is_waiting = False
-                    immature_inv.investor.waiting_since = None
-                    immature_inv.investor.waiting_investment_id = None
-                    immature_inv.investor.save()
-
-                # Save the changes
-                matured_inv.save()
-                immature_inv.save()
-
-                # If the matured investment is fully paired, break the loop
-                if matured_inv.remaining_amount == 0:
-                    break
-
-def notify_user_of_pairing(investor, paired_investment, amount):
-    subject = 'Investment Paired'
-    message = f'Dear {investor.user.username},\n\nYour investment has been paired with {paired_investment.investor.user.username} for an amount of ${amount}.\n\nBest regards,\nLoan Management System'
-    
-    try:
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [investor.user.email],
-            fail_silently=False,
-        )
-    except Exception as e:
-        print(f"Failed to send email to {investor.user.email}: {str(e)}")
+@shared_task
+def match_in_parallel(partitions=None):
+    """
+    Fan matching out over several workers, one id range of matured
+    investments each. Workers claim rows with SKIP LOCKED, so they never
+    block on or double-allocate each other's investments.
+    """
+    ranges = partition_ranges(partitions or settings.MATCHING_PARTITIONS)
+    group(match_partition.s(start_id, end_id) for start_id, end_id in ranges).apply_async()
+    return len(ranges)
+
+@shared_task
+def match_partition(start_id, end_id):
+    """Match one id range of matured investments"""
+    pairings = match_id_range(start_id, end_id)
+    return len(pairings)
+
+@shared_task
+def sweep_maturations():
+    """
+    Mark every investment past its maturation date as matured and match only
+    the newly matured ones. Runs on the beat schedule.
+    """
+    matured_ids = mature_due_investments()
+    return run_matching(lambda: match_batches(matured_ids), matured_ids)
+
+@shared_task
+def match_investment_event(investment_ids):
+    """
+    Match the investments affected by a single event (creation or a
+    confirmed payment) against the other side of the market.
+    """
+    return run_matching(lambda: len(match_for_investments(investment_ids)), investment_ids)
+
+def schedule_matching(*investment_ids):
+    """Queue an incremental matching run once the current transaction commits"""
+    ids = list(investment_ids)
+    transaction.on_commit(lambda: match_investment_event.delay(ids))
 
 @shared_task
 def process_investment_matching():
     """
     Process investment matching for waiting investors.
-    This task runs every minute to match waiting investors with available investments.
+    Runs the matching engine against the waiting queue, head first.
     """
     try:
-        with transaction.atomic():
-            # Get all waiting investors
-            waiting_investors = User.objects.filter(
-                investorprofile__status='waiting',
-                investorprofile__is_active=True
-            ).select_related('investorprofile')
-
-            for investor in waiting_investors:
-                # Get available investments that match the investor's criteria
-                available_investments = Investment.objects.filter(
-                    status='available',
-                    amount__lte=investor.investorprofile.available_balance
-                ).order_by('created_at')
-
-                for investment in available_investments:
-                    # Match the investment with the investor
-                    investment.investor = investor
-                    investment.status = 'matched'
-                    investment.matched_at = timezone.now()
-                    investment.save()
-
-                    # Update investor profile
-                    profile = investor.investorprofile
-                    profile.available_balance -= investment.amount
-                    profile.total_invested += investment.amount
-                    profile.status = 'invested'
-                    profile.save()
-
-                    # Break if investor's balance is depleted
-                    if profile.available_balance <= 0:
-                        break
+        return run_matching(lambda: len(match_investments(immature=waiting_investments())))
 
     except Exception as e:
         print(f"Error in process_investment_matching: {str(e)}")
@@ -124,33 +120,76 @@ def process_investment_matching():
 @shared_task
 def process_referral_earnings():
     """
-    Process referral earnings for all active referrals.
-    This task runs every 5 minutes to calculate and update referral earnings.
+    Process referral earnings for investments matched since the last run.
+    This task runs every 5 minutes. New matched amounts are summed per referral
+    in one grouped query and added with a single conditional F() update.
     """
     try:
         with transaction.atomic():
-            # Get all active referrals
-            active_referrals = Referral.objects.filter(
-                is_active=True
-            ).select_related('referrer', 'referred_user')
-
-            for referral in active_referrals:
-                # Get all investments made by the referred user
-                investments = Investment.objects.filter(
-                    investor=referral.referred_user,
-                    status='matched',
-                    created_at__gte=referral.created_at
+            watermark, _ = JobWatermark.objects.select_for_update().get_or_create(name='referral_earnings')
+            # Lag behind the clock so investments matched in still-open
+            # transactions are picked up by the next run instead of skipped
+            processed_until = timezone.now() - REFERRAL_WATERMARK_LAG
+
+            investments = Investment.objects.filter(
+                status='matched',
+                matched_at__lte=processed_until,
+                investor__user__referral_received__is_active=True,
+                created_at__gte=F('investor__user__referral_received__created_at')
+            )
+            if watermark.processed_until:
+                investments = investments.filter(matched_at__gt=watermark.processed_until)
+
+            deltas = list(
+                investments.order_by()
+                .values_list('investor__user__referral_received')
+                .annotate(amount=Sum('amount'))
+            )
+            note(examined=len(deltas))
+
+            for start in range(0, len(deltas), BATCH_SIZE):
+                batch = dict(deltas[start:start + BATCH_SIZE])
+                new_investment = Case(
+                    *[When(pk=referral_id, then=Value(amount)) for referral_id, amount in batch.items()],
+                    output_field=DecimalField(max_digits=10, decimal_places=2)
+                )
+                Referral.objects.filter(pk__in=batch).update(
+                    total_investment_amount=F('total_investment_amount') + new_investment,
+                    total_earnings=F('total_earnings') + new_investment * REFERRAL_EARNINGS_RATE
                 )
 
-                # Calculate total investment amount
-                total_investment = sum(investment.amount for investment in investments)
-                
-                # Update referral with new investment amount and earnings
-                if total_investment > referral.total_investment_amount:
-                    new_investment = total_investment - referral.total_investment_amount
-                    referral.add_investment(new_investment)
-                    referral.save()
+            watermark.processed_until = processed_until
+            watermark.save()
+            return len(deltas)
 
     except Exception as e:
         print(f"Error in process_referral_earnings: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
+
+@shared_task
+def snapshot_balances():
+    """
+    Fold new balance ledger entries into the per-investor snapshots.
+    Runs on the beat schedule so balance reads only sum a short tail.
+    """
+    try:
+        return take_snapshots()
+
+    except Exception:
+        logger.exception('Error in snapshot_balances')
+        raise
+
+@shared_task
+def send_notifications():
+    """
+    Drain the notification outbox in batches over one mail connection.
+    Runs on the beat schedule; overlapping runs coalesce under a singleton
+    lock so a message is never picked up by two workers at once.
+    """
+    try:
+        runs = run_exclusive('notifications', send_pending) or []
+        return sum(run['sent'] for run in runs)
+
+    except Exception:
+        logger.exception('Error in send_notifications')
+        raise
@@ -1,10 +1,47 @@
-from django.test import TestCase
+import gc
+import re
+import warnings
+from unittest import mock
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 from decimal import Decimal
-from .models import Investor, Investment, Pairing
-from .tasks import match_waiting_investors
+from .models import (
+    BalanceEntry, BalanceSnapshot, BuyOrder, Investor, Investment, InvestmentSale, JobWatermark, Pairing,
+    Notification, PortfolioSummary, Referral, ReferralPath, Trade, WaitingQueueEntry
+)
+from .referrals import downline, downline_stats, link_referral
+from . import ledger
+from .summaries import get_summary
+from .caching import page_version
+from django.core.cache import cache
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from .tasks import (
+    match_waiting_investors, match_investment_event, process_investment_matching, sweep_maturations,
+    process_referral_earnings, run_matching, send_notifications
+)
+from .matching import (
+    match_investments, match_id_range, mature_due_investments, partition_ranges, enqueue, cancel, waiting_investments
+)
+from django.db.models import Sum
+from .benchmarks import run_purchase_stress, run_serving_comparison, run_suite
+from .querybudget import QueryBudgetExceeded, query_budget
+from . import exports, imports, market, metrics, notifications, orderbook
+from django.core import mail
+from .locks import CacheLock, run_exclusive
+from . import admin as api_admin
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.urls import resolve
 
 class PairingTests(TestCase):
     def setUp(self):
@@ -121,3 +158,1474 @@ class PairingTests(TestCase):
         ).first()
         self.assertIsNotNone(different_user_pairing,
                             "Pairing should be created for investments from different users")
+
+class MatchingEngineTests(TestCase):
+    def setUp(self):
+        self.investors = [
+            Investor.objects.create(user=User.objects.create_user(username=f'investor{i}', password='testpass123'))
+            for i in range(3)
+        ]
+
+    def create_investment(self, investor, amount, matured):
+        days = -1 if matured else 30
+        return Investment.objects.create(
+            investor=investor,
+            amount=Decimal(amount),
+            remaining_amount=Decimal(amount),
+            maturation_date=timezone.now() + timedelta(days=days),
+            is_matured=matured
+        )
+
+    def test_fifo_order(self):
+        matured = self.create_investment(self.investors[0], '500.00', matured=True)
+        first = self.create_investment(self.investors[1], '400.00', matured=False)
+        second = self.create_investment(self.investors[2], '400.00', matured=False)
+
+        pairings = match_investments()
+
+        self.assertEqual([p.paired_amount for p in pairings], [Decimal('400.00'), Decimal('100.00')])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        matured.refresh_from_db()
+        self.assertTrue(first.paired)
+        self.assertEqual(second.remaining_amount, Decimal('300.00'))
+        self.assertTrue(matured.paired)
+
+    def test_query_count_does_not_grow_with_market_size(self):
+        def count_queries(size):
+            Investment.objects.all().delete()
+            for _ in range(size):
+                self.create_investment(self.investors[0], '100.00', matured=True)
+                self.create_investment(self.investors[1], '100.00', matured=False)
+            with CaptureQueriesContext(connection) as ctx:
+                pairings = match_investments()
+            self.assertEqual(len(pairings), size)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(count_queries(2), count_queries(20))
+
+    def test_partitions_pair_every_investment_once(self):
+        for _ in range(5):
+            self.create_investment(self.investors[0], '100.00', matured=True)
+        for _ in range(3):
+            self.create_investment(self.investors[1], '150.00', matured=False)
+
+        ranges = partition_ranges(3)
+        for start_id, end_id in ranges:
+            match_id_range(start_id, end_id, claim_batch=2)
+
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(Pairing.objects.aggregate(total=Sum('paired_amount'))['total'], Decimal('450.00'))
+        self.assertFalse(Investment.objects.filter(remaining_amount__lt=0).exists())
+        self.assertEqual(Investment.objects.filter(is_matured=True, remaining_amount__gt=0).count(), 1)
+
+    def test_range_continues_past_a_batch_that_pairs_nothing(self):
+        # The first claimed batch of demand all belongs to the first batch's seller
+        own_demand = [self.create_investment(self.investors[0], '100.00', matured=False) for _ in range(2)]
+        for _ in range(2):
+            self.create_investment(self.investors[0], '100.00', matured=True)
+        other_supply = self.create_investment(self.investors[1], '100.00', matured=True)
+
+        pairings = match_id_range(0, other_supply.id + 1, claim_batch=2)
+
+        self.assertEqual([(p.investor, p.paired_investment) for p in pairings], [(self.investors[0], other_supply)])
+        own_demand[0].refresh_from_db()
+        self.assertTrue(own_demand[0].paired)
+
+    def test_event_matching_touches_only_affected_investments(self):
+        self.create_investment(self.investors[0], '1000.00', matured=True)
+        first = self.create_investment(self.investors[1], '300.00', matured=False)
+        second = self.create_investment(self.investors[2], '300.00', matured=False)
+
+        match_investment_event([second.id])
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.remaining_amount, Decimal('300.00'))
+        self.assertTrue(second.paired)
+
+    def test_new_investment_schedules_matching_on_commit(self):
+        with mock.patch('api.tasks.match_investment_event.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                investment = self.create_investment(self.investors[1], '300.00', matured=False)
+        delay.assert_called_once_with([investment.pk])
+
+class WaitingQueueTests(TestCase):
+    def setUp(self):
+        self.investors = [
+            Investor.objects.create(user=User.objects.create_user(username=f'waiting{i}', password='testpass123'))
+            for i in range(3)
+        ]
+        self.investments = [
+            Investment.objects.create(
+                investor=investor,
+                amount=Decimal('100.00'),
+                remaining_amount=Decimal('100.00'),
+                maturation_date=timezone.now() + timedelta(days=30)
+            )
+            for investor in self.investors
+        ]
+        # New demand joins the queue when created; start from an empty one
+        for investment in self.investments:
+            cancel(investment)
+
+    def test_new_demand_is_queued_and_matched_from_the_queue_head(self):
+        enqueue(self.investments[2], priority=-1)
+        Investment.objects.create(
+            investor=Investor.objects.create(user=User.objects.create_user(username='supplier', password='x')),
+            amount=Decimal('100.00'),
+            remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1),
+            is_matured=True
+        )
+        late = Investment.objects.create(
+            investor=self.investors[0], amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+        self.assertTrue(WaitingQueueEntry.objects.filter(investment=late).exists())
+
+        pairings = match_investments()
+        # Only queued demand is paired, and the prioritised entry goes first
+        self.assertEqual([pairing.investor_id for pairing in pairings], [self.investors[2].pk])
+        self.assertEqual(set(waiting_investments()), {late})
+
+    def test_head_follows_priority_then_enqueue_time(self):
+        enqueue(self.investments[0])
+        enqueue(self.investments[1])
+        enqueue(self.investments[2], priority=-1)
+
+        with self.assertNumQueries(1):
+            head = list(waiting_investments()[:3])
+        self.assertEqual(head, [self.investments[2], self.investments[0], self.investments[1]])
+
+    def test_cancel_clears_waiting_flags(self):
+        enqueue(self.investments[0])
+        self.investors[0].refresh_from_db()
+        self.assertTrue(self.investors[0].is_waiting)
+
+        self.assertTrue(cancel(self.investments[0]))
+        self.assertFalse(cancel(self.investments[0]))
+        self.investors[0].refresh_from_db()
+        self.assertFalse(self.investors[0].is_waiting)
+        self.assertFalse(WaitingQueueEntry.objects.exists())
+
+    def test_cancelled_investment_is_not_paired(self):
+        enqueue(self.investments[0])
+        enqueue(self.investments[1])
+        self.assertTrue(cancel(self.investments[0]))
+        supply = Investment.objects.create(
+            investor=Investor.objects.create(user=User.objects.create_user(username='supplier', password='x')),
+            amount=Decimal('300.00'),
+            remaining_amount=Decimal('300.00'),
+            maturation_date=timezone.now() - timedelta(days=1)
+        )
+
+        sweep_maturations()
+        match_investment_event([self.investments[0].pk, supply.pk])
+
+        self.assertEqual(list(Pairing.objects.values_list('investor_id', flat=True)), [self.investors[1].pk])
+        self.investments[0].refresh_from_db()
+        self.assertEqual(self.investments[0].remaining_amount, Decimal('100.00'))
+        # The supply was queued as demand when created and left the queue on maturing
+        self.assertFalse(WaitingQueueEntry.objects.filter(investment=supply).exists())
+
+    def test_paired_investment_leaves_queue(self):
+        enqueue(self.investments[1])
+        Investment.objects.create(
+            investor=self.investors[0],
+            amount=Decimal('100.00'),
+            remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1),
+            is_matured=True
+        )
+
+        process_investment_matching()
+
+        self.investors[1].refresh_from_db()
+        self.assertFalse(self.investors[1].is_waiting)
+        self.assertFalse(WaitingQueueEntry.objects.exists())
+
+class BenchmarkTests(TestCase):
+    def test_suite_reports_every_scenario_and_rolls_back(self):
+        results = run_suite([30], view_requests=5, track_memory=False, seed=1)
+
+        self.assertEqual([row['scenario'] for row in results], ['task', 'view'])
+        for row in results:
+            self.assertEqual(row['size'], 30)
+            self.assertGreater(row['queries'], 0)
+            self.assertIn('pairings_per_sec', row)
+        self.assertFalse(Investment.objects.exists())
+
+class MaturationSweepTests(TestCase):
+    def setUp(self):
+        self.owner = Investor.objects.create(user=User.objects.create_user(username='owner', password='testpass123'))
+        self.buyer = Investor.objects.create(user=User.objects.create_user(username='buyer', password='testpass123'))
+
+    def test_sweep_matures_due_investments_and_matches_them(self):
+        due = Investment.objects.create(
+            investor=self.owner,
+            amount=Decimal('200.00'),
+            remaining_amount=Decimal('200.00'),
+            maturation_date=timezone.now() - timedelta(hours=1)
+        )
+        demand = Investment.objects.create(
+            investor=self.buyer,
+            amount=Decimal('200.00'),
+            remaining_amount=Decimal('200.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+
+        self.assertEqual(sweep_maturations(), 1)
+
+        due.refresh_from_db()
+        demand.refresh_from_db()
+        self.assertTrue(due.is_matured)
+        self.assertFalse(demand.is_matured)
+        self.assertTrue(demand.paired)
+        self.assertEqual(mature_due_investments(), [])
+
+    def test_saving_a_due_investment_does_not_mature_it(self):
+        due = Investment.objects.create(
+            investor=self.owner,
+            amount=Decimal('200.00'),
+            remaining_amount=Decimal('200.00'),
+            maturation_date=timezone.now() - timedelta(hours=1)
+        )
+        due.save()
+        due.refresh_from_db()
+        self.assertFalse(due.is_matured)
+
+class QueryPlanAssertions:
+    def assert_no_table_scans(self, queries):
+        prefix = connection.ops.explain_query_prefix()
+        if connection.vendor == 'postgresql':
+            # On tables this small the planner prefers a seq scan even with
+            # an index; turned off, it only picks one when no index applies
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        for query in queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or 'api_' not in sql:
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f'{prefix} {sql}')
+                plan = '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+            for line in plan.splitlines():
+                # SQLite reports "SCAN <table>" without an index, PostgreSQL "Seq Scan";
+                # a pass over Django's derived "subquery" table is not a table scan
+                scan = re.search(r'\bSCAN (\w+)', line)
+                full_scan = 'Seq Scan' in line or (
+                    scan is not None and scan.group(1) != 'subquery' and 'USING' not in line
+                )
+                self.assertFalse(full_scan, f'Table scan in plan for:\n{sql}\n{plan}')
+
+class QueryPlanTests(QueryPlanAssertions, TestCase):
+    """Hot queries must be served from an index, never a full table scan"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='planner', password='testpass123')
+        self.investor = Investor.objects.create(user=self.user)
+        other = Investor.objects.create(user=User.objects.create_user(username='other', password='testpass123'))
+        matured = Investment.objects.create(
+            investor=other,
+            amount=Decimal('100.00'),
+            remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1),
+            is_matured=True
+        )
+        waiting = Investment.objects.create(
+            investor=self.investor,
+            amount=Decimal('50.00'),
+            remaining_amount=Decimal('50.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+        Pairing.objects.create(investor=self.investor, paired_investment=matured, paired_amount=Decimal('50.00'))
+        enqueue(waiting)
+        self.client.force_login(self.user)
+
+    def test_dashboard_queries_use_indexes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('api:dashboard'))
+        self.assert_no_table_scans(ctx.captured_queries)
+
+    def test_waiting_to_be_paired_queries_use_indexes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('api:waiting_to_be_paired'))
+        self.assert_no_table_scans(ctx.captured_queries)
+
+    def test_matching_queries_use_indexes(self):
+        with CaptureQueriesContext(connection) as ctx:
+            match_investments()
+            match_investments(immature=waiting_investments())
+            mature_due_investments()
+        self.assert_no_table_scans(ctx.captured_queries)
+
+class StoredReturnTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='saver', password='testpass123')
+        self.investor = Investor.objects.create(user=self.user)
+
+    def test_save_stores_projected_interest_and_end_return(self):
+        investment = Investment.objects.create(
+            investor=self.investor,
+            amount='100.00',
+            remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() + timedelta(days=10, hours=1)
+        )
+        investment.refresh_from_db()
+        self.assertEqual(investment.projected_interest, Decimal('10.00'))
+        self.assertEqual(investment.end_return, Decimal('110.00'))
+        self.assertEqual(investment.end_return, investment.calculate_end_return())
+
+        investment.maturation_date = investment.created_at + timedelta(days=20)
+        investment.save(update_fields=['maturation_date'])
+        investment.refresh_from_db()
+        self.assertEqual(investment.end_return, Decimal('120.00'))
+
+    def test_dashboard_totals_come_from_stored_columns(self):
+        other = Investor.objects.create(user=User.objects.create_user(username='payer', password='testpass123'))
+        matured = Investment.objects.create(
+            investor=other,
+            amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1),
+            is_matured=True
+        )
+        for days in (10, 20):
+            investment = Investment.objects.create(
+                investor=self.investor,
+                amount=Decimal('100.00'),
+                remaining_amount=Decimal('100.00'),
+                maturation_date=timezone.now() + timedelta(days=days, hours=1)
+            )
+            investment.pairing = Pairing.objects.create(
+                investor=self.investor, paired_investment=matured, paired_amount=Decimal('100.00'), confirmed=True
+            )
+            investment.save()
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('api:dashboard'))
+
+        self.assertEqual(response.context['total_returns'], Decimal('230.00'))
+        self.assertEqual(response.context['total_interest'], Decimal('30.00'))
+        self.assertEqual(response.context['total_waiting'], Decimal('230.00'))
+
+class PortfolioSummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='holder', password='testpass123')
+        self.investor = Investor.objects.create(user=self.user)
+        other = Investor.objects.create(user=User.objects.create_user(username='matured', password='testpass123'))
+        self.matured = Investment.objects.create(
+            investor=other,
+            amount=Decimal('500.00'),
+            maturation_date=timezone.now() - timedelta(days=1),
+            is_matured=True
+        )
+        self.investment = Investment.objects.create(
+            investor=self.investor,
+            amount=Decimal('100.00'),
+            remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() + timedelta(days=10, hours=1)
+        )
+        self.pairing = Pairing.objects.create(
+            investor=self.investor, paired_investment=self.matured, paired_amount=Decimal('100.00')
+        )
+        self.investment.pairing = self.pairing
+        self.investment.save()
+
+    def test_confirmation_updates_summary(self):
+        self.assertEqual(get_summary(self.investor).active_investments, 0)
+
+        self.pairing.confirmed = True
+        self.pairing.save()
+
+        summary = PortfolioSummary.objects.get(pk=self.investor.pk)
+        self.assertEqual(summary.active_investments, 1)
+        self.assertEqual(summary.total_invested, Decimal('100.00'))
+        self.assertEqual(summary.total_returns, Decimal('110.00'))
+
+    def test_dashboard_reads_summary(self):
+        self.pairing.confirmed = True
+        self.pairing.save()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('api:dashboard'))
+        self.assertEqual(response.context['total_invested'], Decimal('100.00'))
+
+    def test_rebuild_command_checks_live_data(self):
+        self.pairing.confirmed = True
+        self.pairing.save()
+        PortfolioSummary.objects.filter(pk=self.investor.pk).update(total_invested=0)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_summaries', '--check', stdout=StringIO())
+        call_command('rebuild_summaries', stdout=StringIO())
+        call_command('rebuild_summaries', '--check', stdout=StringIO())
+
+    def test_writes_apply_deltas_without_recomputing(self):
+        get_summary(self.investor)
+        get_summary(self.matured.investor)
+
+        def check():
+            call_command('rebuild_summaries', '--check', stdout=StringIO())
+
+        with mock.patch('api.summaries.refresh_summaries', side_effect=AssertionError('full recompute')):
+            self.pairing.confirmed = True
+            self.pairing.save()
+            check()
+
+            self.investment.remaining_amount = Decimal('40.00')
+            self.investment.maturation_date = timezone.now() - timedelta(minutes=1)
+            self.investment.save()
+            check()
+
+            mature_due_investments()
+            check()
+            self.assertEqual(PortfolioSummary.objects.get(pk=self.investor.pk).projected_returns, Decimal('0.00'))
+
+            Investment.objects.get(pk=self.investment.pk).delete()
+            check()
+            self.assertEqual(PortfolioSummary.objects.get(pk=self.investor.pk).active_investments, 0)
+
+    def test_matching_applies_deltas_to_confirmed_investments(self):
+        self.pairing.confirmed = True
+        self.pairing.save()
+        self.investment.is_matured = True
+        self.investment.save()
+        buyer = Investor.objects.create(user=User.objects.create_user(username='late_buyer', password='x'))
+        Investment.objects.create(
+            investor=buyer, amount=Decimal('30.00'), remaining_amount=Decimal('30.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+
+        with mock.patch('api.summaries.refresh_summaries', side_effect=AssertionError('full recompute')):
+            self.assertEqual(len(match_investments()), 1)
+        self.assertEqual(PortfolioSummary.objects.get(pk=self.investor.pk).total_paired, Decimal('30.00'))
+        call_command('rebuild_summaries', '--check', stdout=StringIO())
+
+    def test_deleting_user_with_investments(self):
+        self.user.delete()
+        self.assertFalse(PortfolioSummary.objects.filter(pk=self.investor.pk).exists())
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='refresher', password='testpass123')
+        self.investor = Investor.objects.create(user=self.user)
+        self.other = Investor.objects.create(user=User.objects.create_user(username='bystander', password='testpass123'))
+        self.client.force_login(self.user)
+        self.client.get(reverse('api:login'))  # Picks up a CSRF cookie
+
+    def test_repeat_request_is_served_from_cache(self):
+        first = self.client.get(reverse('api:waiting_to_be_paired'))
+        with self.assertNumQueries(3):  # Session, user and investor lookups only
+            second = self.client.get(reverse('api:waiting_to_be_paired'))
+        self.assertEqual(first.content, second.content)
+
+    def test_write_invalidates_only_the_affected_investor(self):
+        self.assertNotContains(self.client.get(reverse('api:waiting_to_be_paired')), '75.00')
+        other_version = page_version(self.other.pk)
+
+        with mock.patch('api.tasks.match_investment_event.delay'), self.captureOnCommitCallbacks(execute=True):
+            Investment.objects.create(
+                investor=self.investor,
+                amount=Decimal('75.00'),
+                remaining_amount=Decimal('75.00'),
+                maturation_date=timezone.now() + timedelta(days=30)
+            )
+
+        response = self.client.get(reverse('api:waiting_to_be_paired'))
+        self.assertContains(response, '75.00')
+        self.assertEqual(page_version(self.other.pk), other_version)
+
+class ReferralEarningsTests(TestCase):
+    def setUp(self):
+        self.referrer = User.objects.create_user(username='referrer', password='testpass123')
+        self.referred = User.objects.create_user(username='referred', password='testpass123')
+        Investor.objects.create(user=self.referrer)
+        self.investor = Investor.objects.create(user=self.referred)
+        self.referral = Referral.objects.create(referrer=self.referrer, referred_user=self.referred, code='ABC12345')
+        JobWatermark.objects.update_or_create(
+            name='referral_earnings', defaults={'processed_until': timezone.now() - timedelta(hours=1)}
+        )
+
+    def create_matched(self, amount, matched_minutes_ago=10):
+        return Investment.objects.create(
+            investor=self.investor,
+            amount=Decimal(amount),
+            maturation_date=timezone.now() + timedelta(days=30),
+            status='matched',
+            matched_at=timezone.now() - timedelta(minutes=matched_minutes_ago)
+        )
+
+    def test_each_investment_is_credited_once(self):
+        self.create_matched('200.00')
+        self.assertEqual(process_referral_earnings(), 1)
+        self.assertEqual(process_referral_earnings(), 0)
+
+        self.referral.refresh_from_db()
+        self.assertEqual(self.referral.total_investment_amount, Decimal('200.00'))
+        self.assertEqual(self.referral.total_earnings, Decimal('10.00'))
+
+        self.create_matched('100.00', matched_minutes_ago=0)
+        with mock.patch('api.tasks.timezone.now', return_value=timezone.now() + timedelta(minutes=2)):
+            process_referral_earnings()
+        self.referral.refresh_from_db()
+        self.assertEqual(self.referral.total_investment_amount, Decimal('300.00'))
+        self.assertEqual(self.referral.total_earnings, Decimal('15.00'))
+
+    def test_recent_matches_wait_for_the_next_run(self):
+        self.create_matched('200.00', matched_minutes_ago=0)
+        self.assertEqual(process_referral_earnings(), 0)
+        self.referral.refresh_from_db()
+        self.assertEqual(self.referral.total_investment_amount, Decimal('0.00'))
+
+class ReferralTreeTests(TestCase):
+    def setUp(self):
+        self.investors = [
+            Investor.objects.create(user=User.objects.create_user(username=f'tree{i}', password='testpass123'))
+            for i in range(4)
+        ]
+
+    def test_linking_a_subtree_updates_every_ancestor(self):
+        a, b, c, d = self.investors
+        self.assertTrue(link_referral(c, b))
+        self.assertTrue(link_referral(d, c))
+        # b and its subtree move under a
+        self.assertTrue(link_referral(b, a))
+
+        self.assertEqual(set(downline(a)), {b, c, d})
+        self.assertEqual(set(downline(a, max_depth=2)), {b, c})
+        self.assertEqual(ReferralPath.objects.get(ancestor=a, descendant=d).depth, 3)
+
+    def test_applying_a_code_links_the_referral_tree(self):
+        a, b, c, d = self.investors
+        self.assertTrue(link_referral(b, a))
+        invitee = User.objects.create_user(username='invitee', password='testpass123')
+        Referral.objects.create(referrer=b.user, referred_user=invitee, code='SHARED01')
+
+        for investor in (c, d):
+            self.client.force_login(investor.user)
+            response = self.client.post(reverse('api:apply-referral'), {'code': 'SHARED01'})
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertEqual(
+                dict(ReferralPath.objects.filter(descendant=investor).values_list('ancestor_id', 'depth')),
+                {b.pk: 1, a.pk: 2}
+            )
+        self.assertEqual(Referral.objects.filter(referrer=b.user).count(), 3)
+
+        # a is above b, so joining b's downline would create a cycle
+        self.client.force_login(a.user)
+        response = self.client.post(reverse('api:apply-referral'), {'code': 'SHARED01'})
+        self.assertEqual(response.json(), {'error': 'This referral code cannot be applied to your account'})
+        self.assertFalse(Referral.objects.filter(referred_user=a.user).exists())
+
+    def test_cycles_and_second_referrers_are_rejected(self):
+        a, b, c, _ = self.investors
+        link_referral(b, a)
+        self.assertFalse(link_referral(a, b))
+        self.assertFalse(link_referral(b, c))
+        self.assertFalse(link_referral(a, a))
+
+    def test_downline_stats_per_level(self):
+        a, b, c, _ = self.investors
+        link_referral(b, a)
+        link_referral(c, b)
+        for investor, amount in ((b, '100.00'), (c, '50.00'), (c, '25.00')):
+            Investment.objects.create(investor=investor, amount=Decimal(amount), maturation_date=timezone.now())
+
+        with self.assertNumQueries(2):
+            levels = downline_stats(a)
+        self.assertEqual(levels, [
+            {'depth': 1, 'investors': 1, 'investment': Decimal('100.00')},
+            {'depth': 2, 'investors': 1, 'investment': Decimal('75.00')},
+        ])
+
+    def test_register_with_referral_code_links_tree(self):
+        referrer = self.investors[0]
+        self.client.post(
+            f"{reverse('api:register')}?ref={referrer.referral_code}",
+            {'username': 'newcomer', 'password1': 'Sup3r-secret-pw', 'password2': 'Sup3r-secret-pw'}
+        )
+        newcomer = Investor.objects.get(user__username='newcomer')
+        self.assertEqual(newcomer.referred_by, referrer)
+        self.assertEqual(list(downline(referrer)), [newcomer])
+
+class BalanceLedgerTests(TestCase):
+    def setUp(self):
+        self.buyer = Investor.objects.create(user=User.objects.create_user(username='buyer', password='testpass123'))
+        self.seller = Investor.objects.create(user=User.objects.create_user(username='seller', password='testpass123'))
+        ledger.post_entry(self.buyer, Decimal('1000.00'), 'deposit')
+
+    def test_balance_is_snapshot_plus_tail(self):
+        ledger.transfer(self.buyer, self.seller, Decimal('300.00'), 'purchase', 'sale')
+        later = timezone.now() + timedelta(minutes=2)
+        self.assertEqual(ledger.take_snapshots(now=later), 2)
+        self.assertEqual(BalanceSnapshot.objects.get(investor=self.buyer).balance, Decimal('700.00'))
+
+        ledger.post_entry(self.seller, Decimal('-50.00'), 'withdrawal')
+        self.assertEqual(ledger.balances([self.buyer.pk, self.seller.pk]), {
+            self.buyer.pk: Decimal('700.00'),
+            self.seller.pk: Decimal('250.00'),
+        })
+
+        # The next run only folds the new entry
+        self.assertEqual(ledger.take_snapshots(now=later + timedelta(minutes=2)), 1)
+        self.assertEqual(ledger.take_snapshots(now=later + timedelta(minutes=2)), 0)
+        self.assertEqual(ledger.balance(self.seller), Decimal('250.00'))
+        self.assertEqual(ledger.balance(self.buyer), Decimal('700.00'))
+
+    def test_repair_picks_up_an_entry_committed_behind_the_snapshot(self):
+        late = ledger.post_entry(self.buyer, Decimal('25.00'), 'deposit')
+        late_id = late.id
+        late.delete()  # Not yet committed when the run folds past its id
+        ledger.post_entry(self.buyer, Decimal('-100.00'), 'withdrawal')
+        ledger.take_snapshots(now=timezone.now() + timedelta(minutes=2))
+        BalanceEntry.objects.create(id=late_id, investor=self.buyer, amount=Decimal('25.00'), kind='deposit')
+        self.assertEqual(ledger.balance(self.buyer), Decimal('900.00'))
+
+        with self.assertRaises(CommandError):
+            call_command('repair_balance_snapshots', '--check', stdout=StringIO())
+        out = StringIO()
+        call_command('repair_balance_snapshots', stdout=out)
+
+        self.assertIn('Repaired 1 of 1 snapshots', out.getvalue())
+        self.assertEqual(ledger.balance(self.buyer), Decimal('925.00'))
+        self.assertEqual(ledger.repair_snapshots([self.buyer.pk]), 0)
+
+    def test_recent_entries_wait_for_the_next_snapshot(self):
+        self.assertEqual(ledger.take_snapshots(), 0)
+        self.assertFalse(BalanceSnapshot.objects.exists())
+        self.assertEqual(ledger.balance(self.buyer), Decimal('1000.00'))
+
+    def test_buy_share_appends_entries(self):
+        share = Investment.objects.create(
+            investor=self.seller, amount=Decimal('400.00'), maturation_date=timezone.now() + timedelta(days=7),
+            status='available', is_for_sale=True
+        )
+        self.client.login(username='buyer', password='testpass123')
+        self.client.post(reverse('api:buy_share', args=[share.id]), {'amount': '250.00'})
+
+        self.assertEqual(ledger.balance(self.buyer), Decimal('750.00'))
+        self.assertEqual(ledger.balance(self.seller), Decimal('250.00'))
+        self.assertEqual(
+            list(BalanceEntry.objects.filter(reference=f'investment:{share.id}').values_list('kind', 'amount')),
+            [('purchase', Decimal('-250.00')), ('sale', Decimal('250.00'))]
+        )
+
+
+class BuyShareTests(TestCase):
+    def setUp(self):
+        self.seller = Investor.objects.create(user=User.objects.create_user(username='seller', password='testpass123'))
+        self.buyer = Investor.objects.create(user=User.objects.create_user(username='buyer', password='testpass123'))
+        ledger.post_entry(self.buyer, Decimal('500.00'), 'deposit')
+        self.share = Investment.objects.create(
+            investor=self.seller, amount=Decimal('300.00'), maturation_date=timezone.now() + timedelta(days=14),
+            status='available', is_for_sale=True
+        )
+
+    def test_partial_fill_then_sell_out(self):
+        market.buy_share(self.buyer, self.share.pk, Decimal('200.00'))
+        self.share.refresh_from_db()
+        self.assertEqual((self.share.amount, self.share.status), (Decimal('100.00'), 'available'))
+        self.assertEqual(self.share.end_return, self.share.amount + self.share.projected_interest)
+
+        bought = market.buy_share(self.buyer, self.share.pk, Decimal('100.00'))
+        self.share.refresh_from_db()
+        self.assertEqual((self.share.amount, self.share.status), (Decimal('0.00'), 'sold'))
+        self.assertEqual((bought.status, bought.maturation_date), ('matched', self.share.maturation_date))
+        self.assertEqual(ledger.balance(self.seller), Decimal('300.00'))
+
+    def test_rejected_purchases_change_nothing(self):
+        for amount, message in (
+            (Decimal('400.00'), 'Only part'),
+            (Decimal('0'), 'Invalid amount'),
+        ):
+            with self.assertRaisesMessage(market.PurchaseError, message):
+                market.buy_share(self.buyer, self.share.pk, amount)
+        ledger.post_entry(self.seller, Decimal('10.00'), 'deposit')
+        with self.assertRaisesMessage(market.PurchaseError, 'own share'):
+            market.buy_share(self.seller, self.share.pk, Decimal('10.00'))
+        ledger.post_entry(self.buyer, Decimal('-450.00'), 'withdrawal')
+        with self.assertRaisesMessage(market.PurchaseError, 'enough balance'):
+            market.buy_share(self.buyer, self.share.pk, Decimal('100.00'))
+
+        self.share.refresh_from_db()
+        self.assertEqual(self.share.amount, Decimal('300.00'))
+        self.assertFalse(Investment.objects.filter(investor=self.buyer).exists())
+        self.assertEqual(ledger.balance(self.seller), Decimal('10.00'))
+
+
+class BuyShareStressTests(TransactionTestCase):
+    def test_concurrent_buyers_never_oversell(self):
+        with mock.patch('api.tasks.match_investment_event.delay'):
+            result = run_purchase_stress(buyers=10, threads=4, purchases_per_buyer=3)
+
+        self.assertFalse(result['oversold'])
+        self.assertEqual(result['purchases'] + result['rejected'], 30)
+        self.assertEqual(result['sold'], result['listing_amount'])
+        self.assertEqual(result['remaining'], Decimal('0.00'))
+        self.assertGreater(result['purchases_per_sec'], 0)
+
+
+class OrderBookTests(TestCase):
+    def setUp(self):
+        orderbook.reset_books()
+        self.maturity = timezone.now() + timedelta(days=30)
+        self.sellers = [
+            Investor.objects.create(user=User.objects.create_user(username=f'ask{i}', password='testpass123'))
+            for i in range(3)
+        ]
+        self.buyer = Investor.objects.create(user=User.objects.create_user(username='bidder', password='testpass123'))
+        ledger.post_entry(self.buyer, Decimal('1000.00'), 'deposit')
+
+    def list_share(self, seller, amount, price):
+        investment = Investment.objects.create(
+            investor=seller, amount=Decimal(amount), maturation_date=self.maturity, status='matched'
+        )
+        return orderbook.list_investment(investment, seller.user, Decimal(price))
+
+    def test_bid_fills_best_price_then_oldest_first(self):
+        expensive = self.list_share(self.sellers[0], '100.00', '110.00')
+        older = self.list_share(self.sellers[1], '100.00', '105.00')
+        newer = self.list_share(self.sellers[2], '100.00', '105.00')
+
+        order = orderbook.place_buy_order(self.buyer, Decimal('150.00'), Decimal('1.08'), self.maturity)
+
+        trades = list(Trade.objects.order_by('id').values_list('sale_id', 'amount', 'unit_price'))
+        self.assertEqual(trades, [
+            (older.pk, Decimal('100.00'), Decimal('1.0500')),
+            (newer.pk, Decimal('50.00'), Decimal('1.0500')),
+        ])
+        self.assertEqual(order.status, 'filled')
+        self.assertEqual(InvestmentSale.objects.get(pk=expensive.pk).status, 'pending')
+        self.assertEqual(InvestmentSale.objects.get(pk=newer.pk).remaining_amount, Decimal('50.00'))
+        # The buyer pays the asks' price and gets the rest of the hold back
+        self.assertEqual(ledger.balance(self.buyer), Decimal('842.50'))
+        self.assertEqual(ledger.balance(self.sellers[2]), Decimal('52.50'))
+        self.assertEqual(Investment.objects.filter(investor=self.buyer).aggregate(total=Sum('amount'))['total'],
+                         Decimal('150.00'))
+
+    def test_resting_bid_fills_when_a_crossing_ask_arrives(self):
+        order = orderbook.place_buy_order(self.buyer, Decimal('100.00'), Decimal('1.00'), self.maturity)
+        self.assertEqual((order.status, order.held_amount), ('open', Decimal('100.00')))
+        self.list_share(self.sellers[0], '100.00', '120.00')
+        self.assertFalse(Trade.objects.exists())
+
+        # Rebuilt from the database, as after a restart
+        orderbook.reset_books()
+        sale = self.list_share(self.sellers[1], '40.00', '38.00')
+        order.refresh_from_db()
+        self.assertEqual(order.remaining_amount, Decimal('60.00'))
+        self.assertEqual(Trade.objects.get().unit_price, Decimal('1.0000'))  # The resting bid's price
+        self.assertEqual(InvestmentSale.objects.get(pk=sale.pk).status, 'completed')
+
+        orderbook.cancel_buy_order(order.pk, self.buyer)
+        self.assertEqual(ledger.balance(self.buyer), Decimal('960.00'))
+
+    def test_orders_only_trade_within_their_bucket(self):
+        self.list_share(self.sellers[0], '100.00', '90.00')
+        orderbook.place_buy_order(self.buyer, Decimal('100.00'), Decimal('1.00'), self.maturity + timedelta(days=60))
+        self.assertFalse(Trade.objects.exists())
+
+    def test_selling_into_a_resting_bid_keeps_the_fill(self):
+        orderbook.place_buy_order(self.buyer, Decimal('100.00'), Decimal('1.00'), self.maturity)
+        investment = Investment.objects.create(
+            investor=self.sellers[0], amount=Decimal('100.00'), maturation_date=self.maturity, status='matched'
+        )
+        self.client.force_login(self.sellers[0].user)
+        response = self.client.post(reverse('api:sell_investment_api'),
+                                    {'investment_id': investment.pk, 'price': '100.00'})
+        self.assertTrue(response.json()['success'])
+
+        investment.refresh_from_db()
+        self.assertEqual((investment.amount, investment.status, investment.is_for_sale),
+                         (Decimal('0.00'), 'sold', False))
+        self.assertEqual(Investment.objects.get(investor=self.buyer).amount, Decimal('100.00'))
+
+    def test_self_trade_cancels_the_newer_listing_and_clears_for_sale(self):
+        orderbook.place_buy_order(self.buyer, Decimal('100.00'), Decimal('1.00'), self.maturity)
+        sale = self.list_share(self.buyer, '100.00', '90.00')
+
+        sale.refresh_from_db()
+        investment = Investment.objects.get(pk=sale.investment_id)
+        self.assertEqual(sale.status, 'cancelled')
+        self.assertEqual((investment.is_for_sale, investment.status), (False, 'matched'))
+        self.assertFalse(Trade.objects.exists())
+
+    def test_book_side_removes_orders_by_id(self):
+        side = orderbook.BookSide(descending=True)
+        now = timezone.now()
+        side.push(1, Decimal('1.00'), now)
+        side.push(2, Decimal('0.90'), now)
+        # Removing an order that is not on top leaves the best one in place
+        side.remove(2)
+        self.assertEqual(side.best(), (1, Decimal('1.00')))
+        side.remove(1)
+        self.assertIsNone(side.best())
+        self.assertEqual(len(side), 0)
+
+    def test_buy_order_api(self):
+        self.list_share(self.sellers[0], '100.00', '100.00')
+        self.client.login(username='bidder', password='testpass123')
+        response = self.client.post(reverse('api:buy_order_api'), {'amount': '30', 'limit_price': '1', 'days': 30})
+        self.assertEqual(response.json()['status'], 'filled')
+        response = self.client.post(reverse('api:buy_order_api'), {'amount': '5000', 'limit_price': '1'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MarketListingTests(QueryPlanAssertions, TestCase):
+    def setUp(self):
+        seller = Investor.objects.create(user=User.objects.create_user(username='lister', password='testpass123'))
+        now = timezone.now()
+        self.shares = [
+            Investment.objects.create(
+                investor=seller, amount=Decimal(100 * (i % 3 + 1)), status='available', is_for_sale=True,
+                maturation_date=now + timedelta(days=10 + i % 4)
+            )
+            for i in range(12)
+        ]
+        for investment in self.shares[:6]:
+            orderbook.list_investment(investment, seller.user, investment.amount * Decimal('0.9'))
+        self.client.force_login(User.objects.create_user(username='browser', password='testpass123'))
+
+    def walk(self, url):
+        ids = []
+        while url:
+            page = self.client.get(url).json()
+            ids += [row['id'] for row in page['results']]
+            url = page['next']
+        return ids
+
+    def test_pages_cover_every_listing_once_in_order(self):
+        ids = self.walk(reverse('api:share_listings_api') + '?ordering=amount&page_size=5')
+        expected = sorted(self.shares, key=lambda share: (share.amount, share.id))
+        self.assertEqual(ids, [share.id for share in expected])
+
+    def test_filters(self):
+        url = reverse('api:share_listings_api')
+        ids = self.walk(f'{url}?min_amount=200&max_amount=200')
+        self.assertEqual(set(ids), {share.id for share in self.shares if share.amount == 200})
+        # Shares sell at face value, so they have no price to filter on
+        response = self.client.get(url, {'max_price': '0.9'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('max_price', response.json())
+
+        url = reverse('api:sale_listings_api')
+        matures_before = (timezone.now() + timedelta(days=11, hours=12)).isoformat()
+        rows = self.client.get(url, {'max_price': '0.9', 'matures_before': matures_before}).json()['results']
+        self.assertEqual({row['investment'] for row in rows}, {self.shares[0].id, self.shares[1].id, self.shares[4].id,
+                                                                 self.shares[5].id})
+        self.assertEqual(self.client.get(url, {'ordering': 'newest'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cursor': 'not-a-cursor'}).status_code, 400)
+
+    def test_deep_pages_cost_the_same_and_use_indexes(self):
+        url = reverse('api:sale_listings_api') + '?page_size=2'
+        with CaptureQueriesContext(connection) as first:
+            page = self.client.get(url).json()
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(page['next'])
+        self.assertEqual(len(first.captured_queries), len(deep.captured_queries))
+        self.assertNotIn('OFFSET', deep.captured_queries[-1]['sql'])
+        self.assert_no_table_scans(deep.captured_queries)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.walk(reverse('api:share_listings_api') + '?page_size=4')
+        self.assert_no_table_scans(ctx.captured_queries)
+
+
+@override_settings(QUERY_BUDGET_RAISE=True)
+class QueryBudgetTests(TestCase):
+    """Every budgeted view must stay within budget however many rows it shows"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='budget', password='testpass123')
+        self.investor = Investor.objects.create(user=self.user, phone_number='0700000000')
+        now = timezone.now()
+        for i in range(4):
+            payer = Investor.objects.create(user=User.objects.create_user(username=f'payer{i}', password='x'))
+            mine = Investment.objects.create(
+                investor=self.investor, amount=Decimal('100.00'), maturation_date=now - timedelta(days=1),
+                is_matured=True, paired=True, status='matched'
+            )
+            theirs = Investment.objects.create(
+                investor=payer, amount=Decimal('100.00'), maturation_date=now + timedelta(days=30)
+            )
+            pairing = Pairing.objects.create(investor=payer, paired_investment=mine, paired_amount=Decimal('100.00'))
+            Pairing.objects.create(investor=self.investor, paired_investment=theirs,
+                                   paired_amount=Decimal('50.00'), confirmed=True)
+            Investment.objects.filter(pk=mine.pk).update(pairing=pairing)
+            Referral.objects.create(referrer=self.user, referred_user=payer.user, code=f'code{i}')
+        for investment in Investment.objects.filter(investor=self.investor)[:2]:
+            orderbook.list_investment(investment, self.user, investment.amount)
+        self.pairing = pairing
+        self.investment = mine
+        self.client.force_login(self.user)
+
+    def test_views_stay_within_budget(self):
+        for url in (
+            reverse('api:dashboard'),
+            reverse('api:sell_shares'),
+            reverse('api:investment_status'),
+            reverse('api:waiting_to_be_paired'),
+            reverse('api:referrals'),
+            reverse('api:buy_shares'),
+            reverse('api:pairing_detail', args=[self.pairing.pk]),
+            reverse('api:investment_detail', args=[self.investment.pk]),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_over_budget_reports_repeated_shapes(self):
+        @query_budget(2)
+        def view(request):
+            for investment in Investment.objects.filter(investor=self.investor):
+                investment.investor.user.username
+            return None
+
+        request = RequestFactory().get('/')
+        with self.assertRaises(QueryBudgetExceeded) as raised:
+            view(request)
+        self.assertIn('ran 9 queries, over its budget of 2', str(raised.exception))
+        self.assertIn('4x SELECT', str(raised.exception))
+
+        with override_settings(QUERY_BUDGET_RAISE=False), self.assertLogs('api.querybudget', 'WARNING'):
+            view(request)
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='observer', password='testpass123')
+        Investor.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.client.get(reverse('api:login'))  # Picks up a CSRF cookie
+
+    def sample(self, name, labels):
+        line = re.search(rf'^{re.escape(name + labels)} (\S+)$', metrics.REGISTRY.render(), re.M)
+        return float(line.group(1)) if line else 0
+
+    def test_requests_are_recorded_per_route(self):
+        route = '{route="api:waiting_to_be_paired"}'
+        before = self.sample('newloan_request_duration_seconds_count', route)
+        hits = self.sample('newloan_page_cache_lookups_total', '{route="api:waiting_to_be_paired",result="hit"}')
+
+        self.client.get(reverse('api:waiting_to_be_paired'))
+        response = self.client.get(reverse('api:waiting_to_be_paired'))
+
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="3 queries", cache;desc="hit"$')
+        self.assertEqual(self.sample('newloan_request_duration_seconds_count', route), before + 2)
+        self.assertEqual(
+            self.sample('newloan_page_cache_lookups_total', '{route="api:waiting_to_be_paired",result="hit"}'), hits + 1
+        )
+
+        with override_settings(METRICS_TOKEN='scrape-secret'):
+            body = self.client.get(reverse('api:metrics'), HTTP_AUTHORIZATION='Bearer scrape-secret').content.decode()
+        self.assertIn('# TYPE newloan_request_duration_seconds histogram', body)
+        self.assertIn('newloan_request_db_queries_bucket{route="api:waiting_to_be_paired",le="+Inf"}', body)
+        self.assertIn('newloan_requests_total{route="api:waiting_to_be_paired",method="GET",status="200"}', body)
+
+    def test_metrics_need_staff_or_the_token(self):
+        url = reverse('api:metrics')
+        # Loopback is what every request looks like behind a local proxy
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with override_settings(METRICS_TOKEN='scrape-secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-secret').status_code, 200)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class TaskMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        seller = Investor.objects.create(user=User.objects.create_user(username='supplier', password='testpass123'))
+        buyer = Investor.objects.create(user=User.objects.create_user(username='demander', password='testpass123'))
+        Investment.objects.create(
+            investor=seller, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+        self.waiting = Investment.objects.create(
+            investor=buyer, amount=Decimal('300.00'), remaining_amount=Decimal('300.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+
+    def sample(self, name, labels=''):
+        line = re.search(rf'^{re.escape(name + labels)} (\S+)$', metrics.REGISTRY.render(), re.M)
+        return float(line.group(1)) if line else None
+
+    def test_task_runs_are_recorded(self):
+        match_waiting_investors.apply()
+        task = '{task="api.tasks.match_waiting_investors"}'
+
+        runs = self.sample('newloan_task_runs_total', '{task="api.tasks.match_waiting_investors",state="SUCCESS"}')
+        self.assertEqual(runs, 1)
+        self.assertEqual(self.sample('newloan_task_duration_seconds_count', task), 1)
+        self.assertEqual(self.sample('newloan_task_pairings_created_total', task), 1)
+        self.assertEqual(self.sample('newloan_task_rows_examined_total', task), 2)
+        # Two investments updated, plus the pairing and outbox inserts where the
+        # driver reports a row count for them
+        self.assertGreaterEqual(self.sample('newloan_task_rows_written_total', task), 2)
+        self.assertIsNotNone(self.sample('newloan_task_last_duration_seconds', task))
+
+    def test_queue_lag_is_the_oldest_wait(self):
+        # The waiting investment joined the queue when it was created
+        self.assertLess(self.sample('newloan_matching_queue_lag_seconds'), 60)
+        entry = WaitingQueueEntry.objects.get(investment=self.waiting)
+        WaitingQueueEntry.objects.filter(pk=entry.pk).update(enqueued_at=timezone.now() - timedelta(minutes=5))
+        self.assertGreaterEqual(self.sample('newloan_matching_queue_lag_seconds'), 300)
+
+class SingletonLockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lock_is_exclusive_and_released_only_by_holder(self):
+        first, second = CacheLock('job'), CacheLock('job')
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        second.release()
+        self.assertFalse(CacheLock('job').acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+
+    def test_triggers_during_a_run_coalesce_into_one_follow_up(self):
+        calls = []
+
+        def run():
+            calls.append('run')
+            # Three triggers arrive while the first run holds the lock
+            for _ in range(3):
+                self.assertIsNone(run_exclusive('job', run, follow_up=follow_up))
+            return 1
+
+        def follow_up(items=()):
+            calls.append('follow_up')
+            return 2
+
+        self.assertEqual(run_exclusive('job', run, follow_up=follow_up), [1, 2])
+        self.assertEqual(calls, ['run', 'follow_up'])
+        self.assertEqual(run_exclusive('job', follow_up), [2])
+
+    def test_follow_up_gets_the_items_of_every_coalesced_call(self):
+        def run():
+            for items in ([1], [2], [2, 3]):
+                self.assertIsNone(run_exclusive('job', run, follow_up=sorted, pending=items))
+            return []
+
+        self.assertEqual(run_exclusive('job', run, follow_up=sorted), [[], [1, 2, 3]])
+
+    def test_trigger_landing_before_the_holder_releases_gets_a_follow_up(self):
+        release = CacheLock.release
+
+        def release_after_trigger(lock):
+            # The holder has made its last check; a trigger lands before the
+            # lock is dropped
+            if lock.key == 'lock:job':
+                CacheLock.release = release
+                self.assertIsNone(run_exclusive('job', list, follow_up=sorted, pending=[4]))
+            release(lock)
+
+        with mock.patch.object(CacheLock, 'release', release_after_trigger):
+            self.assertEqual(run_exclusive('job', list, follow_up=sorted), [[], [4]])
+
+    def test_trigger_that_missed_the_holder_runs_its_own_items(self):
+        acquire = CacheLock.acquire
+        attempts = []
+
+        def acquire_after_holder_left(lock):
+            # The first attempt fails against a holder that then releases
+            # without seeing this call's items
+            if lock.key == 'lock:job' and not attempts:
+                attempts.append(lock)
+                return False
+            return acquire(lock)
+
+        with mock.patch.object(CacheLock, 'acquire', acquire_after_holder_left):
+            self.assertEqual(run_exclusive('job', list, follow_up=sorted, pending=[5, 6]), [[5, 6]])
+        self.assertEqual(len(attempts), 1)
+
+    def test_matching_task_coalesces_while_another_run_holds_the_lock(self):
+        seller = Investor.objects.create(user=User.objects.create_user(username='locked_seller', password='x'))
+        buyer = Investor.objects.create(user=User.objects.create_user(username='locked_buyer', password='x'))
+        Investment.objects.create(
+            investor=seller, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+        demand = Investment.objects.create(
+            investor=buyer, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+
+        untouched = Investment.objects.create(
+            investor=Investor.objects.create(user=User.objects.create_user(username='locked_other', password='x')),
+            amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+        Investment.objects.create(
+            investor=seller, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+
+        def running_pass():
+            # An event for the new investment lands mid-run and is skipped
+            self.assertEqual(match_investment_event([demand.id]), 0)
+            self.assertFalse(Pairing.objects.exists())
+            return 0
+
+        # The running pass makes one follow-up pass for the skipped event's
+        # investment only, not a full-market pass
+        self.assertEqual(run_matching(running_pass), 1)
+        demand.refresh_from_db()
+        untouched.refresh_from_db()
+        self.assertTrue(demand.paired)
+        self.assertFalse(untouched.paired)
+
+class NotificationOutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.seller = Investor.objects.create(
+            user=User.objects.create_user(username='outbox_seller', email='seller@example.com', password='x'))
+        self.buyers = [
+            Investor.objects.create(user=User.objects.create_user(
+                username=f'outbox_buyer{i}', email=f'buyer{i}@example.com', password='x'))
+            for i in range(3)
+        ]
+
+    def pair_all(self):
+        Investment.objects.create(
+            investor=self.seller, amount=Decimal('300.00'), remaining_amount=Decimal('300.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+        for buyer in self.buyers:
+            Investment.objects.create(
+                investor=buyer, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+                maturation_date=timezone.now() + timedelta(days=30)
+            )
+        return match_investments()
+
+    def test_matching_queues_notifications_without_sending(self):
+        self.pair_all()
+
+        self.assertEqual(mail.outbox, [])
+        queued = Notification.objects.filter(status='pending').order_by('id')
+        self.assertEqual([n.user_id for n in queued], [buyer.user_id for buyer in self.buyers])
+        self.assertIn('paired with outbox_seller for an amount of $100.00', queued[0].body)
+
+    def test_outbox_drains_in_batches_over_one_connection(self):
+        self.pair_all()
+
+        with mock.patch('api.notifications.get_connection', wraps=notifications.get_connection) as connect:
+            result = notifications.send_pending(batch_size=2)
+
+        connect.assert_called_once()
+        self.assertEqual((result['sent'], result['failed']), (3, 0))
+        self.assertGreater(result['messages_per_sec'], 0)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['buyer0@example.com', 'buyer1@example.com', 'buyer2@example.com'])
+        self.assertFalse(Notification.objects.exclude(status='sent').exists())
+        self.assertEqual(send_notifications(), 0)
+
+    def test_failed_messages_back_off_then_give_up(self):
+        user = self.buyers[0].user
+        user.email = ''
+        user.save()
+        notification = Notification.objects.create(user=user, subject='Hello', body='Body')
+        now = timezone.now()
+
+        self.assertEqual(notifications.send_pending(now=now)['failed'], 1)
+        notification.refresh_from_db()
+        self.assertEqual((notification.status, notification.attempts), ('pending', 1))
+        self.assertEqual(notification.next_attempt_at, now + notifications.RETRY_BASE_DELAY)
+        self.assertEqual(notifications.send_pending(now=now)['failed'], 0)
+
+        for attempt in range(2, notifications.MAX_ATTEMPTS + 1):
+            now = notification.next_attempt_at
+            notifications.send_pending(now=now)
+            notification.refresh_from_db()
+        self.assertEqual((notification.status, notification.attempts), ('failed', notifications.MAX_ATTEMPTS))
+        self.assertEqual(mail.outbox, [])
+
+    def test_unreachable_mail_server_defers_the_batch(self):
+        self.pair_all()
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('refused')), \
+                self.assertLogs('api.notifications', 'WARNING') as logs:
+            result = notifications.send_pending()
+
+        self.assertIn('OSError: refused', logs.output[0])
+
+        self.assertEqual((result['sent'], result['failed']), (0, 3))
+        self.assertFalse(Notification.objects.filter(attempts=0).exists())
+        self.assertFalse(Notification.objects.filter(next_attempt_at__lte=timezone.now()).exists())
+
+class BulkImportTests(TestCase):
+    CSV = (
+        'username,email,phone_number,amount,maturation_date\n'
+        'partner1,p1@example.com,0700000001,100.00,2030-01-01\n'
+        'partner1,p1@example.com,0700000001,250.50,2030-02-01T12:00:00\n'
+        'partner2,p2@example.com,,,\n'
+        'bad user!,x@example.com,,10,2030-01-01\n'
+        'partner3,not-an-email,,10,2030-01-01\n'
+        'partner4,,,1.005,2030-01-01\n'
+    )
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = directory
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_csv_import_validates_and_reuses_users(self):
+        User.objects.create_user(username='partner2', password='x')
+        out, err = StringIO(), StringIO()
+
+        with mock.patch('api.tasks.match_investment_event.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_investors', self.write_file('book.csv', self.CSV), stdout=out, stderr=err)
+
+        self.assertIn('records=6 rejected=3 users=1 investments=2', out.getvalue())
+        self.assertIn('Record 4 skipped: username is not valid', err.getvalue())
+        self.assertIn('Record 6 skipped: amount must have at most two decimal places', err.getvalue())
+        investor = Investor.objects.get(user__username='partner1')
+        self.assertTrue(investor.referral_code)
+        self.assertEqual(investor.phone_number, '0700000001')
+        self.assertFalse(investor.user.has_usable_password())
+        self.assertEqual(
+            sorted(investor.investments.values_list('amount', 'remaining_amount')),
+            [(Decimal('100.00'), Decimal('100.00')), (Decimal('250.50'), Decimal('250.50'))]
+        )
+        self.assertTrue(Investor.objects.filter(user__username='partner2').exists())
+        self.assertGreater(investor.investments.first().projected_interest, 0)
+        # Imported demand joins the waiting queue
+        self.assertEqual(set(waiting_investments()), set(investor.investments.all()))
+        self.assertTrue(investor.is_waiting)
+        self.assertEqual(investor.waiting_investment_id, investor.investments.latest('id').id)
+        # and is matched against open supply once its chunk commits
+        delay.assert_called_once()
+        self.assertEqual(sorted(delay.call_args.args[0]), sorted(investor.investments.values_list('id', flat=True)))
+
+    def test_failed_jsonl_import_resumes_after_last_chunk(self):
+        lines = [
+            f'{{"username": "jsonl{i}", "amount": "10.00", "maturation_date": "2030-01-01"}}' for i in range(5)
+        ]
+        path = self.write_file('book.jsonl', '\n'.join(lines[:2] + ['not json'] + lines[2:]) + '\n')
+        original = imports.write_chunk
+        calls = []
+
+        def fail_second_chunk(rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError('database went away')
+            return original(rows)
+
+        with mock.patch('api.imports.write_chunk', side_effect=fail_second_chunk):
+            with self.assertRaises(RuntimeError):
+                imports.import_records(path, 'partner-book', chunk_size=2)
+        self.assertEqual(JobWatermark.objects.get(name='partner-book').position, 2)
+        self.assertEqual(Investment.objects.count(), 2)
+
+        stats = imports.import_records(path, 'partner-book', chunk_size=2)
+
+        self.assertEqual((stats['resumed_at'], stats['records'], stats['rejected']), (2, 4, 1))
+        self.assertEqual(Investment.objects.count(), 5)
+        self.assertEqual(imports.import_records(path, 'partner-book')['records'], 0)
+        self.assertEqual(imports.import_records(path, 'partner-book', restart=True)['records'], 6)
+        self.assertEqual(User.objects.filter(username__startswith='jsonl').count(), 5)
+
+class StatementExportTests(TestCase):
+    def setUp(self):
+        self.seller = Investor.objects.create(user=User.objects.create_user(username='export_seller', password='x'))
+        self.buyer = Investor.objects.create(user=User.objects.create_user(username='export_buyer', password='x'))
+        self.matured = Investment.objects.create(
+            investor=self.seller, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+        Investment.objects.create(
+            investor=self.buyer, amount=Decimal('60.00'), remaining_amount=Decimal('60.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+        match_investments()
+        InvestmentSale.objects.create(investment=self.matured, seller=self.seller.user, price=Decimal('90.00'))
+
+    def export(self, user, path, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse('api:export_statement', args=path.split('.')), params)
+
+    def test_csv_export_streams_only_the_users_rows(self):
+        response = self.export(self.buyer.user, 'investments.csv')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('investments-export_buyer-', response['Content-Disposition'])
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:4], ['id', 'investor', 'created_at', 'amount'])
+        self.assertEqual(len(lines), 2)
+        self.assertIn('export_buyer', lines[1])
+
+    def test_jsonl_pairings_cover_both_sides(self):
+        for user in (self.buyer.user, self.seller.user):
+            response = self.export(user, 'pairings.jsonl')
+            rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+            self.assertEqual(len(rows), 1)
+            self.assertEqual((rows[0]['payer'], rows[0]['receiver']), ('export_buyer', 'export_seller'))
+            self.assertEqual(rows[0]['paired_amount'], '60.00')
+
+    def test_platform_wide_export_is_staff_only(self):
+        self.assertEqual(self.export(self.buyer.user, 'sales.csv', scope='all').status_code, 403)
+        self.assertEqual(len(b''.join(self.export(self.buyer.user, 'sales.csv').streaming_content).splitlines()), 1)
+
+        staff = User.objects.create_user(username='export_staff', password='x', is_staff=True)
+        response = self.export(staff, 'investments.csv', scope='all')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 3)
+        self.assertEqual(self.export(staff, 'users.csv', scope='all').status_code, 404)
+
+    def test_blocks_are_bounded(self):
+        lines = (f'{i:09d}\n' for i in range(1000))
+        sizes = [len(block) for block in exports.blocks(lines, size=100)]
+        self.assertEqual(sum(sizes), 10000)
+        self.assertLessEqual(max(sizes), 100)
+
+class ScalableAdminTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_superuser(username='ops', password='x', email='ops@example.com')
+        self.client.force_login(self.staff)
+        self.matured = Investment.objects.create(
+            investor=Investor.objects.create(user=User.objects.create_user(username='admin_seller', password='x')),
+            amount=Decimal('1000.00'), remaining_amount=Decimal('1000.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+
+    def add_pairings(self, count):
+        for _ in range(count):
+            investor = Investor.objects.create(
+                user=User.objects.create_user(username=f'admin_buyer{Investor.objects.count()}', password='x'))
+            Pairing.objects.create(investor=investor, paired_investment=self.matured, paired_amount=Decimal('10.00'))
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:api_pairing_changelist')
+        self.add_pairings(2)
+        few = self.changelist_queries(url)
+        self.add_pairings(10)
+        self.assertEqual(self.changelist_queries(url), few)
+
+    def test_older_link_continues_below_the_last_id(self):
+        self.add_pairings(5)
+        ids = list(Pairing.objects.order_by('-id').values_list('id', flat=True))
+
+        with mock.patch.object(api_admin.PairingAdmin, 'list_per_page', 2):
+            response = self.client.get(reverse('admin:api_pairing_changelist'))
+            self.assertEqual([p.pk for p in response.context['cl'].result_list], ids[:2])
+            older = response.context['cl'].older_url
+            self.assertEqual(older, f'?id__lt={ids[1]}')
+            self.assertContains(response, 'Older')
+
+            response = self.client.get(reverse('admin:api_pairing_changelist') + older)
+            self.assertEqual([p.pk for p in response.context['cl'].result_list], ids[2:4])
+
+    def test_search_uses_prefix_lookups(self):
+        self.add_pairings(3)
+        response = self.client.get(reverse('admin:api_investor_changelist'), {'q': 'admin_buy'})
+        self.assertEqual(len(response.context['cl'].result_list), 3)
+        response = self.client.get(reverse('admin:api_investor_changelist'), {'q': 'buyer'})
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    def test_counts_are_capped(self):
+        self.add_pairings(5)
+        with mock.patch.object(api_admin, 'COUNT_CAP', 3):
+            response = self.client.get(reverse('admin:api_pairing_changelist'))
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertIsNone(response.context['cl'].full_result_count)
+
+@override_settings(ROOT_URLCONF='config.urls_asgi', QUERY_BUDGET_RAISE=True)
+class AsyncViewTests(TestCase):
+    PAGES = ('api:dashboard', 'api:investment_status', 'api:waiting_to_be_paired', 'api:referrals')
+
+    def setUp(self):
+        cache.clear()
+        seller = Investor.objects.create(user=User.objects.create_user(username='async_seller', password='x'))
+        self.buyer = Investor.objects.create(user=User.objects.create_user(username='async_buyer', password='x'))
+        Investment.objects.create(
+            investor=seller, amount=Decimal('100.00'), remaining_amount=Decimal('100.00'),
+            maturation_date=timezone.now() - timedelta(days=1), is_matured=True
+        )
+        Investment.objects.create(
+            investor=self.buyer, amount=Decimal('60.00'), remaining_amount=Decimal('60.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+        match_investments()
+        Pairing.objects.update(confirmed=True, confirmed_at=timezone.now())
+        Referral.objects.create(referrer=self.buyer.user, referred_user=seller.user, code='ASYNC001')
+        self.client.force_login(self.buyer.user)
+        self.async_client.force_login(self.buyer.user)
+
+    def without_csrf(self, content):
+        return re.sub(rb'name="csrfmiddlewaretoken" value="[^"]+"', b'', content)
+
+    def test_hot_pages_are_async_and_render_like_the_sync_views(self):
+        for name in self.PAGES:
+            url = reverse(name)
+            self.assertTrue(iscoroutinefunction(resolve(url).func), name)
+            async_response = async_to_sync(self.async_client.get)(url)
+            self.assertEqual(async_response.status_code, 200, name)
+            with override_settings(ROOT_URLCONF='config.urls'):
+                self.assertFalse(iscoroutinefunction(resolve(url).func), name)
+                sync_response = self.client.get(url)
+            self.assertEqual(self.without_csrf(async_response.content), self.without_csrf(sync_response.content), name)
+        self.assertContains(async_response, 'async_seller')
+
+    def test_dashboard_shows_a_waiting_investment_without_stray_coroutines(self):
+        Investment.objects.create(
+            investor=self.buyer, amount=Decimal('75.00'), remaining_amount=Decimal('75.00'),
+            maturation_date=timezone.now() + timedelta(days=30)
+        )
+        self.buyer.refresh_from_db()
+        self.assertTrue(self.buyer.is_waiting)
+        url = reverse('api:dashboard')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            async_response = async_to_sync(self.async_client.get)(url)
+            gc.collect()
+        self.assertEqual([str(w.message) for w in caught if issubclass(w.category, RuntimeWarning)], [])
+        self.assertContains(async_response, 'Investment waiting: $75.00')
+        with override_settings(ROOT_URLCONF='config.urls'):
+            sync_response = self.client.get(url)
+        self.assertEqual(self.without_csrf(async_response.content), self.without_csrf(sync_response.content))
+
+    def test_async_pages_use_the_page_cache(self):
+        async_to_sync(self.async_client.get)(reverse('api:login'))  # Picks up a CSRF cookie
+        url = reverse('api:dashboard')
+        first = async_to_sync(self.async_client.get)(url)
+        second = async_to_sync(self.async_client.get)(url)
+        self.assertIn('cache;desc="miss"', first['Server-Timing'])
+        self.assertIn('cache;desc="hit"', second['Server-Timing'])
+        self.assertEqual(second.content, first.content)
+
+    def test_async_budget_counts_queries_run_by_the_async_orm(self):
+        @query_budget(1)
+        async def two_queries(request):
+            await User.objects.acount()
+            await Investment.objects.acount()
+
+        with self.assertRaises(QueryBudgetExceeded):
+            async_to_sync(two_queries)(RequestFactory().get('/'))
+
+
+class ServingComparisonTests(TransactionTestCase):
+    def test_both_serving_modes_are_measured(self):
+        with mock.patch('api.tasks.match_investment_event.delay'):
+            results = run_serving_comparison(size=12, requests=8, concurrency=2)
+
+        self.assertEqual([row['mode'] for row in results], ['wsgi', 'asgi'])
+        for row in results:
+            self.assertEqual(row['requests'], 8)
+            self.assertGreater(row['p95_ms'], 0)
@@ -34,4 +34,14 @@ urlpatterns = [
     # Add API endpoints for selling and canceling investments
     path('investments/sell/', views.SellInvestmentView.as_view(), name='sell_investment_api'),
     path('investments/sell/<int:sale_id>/cancel/', views.CancelSaleView.as_view(), name='cancel_sale_api'),
+    # Order book endpoints
+    path('orders/buy/', views.BuyOrderView.as_view(), name='buy_order_api'),
+    path('orders/buy/<int:order_id>/cancel/', views.CancelBuyOrderView.as_view(), name='cancel_buy_order_api'),
+    # Keyset-paginated market listings
+    path('market/shares/', views.ShareListingView.as_view(), name='share_listings_api'),
+    path('market/sales/', views.SaleListingView.as_view(), name='sale_listings_api'),
+    # Streaming statement exports, e.g. export/investments.csv
+    path('export/<slug:name>.<slug:file_format>', views.export_statement, name='export_statement'),
+    # Internal Prometheus metrics
+    path('metrics/', views.metrics, name='metrics'),
 ] 
\ No newline at end of file
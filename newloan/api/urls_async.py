@@ -0,0 +1,18 @@
+from django.urls import path
+from . import async_views
+from .urls import urlpatterns as sync_urlpatterns
+
+app_name = 'api'
+
+# The ASGI serving mode: the hot read pages are served by their async
+# versions and every other route by the same view as under WSGI
+async_urlpatterns = [
+    path('', async_views.dashboard, name='dashboard'),
+    path('investment-status/', async_views.investment_status, name='investment_status'),
+    path('investment-status/<int:investment_id>/', async_views.investment_status, name='investment_status_by_id'),
+    path('referrals/', async_views.referrals, name='referrals'),
+    path('waiting-to-be-paired/', async_views.waiting_to_be_paired, name='waiting_to_be_paired'),
+]
+async_names = {pattern.name for pattern in async_urlpatterns}
+
+urlpatterns = async_urlpatterns + [pattern for pattern in sync_urlpatterns if pattern.name not in async_names]
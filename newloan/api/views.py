@@ -5,20 +5,33 @@ from django.contrib import messages
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from decimal import Decimal
-from django.db.models import Sum, F, Q, Count
+from datetime import timedelta
+from django.db.models import Sum, F, Q, Count, Exists, OuterRef, Prefetch
 from django.contrib.auth.models import User
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
-import random
-import string
+from rest_framework.generics import ListAPIView
+import hmac
 import json
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.conf import settings
 
 from .forms import InvestorProfileForm
 from .models import Investor, Investment, Pairing, Referral, InvestmentSale
-from .tasks import match_waiting_investors
+from .tasks import schedule_matching
+from .matching import match_investments, enqueue, cancel, waiting_investments
+from .summaries import get_summary
+from .caching import cache_investor_page
+from .pagination import KeysetPagination
+from .querybudget import query_budget
+from .metrics import REGISTRY
+from .serializers import ListingFilterSerializer, SaleListingSerializer, ShareListingSerializer
+from .referrals import apply_referral, downline_stats, new_referral_code
+from .exports import CONTENT_TYPES, EXPORTS, stream_export
+from . import ledger, market, orderbook
 
 def index(request):
     return render(request, 'index.html')
@@ -44,76 +57,59 @@ def create_investment(request):
 @login_required
 def match_investor(request):
     new_investor = request.user.investor
-    matured_investments = Investment.objects.filter(is_matured=True, remaining_amount__gt=0).order_by('created_at')
-
-    if matured_investments.exists():
-        # Get the new investment that needs pairing
-        new_investment = Investment.objects.filter(
-            investor=new_investor,
-            remaining_amount__gt=0
-        ).first()
-
-        if new_investment:
-            for matured_investment in matured_investments:
-                if new_investment.remaining_amount <= 0:
-                    break  # If new investment is fully paired, exit the loop
-
-                # Calculate the return amount for the matured investment
-                return_amount = matured_investment.calculate_end_return()
-                
-                # Determine the amount to pair - use the return amount
-                amount_to_pair = min(new_investment.remaining_amount, return_amount)
-
-                # Create the pairing
-                Pairing.objects.create(
-                    investor=new_investor,
-                    paired_investment=matured_investment,
-                    paired_amount=amount_to_pair
-                )
-
-                # Update remaining amounts
-                new_investment.remaining_amount -= amount_to_pair
-                matured_investment.remaining_amount = 0  # Set to 0 since we're using the full return amount
-
-                # Update paired status if fully paired
-                if matured_investment.remaining_amount == 0:
-                    matured_investment.paired = True
-                
-                # Save the changes
-                new_investment.save()
-                matured_investment.save()
 
-                messages.success(request, f"Your investment has been paired with {matured_investment.investor.user.username} for ${amount_to_pair}")
+    # Get the new investment that needs pairing
+    new_investment = Investment.objects.filter(
+        investor=new_investor,
+        is_matured=False,
+        remaining_amount__gt=0
+    ).order_by('created_at').first()
+
+    if new_investment:
+        # Matching only pairs queued demand, so (re)join the queue first
+        enqueue(new_investment)
+        pairings = match_investments(immature=waiting_investments().filter(pk=new_investment.pk))
+
+        if pairings:
+            for pairing in pairings:
+                messages.success(request, f"Your investment has been paired with {pairing.paired_to.user.username} for ${pairing.paired_amount}")
 
-            # If the investment still has remaining amount, add to waiting queue
+            # If the investment still has remaining amount, it stays in the waiting queue
+            new_investment.refresh_from_db(fields=['remaining_amount'])
             if new_investment.remaining_amount > 0:
-                new_investor.is_waiting = True
-                new_investor.waiting_since = timezone.now()
-                new_investor.save()
                 messages.info(request, f"Your remaining investment of ${new_investment.remaining_amount} has been added to the waiting queue.")
-            
+
             return redirect('api:investment_status')
-    
+
     # If no matured investments are available or no new investment to pair
-    new_investor.is_waiting = True
-    new_investor.waiting_since = timezone.now()
-    new_investor.save()
+    if new_investment:
+        new_investor.refresh_from_db(fields=['is_waiting', 'waiting_since', 'waiting_investment_id'])
+    else:
+        new_investor.is_waiting = True
+        new_investor.waiting_since = timezone.now()
+        new_investor.save()
     messages.info(request, "You have been added to the waiting queue. You will be paired when investments mature.")
     return render(request, 'waiting_for_pairing.html', {
         'investor': new_investor
     })
 
+@query_budget(5)
 @login_required
 def investment_detail(request, investment_id):
     investment = get_object_or_404(Investment, id=investment_id, investor=request.user.investor)
     return render(request, 'investment_detail.html', {'investment': investment})
 
+@query_budget(5)
 @login_required
 def pairing_detail(request, pairing_id):
-    pairing = get_object_or_404(Pairing, id=pairing_id)
+    pairing = get_object_or_404(
+        Pairing.objects.select_related('investor__user', 'paired_investment__investor__user'), id=pairing_id
+    )
     return render(request, 'pairing_detail.html', {'pairing': pairing})
 
+@query_budget(6)
 @login_required
+@cache_investor_page
 def investment_status(request, investment_id=None):
     # Get the investment
     if investment_id:
@@ -124,25 +120,22 @@ def investment_status(request, investment_id=None):
             investor=request.user.investor,
         ).order_by('-created_at').first()
 
-    # Check if the investment has matured
-    if investment and investment.maturation_date <= timezone.now() and not investment.is_matured:
-        investment.is_matured = True
-        investment.save()  # This will trigger the pairing process
-
     # Get all pairings for this investment
     pairings = None
     if investment:
         pairings = Pairing.objects.filter(
             investor=request.user.investor,
             paired_investment__created_at__lte=investment.created_at
-        ).order_by('-created_at')
+        ).select_related('paired_investment__investor__user').order_by('-created_at')
 
     return render(request, 'investment_status.html', {
         'investment': investment,
         'pairings': pairings,
     })
 
+@query_budget(6)
 @login_required
+@cache_investor_page
 def sell_shares(request):
     """
     View for selling shares.
@@ -180,33 +173,21 @@ def sell_shares(request):
     
     return render(request, 'sell_shares.html', context)
 
+@query_budget(10)
 @login_required
+@cache_investor_page
 def dashboard(request):
     investor = request.user.investor
     # Only show investments that have been paired and confirmed
     investments = Investment.objects.filter(
         investor=investor,
         pairing__confirmed=True
-    ).distinct().order_by('-created_at')
-
-    # Calculate returns for each investment
-    total_returns = sum(inv.calculate_end_return() for inv in investments)
-    total_interest = sum(inv.calculate_projected_interest() for inv in investments)
-    projected_returns = sum(inv.calculate_end_return() for inv in investments if not inv.is_matured)
-
-    # Calculate waiting amount as cumulative total returns
-    waiting_returns = sum(
-        inv.calculate_end_return() 
-        for inv in investments 
-        if inv.remaining_amount > 0
+    ).distinct().order_by('-created_at').prefetch_related(
+        Prefetch('pairings', queryset=Pairing.objects.select_related('paired_investment__investor__user'))
     )
 
-    # Calculate statistics
-    stats = investments.aggregate(
-        total_invested=Sum('amount'),
-        total_paired=Sum('amount') - Sum('remaining_amount'),
-        active_investments=Count('id')
-    )
+    # Totals are maintained on the investor's portfolio summary row
+    summary = get_summary(investor)
 
     # Check if there are matured investments available for pairing
     matured_investments_available = Investment.objects.filter(
@@ -233,13 +214,13 @@ def dashboard(request):
 
     context = {
         'investments': investments,
-        'total_invested': stats['total_invested'] or Decimal('0.00'),
-        'total_paired': stats['total_paired'] or Decimal('0.00'),
-        'total_waiting': waiting_returns,  # Using cumulative returns instead of remaining amount
-        'active_investments': stats['active_investments'] or 0,
-        'total_returns': total_returns,
-        'total_interest': total_interest,
-        'projected_returns': projected_returns,
+        'total_invested': summary.total_invested,
+        'total_paired': summary.total_paired,
+        'total_waiting': summary.waiting_returns,  # Using cumulative returns instead of remaining amount
+        'active_investments': summary.active_investments,
+        'total_returns': summary.total_returns,
+        'total_interest': summary.total_interest,
+        'projected_returns': summary.projected_returns,
         'matured_investments_available': matured_investments_available,
         'active_pairings': active_pairings,
         'waiting_investment': waiting_investment
@@ -278,10 +259,8 @@ def cancel_waiting(request):
         if investment_id:
             investment = get_object_or_404(Investment, id=investment_id, investor=investor)
             
-            # Only cancel if the investment has remaining amount and investor is waiting
-            if investment.remaining_amount > 0 and investor.is_waiting:
-                investor.is_waiting = False
-                investor.save()
+            # Only cancel if the investment is in the waiting queue
+            if cancel(investment):
                 messages.success(request, "Your waiting status has been cancelled.")
             else:
                 messages.error(request, "Unable to cancel waiting status.")
@@ -314,6 +293,9 @@ def confirm_payment(request, pairing_id):
         # Set the maturation date based on your business logic (e.g., 30 days)
         new_investment.maturation_date = timezone.now() + timezone.timedelta(days=30)
         new_investment.save()
+
+        # The confirmed investment re-enters the market, so match only it
+        schedule_matching(new_investment.id)
         
         # Notify the new investor
         messages.success(
@@ -353,16 +335,11 @@ def register_view(request):
                 # Create user
                 user = form.save()
                 
-                # Create investor record
-                investor = Investor.objects.create(user=user, referred_by=referred_by)
-                
-                # Create referral record if applicable
+                # Create investor record, then place it in the referral tree
+                # and record the referral if applicable
+                investor = Investor.objects.create(user=user)
                 if referred_by:
-                    Referral.objects.create(
-                        referrer=referred_by.user,  # Use the User instance, not the Investor
-                        referred_user=user,
-                        code=referral_code
-                    )
+                    apply_referral(investor, referred_by)
                     messages.success(request, f"Registration successful! You were referred by {referred_by.user.username}.")
                 else:
                     messages.success(request, "Registration successful! Welcome to the Investment Platform.")
@@ -410,6 +387,7 @@ def logout_view(request):
     messages.info(request, "You have been logged out successfully.")
     return redirect('api:login')
 
+@query_budget(7)
 @login_required
 def referrals(request):
     try:
@@ -417,15 +395,23 @@ def referrals(request):
         referrals = Referral.objects.filter(
             referrer=request.user,
             is_active=True
-        ).select_related('referred_user')
+        ).select_related('referred_user').annotate(
+            referred_has_invested=Exists(Investment.objects.filter(investor__user=OuterRef('referred_user')))
+        )
         
         # Calculate total earnings
         total_earnings = sum(referral.total_earnings for referral in referrals)
+
+        # Whole downline per level, read from the referral closure table
+        downline_levels = downline_stats(request.user.investor)
         
         context = {
             'referrals': referrals,
             'total_earnings': total_earnings,
-            'total_referrals': referrals.count()
+            'total_referrals': referrals.count(),
+            'downline_levels': downline_levels,
+            'downline_size': sum(level['investors'] for level in downline_levels),
+            'downline_investment': sum(level['investment'] for level in downline_levels),
         }
         return render(request, 'referrals.html', context)
     except Exception as e:
@@ -471,17 +457,7 @@ class InvestmentCreateView(APIView):
                 amount=amount
             )
 
-            # Check if user was referred
-            try:
-                referral = Referral.objects.get(referred_user=request.user)
-                # Add the investment amount to referral tracking
-                referral.add_investment(amount)
-            except Referral.DoesNotExist:
-                pass
-
-            # Trigger matching process
-            from .tasks import match_waiting_investors
-            match_waiting_investors.delay()
+            # Referral earnings are credited by process_referral_earnings once matched
 
             return Response({
                 'message': 'Investment created successfully',
@@ -503,7 +479,7 @@ class ReferralCodeView(APIView):
             # Get or create referral code for the user
             referral, created = Referral.objects.get_or_create(
                 referrer=request.user,
-                defaults={'code': ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))}
+                defaults={'code': new_referral_code()}
             )
             
             return Response({
@@ -533,13 +509,11 @@ class ApplyReferralCodeView(APIView):
                 if referral.referrer == request.user:
                     return Response({'error': 'Cannot use your own referral code'}, status=status.HTTP_400_BAD_REQUEST)
                 
-                # Create new referral record
-                Referral.objects.create(
-                    referrer=referral.referrer,
-                    referred_user=request.user,
-                    code=code
-                )
-                
+                # Link into the referral tree and record the referral together
+                if apply_referral(request.user.investor, referral.referrer.investor) is None:
+                    return Response({'error': 'This referral code cannot be applied to your account'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+
                 return Response({'message': 'Referral code applied successfully'})
             except Referral.DoesNotExist:
                 return Response({'error': 'Invalid referral code'}, status=status.HTTP_400_BAD_REQUEST)
@@ -547,7 +521,9 @@ class ApplyReferralCodeView(APIView):
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+@query_budget(6)
 @login_required
+@cache_investor_page
 def waiting_to_be_paired(request):
     # Get all unpaired investments for the current user
     unpaired_investments = Investment.objects.filter(
@@ -560,7 +536,7 @@ def waiting_to_be_paired(request):
     pending_pairings = Pairing.objects.filter(
         paired_investment__investor=request.user.investor,
         confirmed=False
-    ).select_related('investor', 'paired_investment')
+    ).select_related('investor__user', 'paired_investment__investor__user')
     
     context = {
         'unpaired_investments': unpaired_investments,
@@ -568,6 +544,7 @@ def waiting_to_be_paired(request):
     }
     return render(request, 'waiting_to_be_paired.html', context)
 
+@query_budget(6)
 @login_required
 def buy_shares(request):
     if request.method == 'POST':
@@ -598,11 +575,11 @@ def buy_shares(request):
                 status='matched'  # Set status to matched since it's immediately available for sale
             )
             
-            # Automatically create a sale listing for the investment
-            sale = InvestmentSale.objects.create(
-                investment=investment,
-                seller=request.user,
-                price=amount  # Set initial price to the investment amount
+            # Automatically list the investment on the order book
+            sale = orderbook.list_investment(
+                investment,
+                request.user,
+                investment.amount  # Set initial price to the investment amount
             )
             
             return JsonResponse({
@@ -623,56 +600,26 @@ def buy_shares(request):
     
     # GET request - show the form
     investor = request.user.investor
-    return render(request, 'buy_shares.html', {'available_balance': investor.available_balance})
+    return render(request, 'buy_shares.html', {'available_balance': ledger.balance(investor)})
 
 @login_required
 def buy_share(request, share_id):
     """
     View for buying a specific share.
     """
-    # Get the share
-    share = get_object_or_404(Investment, id=share_id, status='available', is_for_sale=True)
-    
     if request.method == 'POST':
-        # Get the amount to buy
-        amount = Decimal(request.POST.get('amount', 0))
-        
-        # Validate the amount
-        if amount <= 0 or amount > share.amount:
+        try:
+            amount = Decimal(request.POST.get('amount', 0))
+        except ArithmeticError:
             messages.error(request, 'Invalid amount to buy.')
             return redirect('api:buy_shares')
-        
-        # Check if the user has enough balance
-        if request.user.investor.available_balance < amount:
-            messages.error(request, 'You do not have enough balance to buy this share.')
+
+        try:
+            buyer_investment = market.buy_share(request.user.investor, share_id, amount)
+        except market.PurchaseError as e:
+            messages.error(request, str(e))
             return redirect('api:buy_shares')
-        
-        # Create a new investment for the buyer
-        buyer_investment = Investment.objects.create(
-            investor=request.user.investor,
-            amount=amount,
-            maturation_date=share.maturation_date,
-            status='matched',
-            matched_at=timezone.now()
-        )
-        
-        # Update the seller's investment
-        share.amount -= amount
-        if share.amount == 0:
-            share.status = 'sold'
-        share.save()
-        
-        # Transfer the money from buyer to seller
-        buyer = request.user.investor
-        seller = share.investor
-        
-        buyer.available_balance -= amount
-        buyer.total_invested += amount
-        buyer.save()
-        
-        seller.available_balance += amount
-        seller.save()
-        
+
         messages.success(request, f'You have successfully bought a share for ${amount}.')
         return redirect('api:investment_detail', investment_id=buyer_investment.id)
     
@@ -729,18 +676,10 @@ class SellInvestmentView(APIView):
                     'message': 'This investment is already listed for sale'
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Create the sale listing
-            sale = InvestmentSale.objects.create(
-                investment=investment,
-                seller=request.user,
-                price=price
-            )
-            
-            # Update investment status
-            investment.is_for_sale = True
-            investment.status = 'available'
-            investment.save()
-            
+            # List the sale on the order book, which marks the investment for
+            # sale and matches it against open bids
+            sale = orderbook.list_investment(investment, request.user, price)
+
             return Response({
                 'success': True,
                 'message': 'Investment listed for sale successfully',
@@ -781,3 +720,147 @@ class CancelSaleView(APIView):
                 'success': False,
                 'message': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
+
+class BuyOrderView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        try:
+            amount = Decimal(str(request.data.get('amount', 0)))
+            limit_price = Decimal(str(request.data.get('limit_price', 0)))
+            days = int(request.data.get('days', 30))
+            if days < 1:
+                raise orderbook.OrderError('Days must be at least 1')
+            
+            # Place the bid; it trades at once against any crossing asks
+            order = orderbook.place_buy_order(
+                request.user.investor, amount, limit_price, timezone.now() + timedelta(days=days)
+            )
+            
+            return Response({
+                'success': True,
+                'order_id': order.id,
+                'status': order.status,
+                'filled_amount': order.amount - order.remaining_amount,
+                'remaining_amount': order.remaining_amount
+            })
+            
+        except (orderbook.OrderError, ArithmeticError, ValueError) as e:
+            return Response({
+                'success': False,
+                'message': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+class CancelBuyOrderView(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, order_id):
+        try:
+            orderbook.cancel_buy_order(order_id, request.user.investor)
+            return Response({
+                'success': True,
+                'message': 'Buy order cancelled successfully'
+            })
+            
+        except orderbook.OrderError as e:
+            return Response({
+                'success': False,
+                'message': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+class MarketListingView(ListAPIView):
+    """
+    Keyset-paginated market listing. ``filter_fields`` maps each validated
+    query parameter to the lookup it filters on.
+    """
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    filter_fields = {}
+
+    def get_queryset(self):
+        params = ListingFilterSerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        unsupported = set(params.validated_data) - set(self.filter_fields)
+        if unsupported:
+            raise ValidationError({name: 'Not supported by this listing.' for name in sorted(unsupported)})
+        queryset = self.listings()
+        for name, value in params.validated_data.items():
+            queryset = queryset.filter(**{self.filter_fields[name]: value})
+        return queryset
+
+class ShareListingView(MarketListingView):
+    """
+    Investments listed for direct purchase through buy_share. They sell at
+    face value, so there is no price to filter on, only the amount.
+    """
+    serializer_class = ShareListingSerializer
+    keyset_orderings = {
+        'maturity': ('maturation_date', 'id'),
+        'amount': ('amount', 'id'),
+    }
+    default_keyset_ordering = 'maturity'
+    filter_fields = {
+        'min_amount': 'amount__gte',
+        'max_amount': 'amount__lte',
+        'matures_after': 'maturation_date__gte',
+        'matures_before': 'maturation_date__lte',
+    }
+
+    def listings(self):
+        return Investment.objects.filter(status='available', is_for_sale=True).select_related('investor__user')
+
+class SaleListingView(MarketListingView):
+    """Pending order book asks, cheapest per unit first by default"""
+    serializer_class = SaleListingSerializer
+    keyset_orderings = {
+        'price': ('unit_price', 'id'),
+        'amount': ('remaining_amount', 'id'),
+    }
+    default_keyset_ordering = 'price'
+    filter_fields = {
+        'min_price': 'unit_price__gte',
+        'max_price': 'unit_price__lte',
+        'min_amount': 'remaining_amount__gte',
+        'max_amount': 'remaining_amount__lte',
+        'matures_after': 'investment__maturation_date__gte',
+        'matures_before': 'investment__maturation_date__lte',
+    }
+
+    def listings(self):
+        return InvestmentSale.objects.filter(status='pending').select_related('investment', 'seller')
+
+def has_metrics_token(request):
+    token = settings.METRICS_TOKEN
+    return bool(token) and hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint. Only staff and scrapers presenting
+    METRICS_TOKEN may read it; the client address is not trusted, since
+    behind a local reverse proxy every request comes from loopback.
+    """
+    if not (request.user.is_staff or has_metrics_token(request)):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@login_required
+def export_statement(request, name, file_format):
+    """
+    Stream the user's investments, pairings or sales as CSV or JSON Lines.
+    Staff can export every investor's rows with ``?scope=all``.
+    """
+    if name not in EXPORTS or file_format not in CONTENT_TYPES:
+        raise Http404('Unknown export')
+    if request.GET.get('scope') == 'all':
+        if not request.user.is_staff:
+            return HttpResponseForbidden()
+        investor, owner = None, 'all'
+    else:
+        investor, owner = request.user.investor, request.user.username
+
+    response = StreamingHttpResponse(
+        stream_export(name, file_format, investor), content_type=f'{CONTENT_TYPES[file_format]}; charset=utf-8'
+    )
+    filename = f'{name}-{owner}-{timezone.localdate().isoformat()}.{file_format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
     'api',  # Add your api app with full path
   
     'django_celery_beat',  # Add Celery Beat
@@ -44,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',  # First, so timings cover every other middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,7 +56,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'config.urls'
+# config/asgi.py selects the ASGI serving mode, whose URLconf routes the hot
+# read pages to their async views; WSGI keeps the sync views
+SERVING_MODE = os.environ.get('NEWLOAN_SERVING_MODE', 'wsgi')
+ROOT_URLCONF = 'config.urls_asgi' if SERVING_MODE == 'asgi' else 'config.urls'
 
 TEMPLATES = [
     {
@@ -131,6 +137,33 @@ MEDIA_ROOT = BASE_DIR / 'frontend' / 'media'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache Configuration
+# Redis is shared by all web workers in production; DEBUG uses a local memory cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'KEY_PREFIX': 'newloan',
+        'TIMEOUT': 300,
+    }
+}
+if DEBUG:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'newloan',
+    }
+
+# Safety net for cached investor pages; they are invalidated on every write
+INVESTOR_PAGE_CACHE_TIMEOUT = 600
+
+# Views over their api.querybudget budget raise in development and only log a
+# warning in production; the budget tests turn it on with override_settings
+QUERY_BUDGET_RAISE = DEBUG
+
+# Bearer token Prometheus sends to scrape api:metrics without a staff login
+# (``Authorization: Bearer <token>``); unset, only staff can read it
+METRICS_TOKEN = os.environ.get('NEWLOAN_METRICS_TOKEN')
+
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
@@ -139,19 +172,35 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Number of id ranges api.tasks.match_in_parallel splits matching into
+MATCHING_PARTITIONS = 4
+
+# Seconds before an api.locks singleton lock expires if its holder dies;
+# keep it above the longest matching run
+SINGLETON_LOCK_TIMEOUT = 600
+
+# Width in days of the maturity buckets the secondary market order book trades in
+MATURITY_BUCKET_DAYS = 7
+
+# Matching is event driven (see api.tasks.schedule_matching); the beat only
+# runs the maturation sweeper and periodic bookkeeping
 CELERY_BEAT_SCHEDULE = {
-    'match-investors-every-minute': {
-        'task': 'api.tasks.match_waiting_investors',
-        'schedule': 60.0,  # Run every minute
-    },
-    'process-investment-matching': {
-        'task': 'api.tasks.process_investment_matching',
+    'sweep-maturations': {
+        'task': 'api.tasks.sweep_maturations',
         'schedule': 60.0,  # Run every minute
     },
     'process-referral-earnings': {
         'task': 'api.tasks.process_referral_earnings',
         'schedule': 300.0,  # Run every 5 minutes
     },
+    'snapshot-balances': {
+        'task': 'api.tasks.snapshot_balances',
+        'schedule': 300.0,  # Run every 5 minutes
+    },
+    'send-notifications': {
+        'task': 'api.tasks.send_notifications',
+        'schedule': 10.0,  # Run every 10 seconds
+    },
 }
 
 # Email Configuration